@@ -1,7 +1,7 @@
 # apps/bot/documents.py
 from django_elasticsearch_dsl import Document, fields
 from django_elasticsearch_dsl.registries import registry
-from tika import parser
+from apps.multiparser.blobs import document_text
 from apps.multiparser.models import Document as DocumentModel
 
 
@@ -22,32 +22,19 @@ class DocumentDocument(Document):
             'page_count',
         ]
 
+    def get_queryset(self):
+        return super().get_queryset().select_related('blob__extracted_text')
+
     def prepare_content(self, instance):
         """
-        Extract content from text-based documents using Tika
+        Text of text-based documents, as extracted by Tika and stored by content hash
         """
-        # Only process text-based documents
-        text_based_types = ['application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']
-        
-        # Check if this is a text-based document
-        if not any(text_type in instance.file_type for text_type in text_based_types):
-            return ""
-
-        # If file exists locally, extract content
-        if instance.file_path:
-            try:
-                from django.conf import settings
-                import os
-                
-                file_path = os.path.join(settings.MEDIA_ROOT, instance.file_path)
-                if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                    with open(file_path, 'rb') as f:
-                        parsed = parser.from_buffer(f.read())
-
-                    if parsed and 'content' in parsed and parsed['content']:
-                        # Clean up text content
-                        return ' '.join(str(parsed['content']).split())
-            except Exception as e:
-                print(f"Tika error reading file {instance.file_path}: {e}")
-
-        return ""
\ No newline at end of file
+        # Text stored when the file was downloaded or extracted afterwards, already
+        # normalised and cut to EXTRACTED_TEXT_MAX_CHARS
+        text = document_text(instance)
+        if text is not None:
+            return text
+
+        # Documents without text yet are indexed as they are; flush_index_buffer
+        # queues their extraction, which indexes them again once it is done
+        return ""
@@ -1,7 +1,8 @@
 from django.contrib import admin
+from django.db import models
 from django.utils.html import format_html
 from django.urls import reverse
-from apps.multiparser.models import Seller, Document, Product, ProductView
+from apps.multiparser.models import Seller, Document, Product, ProductView, CrawlCheckpoint, Blob, ExtractedText
 
 # Import bot models only
 from apps.bot.models import User, SubscribeChannel, Location, SearchQuery, Broadcast, BroadcastRecipient
@@ -53,6 +54,7 @@ class CustomAdminSite(admin.AdminSite):
             'total_size_mb': round(total_size_mb, 2),
             'avg_size_mb': round(avg_size, 2),
             'file_count': file_count,
+            'truncated_texts': ExtractedText.objects.filter(truncated=True).count(),
         }
         
         extra_context['stats'] = stats
@@ -84,8 +86,8 @@ class SellerAdmin(admin.ModelAdmin):
 
 class DocumentAdmin(admin.ModelAdmin):
     """Admin interface for Document model"""
-    list_display = ['id', 'content_type', 'file_type', 'file_size', 'page_count', 'download_status_display', 'file_url_display', 'file_path_display', 'created_at']
-    list_filter = ['content_type', 'file_type', 'download_status', 'created_at']
+    list_display = ['id', 'content_type', 'file_type', 'file_size', 'page_count', 'stage_display', 'file_url_display', 'file_path_display', 'created_at']
+    list_filter = ['content_type', 'file_type', 'stage', 'created_at']
     search_fields = ['id', 'file_type', 'content_type']
     readonly_fields = ['id', 'created_at', 'updated_at', 'download_started_at', 'download_completed_at']
     list_per_page = 25
@@ -94,8 +96,8 @@ class DocumentAdmin(admin.ModelAdmin):
         ('Document Information', {
             'fields': ('id', 'content_type', 'file_type', 'file_size', 'page_count')
         }),
-        ('Download Status', {
-            'fields': ('download_status', 'download_started_at', 'download_completed_at', 'download_error'),
+        ('Pipeline Stage', {
+            'fields': ('stage', 'download_started_at', 'download_completed_at', 'download_error'),
             'classes': ('collapse',)
         }),
         ('Content Details', {
@@ -108,30 +110,39 @@ class DocumentAdmin(admin.ModelAdmin):
         }),
     )
 
-    def download_status_display(self, obj):
-        """Display download status with colors"""
-        status_colors = {
-            'pending': '#6c757d',
-            'downloading': '#ffc107',
-            'downloaded': '#28a745',
-            'failed': '#dc3545',
-            'skipped': '#6f42c1',
+    def stage_display(self, obj):
+        """Display pipeline stage with colors"""
+        Stage = Document.Stage
+        stage_colors = {
+            Stage.PENDING: '#6c757d',
+            Stage.DOWNLOADING: '#ffc107',
+            Stage.DOWNLOADED: '#28a745',
+            Stage.EXTRACTED: '#20c997',
+            Stage.INDEXED: '#17a2b8',
+            Stage.UPLOADED: '#007bff',
+            Stage.EVICTED: '#343a40',
+            Stage.FAILED: '#dc3545',
+            Stage.SKIPPED: '#6f42c1',
         }
-        color = status_colors.get(obj.download_status, '#6c757d')
-        status_icons = {
-            'pending': '⏳',
-            'downloading': '⬇️',
-            'downloaded': '✅',
-            'failed': '❌',
-            'skipped': '⏭️',
+        color = stage_colors.get(obj.stage, '#6c757d')
+        stage_icons = {
+            Stage.PENDING: '⏳',
+            Stage.DOWNLOADING: '⬇️',
+            Stage.DOWNLOADED: '✅',
+            Stage.EXTRACTED: '📝',
+            Stage.INDEXED: '🔎',
+            Stage.UPLOADED: '📤',
+            Stage.EVICTED: '🗑️',
+            Stage.FAILED: '❌',
+            Stage.SKIPPED: '⏭️',
         }
-        icon = status_icons.get(obj.download_status, '❓')
+        icon = stage_icons.get(obj.stage, '❓')
         return format_html(
             '<span style="color: {}; font-weight: bold;">{} {}</span>',
-            color, icon, obj.get_download_status_display()
+            color, icon, obj.get_stage_display()
         )
-    download_status_display.short_description = 'Download Status'
-    download_status_display.admin_order_field = 'download_status'
+    stage_display.short_description = 'Pipeline Stage'
+    stage_display.admin_order_field = 'stage'
 
     def file_url_display(self, obj):
         """Display file URL as clickable link"""
@@ -246,11 +257,51 @@ class ProductViewAdmin(admin.ModelAdmin):
     list_per_page = 25
 
 
+class CrawlCheckpointAdmin(admin.ModelAdmin):
+    """Admin interface for CrawlCheckpoint model"""
+    list_display = ['name', 'start_page', 'end_page', 'last_completed_page', 'completed', 'started_at', 'updated_at']
+    list_filter = ['completed']
+    readonly_fields = ['started_at', 'updated_at']
+
+
+class BlobAdmin(admin.ModelAdmin):
+    """Admin interface for Blob model"""
+    list_display = ['sha256', 'size', 'file_path', 'file_id', 'documents_count', 'created_at']
+    search_fields = ['sha256', 'file_id']
+    readonly_fields = ['sha256', 'size', 'created_at']
+    list_per_page = 25
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(documents_total=models.Count('documents'))
+
+    def documents_count(self, obj):
+        return obj.documents_total
+    documents_count.short_description = 'Documents'
+    documents_count.admin_order_field = 'documents_total'
+
+
+class ExtractedTextAdmin(admin.ModelAdmin):
+    """Admin interface for ExtractedText model"""
+    list_display = ['blob', 'length', 'original_length', 'truncated', 'compressed_size', 'created_at']
+    list_filter = ['truncated']
+    search_fields = ['blob__sha256']
+    exclude = ['data']
+    readonly_fields = ['blob', 'length', 'original_length', 'truncated', 'created_at']
+    list_per_page = 25
+
+    def compressed_size(self, obj):
+        return len(obj.data)
+    compressed_size.short_description = 'Compressed Size'
+
+
 # Register models with custom admin site
 admin_site.register(Seller, SellerAdmin)
 admin_site.register(Document, DocumentAdmin)
 admin_site.register(Product, ProductAdmin)
 admin_site.register(ProductView, ProductViewAdmin)
+admin_site.register(CrawlCheckpoint, CrawlCheckpointAdmin)
+admin_site.register(Blob, BlobAdmin)
+admin_site.register(ExtractedText, ExtractedTextAdmin)
 
 # Simple admin classes for bot models
 class BotUserAdmin(admin.ModelAdmin):
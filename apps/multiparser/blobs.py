@@ -0,0 +1,126 @@
+"""
+Content-addressed storage of downloaded documents
+"""
+import hashlib
+import logging
+import os
+import zlib
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.multiparser.models import Blob, Document, ExtractedText
+from apps.multiparser.pipeline import advance
+
+logger = logging.getLogger(__name__)
+
+# Extracted text compresses 4-6x; higher levels barely help and cost CPU on every download
+TEXT_COMPRESSION_LEVEL = 6
+
+
+def blob_path(sha256, extension):
+    """Absolute path of the stored content with digest `sha256`, sharded by the first two bytes"""
+    return Path(settings.MEDIA_ROOT) / 'blobs' / sha256[:2] / sha256[2:4] / f"{sha256}{extension}"
+
+
+def write_blob_text(sha256, extracted):
+    """Store the text extracted from a blob (a `BoundedText`), replacing an earlier extraction"""
+    ExtractedText.objects.update_or_create(
+        blob_id=sha256,
+        defaults={
+            'data': zlib.compress(extracted.text.encode('utf-8'), TEXT_COMPRESSION_LEVEL),
+            'length': len(extracted.text),
+            'original_length': extracted.seen,
+            'truncated': extracted.truncated,
+        },
+    )
+    if extracted.truncated:
+        logger.info(f"Text of blob {sha256} cut from {extracted.seen} to {len(extracted.text)} characters")
+
+
+def decompress_text(extracted):
+    return zlib.decompress(bytes(extracted.data)).decode('utf-8')
+
+
+def read_blob_text(sha256):
+    """Text extracted from a blob, None when it was never extracted"""
+    extracted = ExtractedText.objects.filter(blob_id=sha256).first()
+    return decompress_text(extracted) if extracted else None
+
+
+def document_text(document):
+    """
+    Stored text of `document`'s blob, None when there is none
+
+    Uses ``blob__extracted_text`` when the queryset selected it, so bulk
+    indexing does not issue a query per document.
+    """
+    if not document.blob_id:
+        return None
+    try:
+        return decompress_text(document.blob.extracted_text)
+    except ExtractedText.DoesNotExist:
+        return None
+
+
+def store_file_text(document, path, extracted):
+    """
+    Keep the text (a `BoundedText`) extracted from `path`, the local file of `document`
+
+    Documents downloaded before blobs existed get one here, so the text is
+    found by content hash from now on and shared with identical files.
+    """
+    sha256 = document.blob_id
+    if not sha256:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+        Blob.objects.get_or_create(sha256=sha256, defaults={'size': os.path.getsize(path), 'file_path': document.file_path})
+        Document.objects.filter(pk=document.pk, blob__isnull=True).update(blob_id=sha256, updated_at=timezone.now())
+        document.blob_id = sha256
+    write_blob_text(sha256, extracted)
+
+
+def store_download(part, extension, text=None):
+    """
+    Move a completed `PartialDownload` into the store, keyed by its SHA-256
+
+    Returns ``(blob, duplicate)``. When the content is already known, the new
+    copy is dropped and `duplicate` is True; the existing blob either still
+    has its file or was already uploaded to Telegram, so nothing has to be
+    stored, indexed or sent again. `text` extracted while downloading (a
+    `BoundedText`) is kept in the extracted text store.
+    """
+    size = part.verify()
+    sha256 = part.sha256()
+
+    with transaction.atomic():
+        blob, created = Blob.objects.select_for_update().get_or_create(sha256=sha256, defaults={'size': size})
+        if text is not None and (created or not ExtractedText.objects.filter(blob_id=sha256).exists()):
+            write_blob_text(sha256, text)
+        if not created and (blob.file_id or (blob.file_path and (Path(settings.MEDIA_ROOT) / blob.file_path).exists())):
+            part.discard()
+            return blob, True
+
+        path = blob_path(sha256, extension)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part.commit(path)
+        blob.file_path = str(path.relative_to(settings.MEDIA_ROOT))
+        blob.save(update_fields=['file_path'])
+        return blob, False
+
+
+def release_blob_file(blob):
+    """Delete the local copy of a blob and clear the path on every document sharing it"""
+    if blob.file_path:
+        try:
+            os.remove(Path(settings.MEDIA_ROOT) / blob.file_path)
+        except FileNotFoundError:
+            pass
+    advance(Document.objects.filter(blob=blob), Document.Stage.EVICTED, file_path=None)
+    blob.file_path = None
+    blob.save(update_fields=['file_path'])
@@ -0,0 +1,179 @@
+"""
+Removal of local files that are no longer needed
+
+A file is needed until its content is in the Telegram channel. The eligible
+rows are read a page at a time, by primary key; the files of a page are
+deleted from a thread pool and their paths cleared with one UPDATE per table,
+so a cleanup of a million documents never holds them all in memory, and no
+cursor is open on the rows being updated. When free space in MEDIA_ROOT drops
+below MEDIA_MIN_FREE_BYTES, `free_media_space` evicts eligible files of any
+age, least recently accessed first.
+"""
+import heapq
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count, islice
+from pathlib import Path
+
+from django.conf import settings
+
+from apps.multiparser.models import Blob, Document
+from apps.multiparser.pipeline import advance
+
+logger = logging.getLogger(__name__)
+
+
+def sent_blobs(sent_before=None):
+    """Blobs with a local copy whose content is already in the channel"""
+    blobs = Blob.objects.filter(file_path__isnull=False, file_id__isnull=False)
+    if sent_before:
+        blobs = blobs.filter(documents__sent_at__lt=sent_before).distinct()
+    return blobs
+
+
+def sent_documents(sent_before=None):
+    """Documents stored before content addressing (no blob) with a local copy, already in the channel"""
+    documents = Document.objects.filter(blob__isnull=True, file_path__isnull=False, sent_to_channel=True)
+    if sent_before:
+        documents = documents.filter(sent_at__lt=sent_before)
+    return documents
+
+
+def _pages(queryset, key, chunk_size):
+    """
+    (key, file_path) rows of `queryset`, fetched `chunk_size` at a time in `key` order
+
+    Each page is a query of its own that starts after the last key of the
+    previous one, so the caller may update the rows it was given in between.
+    """
+    last = None
+    while True:
+        page = queryset.order_by(key) if last is None else queryset.filter(**{f'{key}__gt': last}).order_by(key)
+        rows = list(page.values_list(key, 'file_path')[:chunk_size])
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1][0]
+
+
+def eligible_files(sent_before=None, chunk_size=None):
+    """Stream (kind, key, file_path) for every local file that may be deleted"""
+    chunk_size = chunk_size or settings.CLEANUP_CHUNK_SIZE
+    for sha256, file_path in _pages(sent_blobs(sent_before), 'sha256', chunk_size):
+        yield 'blob', sha256, file_path
+    for document_id, file_path in _pages(sent_documents(sent_before), 'id', chunk_size):
+        yield 'document', document_id, file_path
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _remove(path):
+    """Delete `path`; returns its size, 0 when it was already gone, None when it could not be deleted"""
+    try:
+        size = path.stat().st_size
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logger.error(f"Failed to delete {path}: {e}")
+        return None
+
+
+def _last_access(path):
+    """(last access time, size) of `path`, (0, 0) when it is gone"""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return 0.0, 0
+    # On noatime mounts the access time never moves past the modification time
+    return max(stat.st_atime, stat.st_mtime), stat.st_size
+
+
+def delete_files(executor, rows):
+    """Delete the files of `rows` concurrently and clear their paths; returns (files, bytes)"""
+    root = Path(settings.MEDIA_ROOT)
+    sizes = list(executor.map(_remove, [root / file_path for _, _, file_path in rows]))
+    removed = [row for row, size in zip(rows, sizes) if size is not None]
+
+    blob_keys = [key for kind, key, _ in removed if kind == 'blob']
+    document_keys = [key for kind, key, _ in removed if kind == 'document']
+    if blob_keys:
+        Blob.objects.filter(sha256__in=blob_keys).update(file_path=None)
+        advance(Document.objects.filter(blob_id__in=blob_keys), Document.Stage.EVICTED, file_path=None)
+    if document_keys:
+        advance(Document.objects.filter(id__in=document_keys), Document.Stage.EVICTED, file_path=None)
+    return len(removed), sum(size for size in sizes if size)
+
+
+def remove_sent_files(sent_before, chunk_size=None, threads=None):
+    """Delete the local copies of everything sent to the channel before `sent_before`, returns a summary"""
+    chunk_size = chunk_size or settings.CLEANUP_CHUNK_SIZE
+    started = time.monotonic()
+    summary = {'files': 0, 'bytes': 0}
+    with ThreadPoolExecutor(max_workers=threads or settings.CLEANUP_THREADS) as executor:
+        for rows in _chunks(eligible_files(sent_before, chunk_size), chunk_size):
+            files, size = delete_files(executor, rows)
+            summary['files'] += files
+            summary['bytes'] += size
+    summary['elapsed'] = round(time.monotonic() - started, 2)
+    return summary
+
+
+def free_media_space(min_free=None, target_free=None, chunk_size=None, threads=None):
+    """
+    Evict files already in the channel while MEDIA_ROOT is short of space
+
+    Does nothing while at least `min_free` bytes are free. Otherwise the least
+    recently used eligible files that free up to `target_free` are selected in
+    one pass, keeping only as many as are needed, and deleted. Files that are
+    not in the channel yet are never touched. Returns a summary.
+    """
+    min_free = settings.MEDIA_MIN_FREE_BYTES if min_free is None else min_free
+    target_free = max(min_free, settings.MEDIA_TARGET_FREE_BYTES if target_free is None else target_free)
+    chunk_size = chunk_size or settings.CLEANUP_CHUNK_SIZE
+    root = Path(settings.MEDIA_ROOT)
+
+    free = shutil.disk_usage(root).free if root.exists() else min_free
+    summary = {'free_before': free, 'free_after': free, 'files': 0, 'bytes': 0}
+    if free >= min_free:
+        return summary
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads or settings.CLEANUP_THREADS) as executor:
+        # The least recently used files seen so far that free what is needed,
+        # the most recently used of them on top of the heap
+        needed = target_free - free
+        selected = []
+        selected_bytes = 0
+        order = count()
+        for rows in _chunks(eligible_files(chunk_size=chunk_size), chunk_size):
+            accesses = executor.map(_last_access, [root / file_path for _, _, file_path in rows])
+            for (accessed, size), row in zip(accesses, rows):
+                heapq.heappush(selected, (-accessed, next(order), size, row))
+                selected_bytes += size
+                while selected_bytes - selected[0][2] >= needed:
+                    selected_bytes -= heapq.heappop(selected)[2]
+
+        victims = [row for *_, row in sorted(selected, reverse=True)]
+
+        for rows in _chunks(victims, chunk_size):
+            files, size = delete_files(executor, rows)
+            summary['files'] += files
+            summary['bytes'] += size
+
+    summary['free_after'] = shutil.disk_usage(root).free
+    summary['elapsed'] = round(time.monotonic() - started, 2)
+    if summary['free_after'] < min_free:
+        logger.warning(
+            f"MEDIA_ROOT still has only {summary['free_after'] / 2 ** 30:.1f} GB free after evicting "
+            f"{summary['files']} files; the rest is not in the channel yet"
+        )
+    return summary
@@ -0,0 +1,125 @@
+"""
+De-duplication of document pipeline tasks, backed by Redis
+
+`enqueue_once` publishes a task for a document only when the same task is not
+queued for that document already. The (task name, document id) pair stays
+claimed until the task calls `task_finished`; rescheduling itself or retrying
+keeps the claim. `TaskLock` keeps two workers from running the same pair at
+the same time, for duplicates that reach a worker anyway (plain ``delay()``
+calls, messages redelivered by the broker). Claims and locks expire, so a task
+lost with its worker does not block the document forever; a lock is renewed
+while its task runs, however long the download or extraction takes.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+
+from apps.multiparser.ratelimit import get_redis
+
+# KEYS[1] is a sorted set of the claimed document ids of one task, scored by
+# the time the claim expires. Claims the ids that are not claimed yet while
+# fewer than ARGV[1] are, and returns the room left and the claimed ids.
+CLAIM_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local room = tonumber(ARGV[1]) - redis.call('ZCARD', KEYS[1])
+local added = {}
+for i = 3, #ARGV do
+    if room <= 0 then
+        break
+    end
+    if not redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[i])
+        added[#added + 1] = ARGV[i]
+        room = room - 1
+    end
+end
+return {room, added}
+"""
+# Delete the lock only if it still holds our token (it may have expired and been taken over)
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# Extend the lock only if it still holds our token
+EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+UNLIMITED = 2 ** 31
+
+
+def claim(task_name, document_ids, limit=None, ttl=None):
+    """
+    Claim `task_name` for `document_ids`
+
+    Ids already claimed are left out, and no more than `limit` ids are claimed
+    at once. Returns (claimed ids, room left).
+    """
+    redis = get_redis()
+    room, added = redis.register_script(CLAIM_SCRIPT)(
+        keys=[f"tasks:queued:{task_name}"],
+        args=[limit or UNLIMITED, ttl or settings.TASK_QUEUED_TTL, *[str(document_id) for document_id in document_ids]],
+    )
+    return [document_id.decode() for document_id in added], room
+
+
+def enqueue_once(task, document_id, claim_name=None, **kwargs):
+    """
+    Publish `task` for `document_id` unless it is queued for it already; returns whether it was published
+
+    `claim_name` (default: the task name) claims a variant of the task apart
+    from the others, e.g. one called with different arguments.
+    """
+    claimed, _ = claim(claim_name or task.name, [document_id])
+    if claimed:
+        task.apply_async(args=[str(document_id)], kwargs=kwargs)
+    return bool(claimed)
+
+
+def task_finished(task_name, document_id):
+    """Drop the claim on `task_name` for `document_id`, so it can be queued again"""
+    get_redis().zrem(f"tasks:queued:{task_name}", str(document_id))
+
+
+class TaskLock:
+    """
+    Exclusive right to run `task_name` for `document_id`
+
+    The lock expires `ttl` seconds after its worker is lost. While it is held,
+    a watchdog thread extends it every third of `ttl`.
+    """
+
+    def __init__(self, task_name, document_id, ttl=None):
+        self.key = f"tasks:running:{task_name}:{document_id}"
+        self.ttl = ttl or settings.TASK_LOCK_TTL
+        self.token = uuid.uuid4().hex
+        self.redis = get_redis()
+        self._released = threading.Event()
+
+    def acquire(self):
+        if not self.redis.set(self.key, self.token, nx=True, ex=self.ttl):
+            return False
+        threading.Thread(target=self._keep_alive, name=f"lock:{self.key}", daemon=True).start()
+        return True
+
+    def _keep_alive(self):
+        extend = self.redis.register_script(EXTEND_SCRIPT)
+        while not self._released.wait(self.ttl / 3):
+            try:
+                if not extend(keys=[self.key], args=[self.token, self.ttl]):
+                    # Expired and taken over; nothing left to keep
+                    return
+            except Exception:
+                # Redis unreachable for now; the lock lasts until its TTL runs out
+                pass
+
+    def release(self):
+        self._released.set()
+        self.redis.register_script(RELEASE_SCRIPT)(keys=[self.key], args=[self.token])
@@ -0,0 +1,588 @@
+"""
+Bulk document downloader: one asyncio event loop streaming hundreds of files
+concurrently over a pooled (HTTP/2 when available) httpx client
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import statistics
+import threading
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+import httpx
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.multiparser.blobs import store_download
+from apps.multiparser.crawler import TokenBucket
+from apps.multiparser.extraction import AsyncTikaStream, BoundedText, TikaPool, extraction_timeout
+from apps.multiparser.extractors import extracts_natively
+from apps.multiparser.models import Document
+from apps.multiparser.pipeline import claim, transition
+from apps.multiparser.ratelimit import HostRateLimiter
+from apps.multiparser.retry import CircuitBreaker, RetryPolicy, is_retryable, is_throttled, retry_after_seconds
+
+# HTTP/2 needs the optional h2 package; plain HTTP/1.1 keep-alive pooling otherwise
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# Ask for the stored bytes so that byte offsets line up across ranged requests
+DOWNLOAD_HEADERS = {'Accept-Encoding': 'identity'}
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)')
+
+
+
+def guess_extension(url, content_type=''):
+    """File extension from the URL, falling back to the response content type"""
+    extension = Path(url).suffix
+    if extension:
+        return extension
+    if 'pdf' in content_type:
+        return '.pdf'
+    if 'doc' in content_type:
+        return '.doc'
+    return '.pdf'
+
+
+class IncompleteDownload(IOError):
+    """The transfer ended before the expected number of bytes arrived (the .part file is kept)"""
+
+
+class HostUnavailable(Exception):
+    """The host's circuit stays open for longer than the retry budget; the document is handed back"""
+
+
+def parse_content_range(value):
+    """Parse a Content-Range header into (start, total); either may be None"""
+    match = CONTENT_RANGE_PATTERN.match(value or '')
+    if not match:
+        return None, None
+    start, total = match.groups()
+    return (int(start) if start is not None else None), (int(total) if total != '*' else None)
+
+
+class PartialDownload:
+    """
+    A resumable download of one document into ``document_<id>.part``.
+
+    When a previous attempt left a partial file behind, `request_headers()` asks
+    for the remaining bytes with ``Range``, guarded by ``If-Range`` on the
+    validator (ETag or Last-Modified) saved next to it, so a file that changed
+    upstream is fetched again from the start instead of being spliced together.
+    `commit()` checks the size against Content-Length / Content-Range before
+    moving the file into place. The SHA-256 of the content is computed while
+    the chunks are written (the kept prefix is re-read once on resume). Works
+    with both requests and httpx responses.
+    """
+
+    def __init__(self, document_id):
+        directory = Path(settings.MEDIA_ROOT) / 'documents' / str(document_id)
+        self.path = directory / f"document_{document_id}.part"
+        self.validator_path = directory / f"document_{document_id}.part.validator"
+        self.expected_size = None
+        self.resumed = 0
+        self.hasher = hashlib.sha256()
+
+    @property
+    def offset(self):
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def request_headers(self):
+        """Headers for the next request: a ranged one when there is something to resume"""
+        headers = dict(DOWNLOAD_HEADERS)
+        offset = self.offset
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+            try:
+                headers['If-Range'] = self.validator_path.read_text().strip()
+            except OSError:
+                # Without a validator a changed file cannot be detected; start over
+                self.discard()
+                del headers['Range']
+        return headers
+
+    def _rehash(self):
+        """Hash the bytes already on disk before appending to them"""
+        self.hasher = hashlib.sha256()
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                self.hasher.update(chunk)
+
+    def _begin(self, status_code, headers):
+        """Work out how the response continues the part file: 'ab', 'wb', or None when already complete"""
+        offset = self.offset
+        if status_code == 206:
+            start, total = parse_content_range(headers.get('content-range'))
+            if start != offset:
+                self.discard()
+                raise IncompleteDownload(f"Server resumed at byte {start}, expected {offset}")
+            self.expected_size = total
+            self.resumed = offset
+            self._rehash()
+            return 'ab'
+
+        if status_code == 416:
+            _, total = parse_content_range(headers.get('content-range'))
+            if total is not None and total == offset:
+                self.expected_size = total
+                self._rehash()
+                return None
+            self.discard()
+            raise IncompleteDownload(f"Range {offset}- not satisfiable, restarting from scratch")
+
+        # Full response: the range was ignored or the file changed upstream
+        length = headers.get('content-length')
+        self.expected_size = int(length) if length and length.isdigit() else None
+        self.resumed = 0
+        self.hasher = hashlib.sha256()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        validator = headers.get('etag') or headers.get('last-modified')
+        if validator:
+            self.validator_path.write_text(validator)
+        else:
+            self.validator_path.unlink(missing_ok=True)
+        return 'wb'
+
+    def receive(self, status_code, headers, chunks, extractor=None):
+        """
+        Append the body chunks of a 200/206/416 response to the part file
+
+        Every chunk is written, hashed and handed to `extractor` (a `TikaStream`) in
+        the same pass. Returns True when the extractor saw the whole file; on a
+        resumed download it is aborted, the text is then extracted from the file later.
+        """
+        mode = self._begin(status_code, headers)
+        if mode != 'wb' and extractor is not None:
+            extractor.abort()
+            extractor = None
+        if mode is None:
+            return False
+        with open(self.path, mode) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                self.hasher.update(chunk)
+                if extractor is not None:
+                    extractor.feed(chunk)
+        return extractor is not None
+
+    async def areceive(self, status_code, headers, chunks, extractor=None):
+        """`receive` for an async chunk iterator and an `AsyncTikaStream`"""
+        mode = self._begin(status_code, headers)
+        if mode != 'wb' and extractor is not None:
+            extractor.abort()
+            extractor = None
+        if mode is None:
+            return False
+        with open(self.path, mode) as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                self.hasher.update(chunk)
+                if extractor is not None:
+                    await extractor.feed(chunk)
+        return extractor is not None
+
+    def verify(self):
+        """Check the part file is complete, returns its size"""
+        size = self.offset
+        if self.expected_size is not None and size != self.expected_size:
+            if size > self.expected_size:
+                self.discard()
+            raise IncompleteDownload(f"Got {size} of {self.expected_size} bytes")
+        return size
+
+    def sha256(self):
+        return self.hasher.hexdigest()
+
+    def commit(self, path):
+        """Verify the part file is complete and move it to `path`; returns its size"""
+        size = self.verify()
+        os.replace(self.path, path)
+        self.validator_path.unlink(missing_ok=True)
+        return size
+
+    def discard(self):
+        self.path.unlink(missing_ok=True)
+        self.validator_path.unlink(missing_ok=True)
+
+
+@dataclass
+class DownloadResult:
+    """Outcome of downloading one document"""
+    document_id: object
+    url: str
+    part: Optional[PartialDownload] = None
+    extension: str = ''
+    size: int = 0
+    resumed: int = 0
+    duplicate: bool = False
+    text: Optional[BoundedText] = None
+    status_code: Optional[int] = None
+    first_byte: float = 0.0
+    elapsed: float = 0.0
+    error: Optional[Exception] = None
+    # Whether the outcome was written to the document (see `DownloadLease`)
+    recorded: bool = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class BatchDownloader:
+    """
+    Download many files concurrently from a single event loop.
+
+    At most `concurrency` transfers run at once over one shared connection pool.
+    Every request books a slot of the host's `HostRateLimiter`, the Redis token
+    bucket the single-file download tasks use as well, so batches never add to
+    the DOWNLOAD_RATE_LIMIT of a host; `rate` caps this batch's new requests per
+    second further (0 for no extra cap). Bodies are streamed to a
+    ``.part`` file chunk by chunk, so memory stays flat regardless of file size,
+    and an interrupted transfer resumes where it stopped (see `PartialDownload`).
+    Completed files are left for the caller to move into the blob store. With
+    `extract`, each file is also streamed to Tika as it arrives (see
+    `AsyncTikaStream`) while a `TikaPool` slot is free; files that find Tika busy
+    (and formats extracted in-process, see `extractors`) are left for the
+    extraction queue. Transport errors and retryable statuses are retried
+    according to `retry_policy`, and the per-host circuit breaker shared with
+    the Celery tasks is honoured: a document whose host stays unavailable for
+    longer than the policy's `max_delay` ends with `HostUnavailable`.
+    """
+
+    def __init__(self, concurrency=100, rate=0, timeout=60, retry_policy=None, extract=False):
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.timeout = timeout
+        self.extract = extract
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=3, base_delay=2.0, max_delay=120.0)
+        self.limiters = {}
+
+    def limiter(self, url):
+        """The shared `HostRateLimiter` of `url`'s host"""
+        host = urlparse(url).hostname or 'unknown'
+        if host not in self.limiters:
+            self.limiters[host] = HostRateLimiter(host)
+        return self.limiters[host]
+
+    def download(self, jobs):
+        """Download `jobs` ((document_id, url) pairs), returns a `DownloadResult` per job"""
+        return asyncio.run(self._download_all(jobs))
+
+    async def _download_all(self, jobs):
+        bucket = TokenBucket(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        timeout = httpx.Timeout(self.timeout, connect=10)
+
+        # Tika uploads get their own pool so they never wait behind the downloads feeding them
+        async with httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=limits, timeout=timeout,
+                                     follow_redirects=True) as client, \
+                httpx.AsyncClient(limits=limits, timeout=timeout) as tika_client:
+            self.tika_client = tika_client
+            self.tika_pool = TikaPool() if self.extract else None
+            return await asyncio.gather(*(
+                self._download(client, semaphore, bucket, document_id, url) for document_id, url in jobs
+            ))
+
+    async def _download(self, client, semaphore, bucket, document_id, url):
+        result = DownloadResult(document_id=document_id, url=url)
+        breaker = CircuitBreaker.for_url(url)
+        started = time.monotonic()
+
+        async with semaphore:
+            for attempt in range(self.retry_policy.max_attempts):
+                wait = breaker.open_for()
+                if wait > self.retry_policy.max_delay:
+                    result.error = HostUnavailable(f"{breaker.host} unavailable for another {wait:.0f}s")
+                    break
+                if wait:
+                    await asyncio.sleep(wait)
+                await bucket.acquire()
+                await asyncio.sleep(await asyncio.to_thread(self.limiter(url).reserve))
+
+                retry_after = None
+                try:
+                    await self._stream(client, url, result, started)
+                except httpx.HTTPStatusError as e:
+                    result.error = e
+                    if not is_retryable(e.response.status_code):
+                        break
+                    if is_throttled(e.response.status_code):
+                        retry_after = retry_after_seconds(e.response.headers)
+                        bucket.slow_down()
+                    breaker.record_failure(retry_after)
+                except (httpx.TransportError, OSError) as e:
+                    # Includes IncompleteDownload: the next attempt resumes from the .part file
+                    result.error = e
+                    breaker.record_failure()
+                else:
+                    result.error = None
+                    breaker.record_success()
+                    bucket.recover()
+                    break
+
+                if attempt + 1 < self.retry_policy.max_attempts:
+                    await asyncio.sleep(self.retry_policy.delay(attempt, retry_after))
+
+        result.elapsed = time.monotonic() - started
+        return result
+
+    async def _stream(self, client, url, result, started):
+        part = PartialDownload(result.document_id)
+        async with client.stream('GET', url, headers=part.request_headers()) as response:
+            result.status_code = response.status_code
+            if response.status_code not in (200, 206, 416):
+                if not is_retryable(response.status_code):
+                    part.discard()
+                response.raise_for_status()
+            result.first_byte = time.monotonic() - started
+
+            extension = guess_extension(url, response.headers.get('content-type', ''))
+            stream = self.extract and not extracts_natively(extension)
+            timeout = extraction_timeout(size=int(response.headers.get('content-length') or 0))
+            with self.tika_pool.slot(timeout) if stream else nullcontext() as endpoint:
+                extractor = AsyncTikaStream(self.tika_client, endpoint, timeout) if endpoint else None
+                try:
+                    extracted = await part.areceive(
+                        response.status_code, response.headers, response.aiter_raw(CHUNK_SIZE), extractor
+                    )
+                except BaseException:
+                    if extractor is not None:
+                        extractor.abort()
+                    raise
+                result.size = part.verify()
+                if extracted:
+                    result.text = await extractor.finish()
+            result.resumed = part.resumed
+            result.extension = extension
+            result.part = part
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def batch_stats(results, elapsed):
+    """Throughput and latency figures for one batch, JSON-serialisable"""
+    done = [r for r in results if r.ok]
+    size = sum(r.size for r in done)
+    first_bytes = [r.first_byte for r in done]
+    durations = [r.elapsed for r in done]
+    return {
+        'files': len(results),
+        'downloaded': len(done),
+        'failed': len(results) - len(done),
+        'bytes': size,
+        'bytes_resumed': sum(r.resumed for r in done),
+        'duplicates': sum(1 for r in done if r.duplicate),
+        'extracted': sum(1 for r in done if r.text is not None),
+        'truncated': sum(1 for r in done if r.text is not None and r.text.truncated),
+        'elapsed': round(elapsed, 2),
+        'files_per_second': round(len(done) / elapsed, 2) if elapsed else 0.0,
+        'mbytes_per_second': round(size / elapsed / 2 ** 20, 2) if elapsed else 0.0,
+        'first_byte_p50': round(_percentile(first_bytes, 50), 3),
+        'first_byte_p95': round(_percentile(first_bytes, 95), 3),
+        'duration_p50': round(_percentile(durations, 50), 3),
+        'duration_p95': round(_percentile(durations, 95), 3),
+    }
+
+
+def pending_documents():
+    """Documents that still have to be downloaded"""
+    return (
+        Document.objects.filter(stage=Document.Stage.PENDING, file_url__isnull=False)
+        .exclude(product__id=327540)  # Skip this specific product ID as requested
+    )
+
+
+class DownloadLease:
+    """
+    Hold on to documents claimed for download while they are fetched
+
+    ``download_started_at`` is the lease: set when the documents are claimed
+    and renewed every third of DOWNLOAD_LEASE_SECONDS by a watchdog thread
+    until `stop()`, so `release_expired_downloads` only hands back documents
+    of lost workers. A document is still held while it is downloading and
+    carries the latest renewal time; outcomes are recorded through
+    `transition`, which moves held documents only.
+    """
+
+    def __init__(self, document_ids, started_at):
+        self.document_ids = list(document_ids)
+        self.renewed_at = started_at
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._keep_alive, name='download-lease', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def held(self, document_ids=None):
+        """The documents among `document_ids` (default: all of the lease) it still holds"""
+        return Document.objects.filter(
+            id__in=self.document_ids if document_ids is None else document_ids,
+            stage=Document.Stage.DOWNLOADING,
+            download_started_at=self.renewed_at,
+        )
+
+    def transition(self, stage, document_ids=None, **fields):
+        """`pipeline.transition` of the held documents, returns the number moved"""
+        with self._lock:
+            return transition(self.held(document_ids), stage, **fields)
+
+    def _keep_alive(self):
+        try:
+            while not self._stopped.wait(settings.DOWNLOAD_LEASE_SECONDS / 3):
+                with self._lock:
+                    renewed_at = timezone.now()
+                    self.held().update(download_started_at=renewed_at)
+                    self.renewed_at = renewed_at
+        except Exception as e:
+            # The lease runs out and the documents are handed back; the outcome is not recorded
+            logger.error(f"Failed to renew the download lease of {len(self.document_ids)} documents: {e}")
+        finally:
+            connection.close()
+
+
+def release_expired_downloads(lease=None):
+    """
+    Hand documents whose download lease ran out back to pending, returns their ids
+
+    A document stays in the downloading stage only while a worker fetches it,
+    and its `DownloadLease` is renewed meanwhile, so one whose lease is older
+    than `lease` seconds (default: DOWNLOAD_LEASE_SECONDS) was left behind by
+    a lost worker.
+    """
+    cutoff = timezone.now() - timezone.timedelta(seconds=lease or settings.DOWNLOAD_LEASE_SECONDS)
+    expired = Document.objects.filter(stage=Document.Stage.DOWNLOADING).filter(
+        Q(download_started_at__lt=cutoff) | Q(download_started_at__isnull=True)
+    )
+    ids = list(expired.values_list('id', flat=True))
+    if ids:
+        transition(expired.filter(id__in=ids), Document.Stage.PENDING)
+        logger.warning(f"Handed {len(ids)} documents with an expired download lease back to pending")
+    return ids
+
+
+def pending_document_ids(limit=None):
+    """Ids of (up to `limit`) documents that still have to be downloaded"""
+    ids = pending_documents().values_list('id', flat=True)
+    return list(ids[:limit] if limit else ids)
+
+
+
+def download_batch(document_ids, concurrency=100, rate=0, timeout=60, on_downloaded=None, extract=None):
+    """
+    Claim pending documents among `document_ids`, download them and record the outcome
+
+    Documents are claimed by moving them from pending to downloading first, so
+    overlapping batches or single-file tasks never fetch the same file twice,
+    and held by a `DownloadLease` until their outcome is recorded.
+    Documents whose host is unavailable are handed back to pending, and so is
+    every claimed document when the batch itself fails (e.g. before a retry).
+    Downloaded files go to the blob store; a document whose content is already
+    stored shares the existing blob and its Telegram file_id. `extract` (default:
+    the EXTRACT_WHILE_DOWNLOADING setting) extracts the text in the same pass.
+    `on_downloaded(document_id, extracted)` is called for every newly stored file only.
+    Returns `batch_stats`.
+    """
+    if extract is None:
+        extract = settings.EXTRACT_WHILE_DOWNLOADING
+    started_at = timezone.now()
+    claimed = claim(
+        Document.objects.filter(id__in=document_ids, file_url__isnull=False).values('id'),
+        Document.Stage.DOWNLOADING,
+        sources=[Document.Stage.PENDING],
+        download_started_at=started_at,
+    )
+    lease = DownloadLease(claimed, started_at)
+    try:
+        results, elapsed = _download_claimed(lease, concurrency, rate, timeout, extract)
+    except BaseException:
+        lease.transition(Document.Stage.PENDING)
+        raise
+
+    if on_downloaded:
+        for result in results:
+            if result.ok and result.recorded and not result.duplicate:
+                on_downloaded(result.document_id, result.text is not None)
+
+    return batch_stats(results, elapsed)
+
+
+def _download_claimed(lease, concurrency, rate, timeout, extract):
+    """Download the documents of `lease` and record the outcome, returns (results, elapsed)"""
+    documents = Document.objects.filter(id__in=lease.document_ids).values_list('id', 'file_url')
+
+    started = time.monotonic()
+    downloader = BatchDownloader(concurrency=concurrency, rate=rate, timeout=timeout, extract=extract)
+    with lease:
+        results = downloader.download(list(documents))
+    elapsed = time.monotonic() - started
+
+    completed_at = timezone.now()
+    with transaction.atomic():
+        for result in results:
+            if result.ok:
+                try:
+                    blob, result.duplicate = store_download(result.part, result.extension, text=result.text)
+                except Exception as e:
+                    result.error = e
+
+            if result.ok:
+                stage = Document.Stage.EXTRACTED if result.text is not None else Document.Stage.DOWNLOADED
+                fields = {'blob': blob, 'file_path': blob.file_path, 'download_completed_at': completed_at,
+                          'download_error': None}
+                if blob.file_id:
+                    fields.update(file_id=blob.file_id, sent_to_channel=True, sent_at=completed_at)
+                    stage = Document.Stage.UPLOADED
+            elif isinstance(result.error, HostUnavailable):
+                # Not the document's fault; the next dispatch picks it up again
+                stage, fields = Document.Stage.PENDING, {'download_error': str(result.error)}
+            else:
+                logger.error(f"Error downloading document {result.document_id}: {result.error}")
+                stage = Document.Stage.FAILED
+                fields = {'file_path': None, 'download_completed_at': None, 'download_error': str(result.error)}
+
+            # A document whose lease ran out meanwhile belongs to whoever claimed it next
+            result.recorded = bool(lease.transition(stage, [result.document_id], **fields))
+            if not result.recorded:
+                logger.warning(f"Document {result.document_id}: download lease lost, outcome not recorded")
+    return results, elapsed
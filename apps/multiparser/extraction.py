@@ -0,0 +1,330 @@
+"""
+Text extraction that runs while a document is being downloaded
+
+The download loop feeds every chunk to a Tika ``PUT /tika`` request whose body
+is streamed (chunked transfer encoding), so the text is ready as soon as the
+last byte is written and the file never has to be read back for indexing.
+Files that could not be streamed are extracted later by the
+``extract_document_text`` task. Both share `TikaPool`, which spreads the
+work over the configured Tika servers and caps the extractions per server.
+"""
+import asyncio
+import codecs
+import logging
+import queue
+import random
+import threading
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import requests
+from django.conf import settings
+
+from apps.multiparser.ratelimit import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Chunks buffered between the download and the Tika upload; a slow Tika server
+# slows the download down instead of growing memory
+QUEUE_SIZE = 64
+TIKA_HEADERS = {'Accept': 'text/plain; charset=UTF-8'}
+
+
+# Counting semaphore per Tika server. KEYS[1] is a sorted set of slot tokens
+# scored by their expiry time, so slots held by crashed workers free themselves.
+ACQUIRE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+return 1
+"""
+ROUND_ROBIN_KEY = 'tika:next'
+# A slot outlives its extraction timeout by this much before it is reclaimed
+SLOT_GRACE = 60
+
+
+# Share of the character budget kept from the start of a document; the rest
+# holds a sample of the pieces (pages, chunks) that follow
+HEAD_SHARE = 0.75
+SAMPLE_PIECES = 32
+# Raw text without any whitespace is cut after this many characters
+MAX_WORD = 64 * 1024
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class BoundedText:
+    """Extracted text, normalised and cut to the budget; `seen` counts the characters before the cut"""
+    text: str
+    seen: int
+
+    @property
+    def truncated(self):
+        return self.seen > len(self.text)
+
+
+class TextBudget:
+    """
+    Normalises whitespace of extracted text piece by piece and keeps at most
+    `max_chars` of it
+
+    While the text fits, everything is kept. Past the budget, the leading
+    HEAD_SHARE of it stays and the rest of the budget is filled with an
+    evenly drawn (reservoir) sample of the later pieces, kept in document
+    order. Memory stays bounded by the budget however large the document is.
+    """
+
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars or settings.EXTRACTED_TEXT_MAX_CHARS
+        self.head_chars = int(self.max_chars * HEAD_SHARE)
+        self.piece_chars = max(1, (self.max_chars - self.head_chars) // SAMPLE_PIECES)
+        self.seen = 0
+        self._pieces = []
+        self._length = 0
+        self._sample = None
+        self._count = 0
+        self._carry = ''
+        # Seeded so that re-extracting a document keeps the same sample
+        self._random = random.Random(0)
+
+    def add(self, piece):
+        """Add a piece that ends at a word boundary (a page, paragraph or slide)"""
+        self._add(' '.join(piece.split()))
+
+    def feed(self, chunk):
+        """Add a chunk of a text stream, which may end in the middle of a word"""
+        data = self._carry + chunk
+        words = data.split()
+        self._carry = words.pop() if words and not data[-1].isspace() else ''
+        if len(self._carry) > MAX_WORD:
+            words.append(self._carry)
+            self._carry = ''
+        self._add(' '.join(words))
+
+    def _add(self, piece):
+        if not piece:
+            return
+        self.seen += len(piece) + (1 if self.seen else 0)
+        if self._sample is None:
+            self._pieces.append(piece)
+            self._length += len(piece) + 1
+            if self._length > self.max_chars:
+                self._start_sampling()
+            return
+        self._offer(piece)
+
+    def _start_sampling(self):
+        # Keep the head, the pieces after it become the first sample candidates
+        pieces, self._pieces, self._length, self._sample = self._pieces, [], 0, []
+        for piece in pieces:
+            if self._length < self.head_chars:
+                piece = piece[:self.head_chars - self._length]
+                self._pieces.append(piece)
+                self._length += len(piece) + 1
+            else:
+                self._offer(piece)
+
+    def _offer(self, piece):
+        self._count += 1
+        entry = (self._count, piece[:self.piece_chars])
+        if len(self._sample) < SAMPLE_PIECES:
+            self._sample.append(entry)
+            return
+        slot = self._random.randrange(self._count)
+        if slot < SAMPLE_PIECES:
+            self._sample[slot] = entry
+
+    def result(self):
+        if self._carry:
+            self._add(self._carry)
+            self._carry = ''
+        pieces = self._pieces + [piece for _, piece in sorted(self._sample or [])]
+        # The separators and the sampled pieces may overshoot the budget by a little
+        return BoundedText(' '.join(pieces)[:self.max_chars], self.seen)
+
+
+def read_text(chunks, max_chars=None):
+    """`BoundedText` of a UTF-8 byte stream"""
+    budget = TextBudget(max_chars)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in chunks:
+        budget.feed(decoder.decode(chunk))
+    budget.feed(decoder.decode(b'', final=True))
+    return budget.result()
+
+
+async def aread_text(chunks, max_chars=None):
+    """`read_text` for an async byte stream"""
+    budget = TextBudget(max_chars)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    async for chunk in chunks:
+        budget.feed(decoder.decode(chunk))
+    budget.feed(decoder.decode(b'', final=True))
+    return budget.result()
+
+
+def tika_url(endpoint=None):
+    return f"{(endpoint or settings.TIKA_SERVER_ENDPOINT).rstrip('/')}/tika"
+
+
+def extraction_timeout(page_count=None, size=None):
+    """Seconds allowed for extracting a document of `page_count` pages and `size` bytes"""
+    timeout = settings.TIKA_TIMEOUT
+    timeout += (page_count or 0) * settings.TIKA_TIMEOUT_PER_PAGE
+    timeout += (size or 0) / (1024 * 1024) * settings.TIKA_TIMEOUT_PER_MB
+    return min(timeout, settings.TIKA_TIMEOUT_MAX)
+
+
+class TikaPool:
+    """
+    The configured Tika servers, each running at most `max_in_flight`
+    extractions at a time across all workers (tracked in Redis).
+
+    `acquire()` never blocks: it takes a slot on the next server in round-robin
+    order that has one free and returns None when all are busy, so callers can
+    skip streaming extraction or re-queue their task instead of piling more
+    work onto a saturated server.
+    """
+
+    def __init__(self, endpoints=None, max_in_flight=None):
+        self.endpoints = list(endpoints or settings.TIKA_SERVER_ENDPOINTS)
+        self.max_in_flight = max_in_flight or settings.TIKA_MAX_IN_FLIGHT
+        self.redis = get_redis()
+        self._acquire = self.redis.register_script(ACQUIRE_SCRIPT)
+
+    def acquire(self, timeout):
+        """Take a slot for up to `timeout` seconds; returns (endpoint, token) or None"""
+        start = self.redis.incr(ROUND_ROBIN_KEY)
+        token = uuid.uuid4().hex
+        for i in range(len(self.endpoints)):
+            endpoint = self.endpoints[(start + i) % len(self.endpoints)]
+            if self._acquire(keys=[f"tika:slots:{endpoint}"], args=[self.max_in_flight, timeout + SLOT_GRACE, token]):
+                return endpoint, token
+        return None
+
+    def release(self, endpoint, token):
+        self.redis.zrem(f"tika:slots:{endpoint}", token)
+
+    @contextmanager
+    def slot(self, timeout):
+        """Hold a slot while the block runs; yields the endpoint, or None when all servers are busy"""
+        acquired = self.acquire(timeout)
+        try:
+            yield acquired[0] if acquired else None
+        finally:
+            if acquired:
+                self.release(*acquired)
+
+
+def extract_file(path, endpoint=None, timeout=None):
+    """Extract the text of the file at `path` with a single Tika request, returns a `BoundedText`"""
+    with open(path, 'rb') as f, \
+            requests.put(tika_url(endpoint), data=f, headers=TIKA_HEADERS, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        return read_text(response.iter_content(RESPONSE_CHUNK_SIZE))
+
+
+class TikaStream:
+    """Streams chunks to Tika from a background thread; `finish()` returns a `BoundedText` or None"""
+
+    def __init__(self, endpoint=None, timeout=300):
+        self.url = tika_url(endpoint)
+        self.timeout = timeout
+        self.text = None
+        self.error = None
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _body(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def _run(self):
+        try:
+            with requests.put(self.url, data=self._body(), headers=TIKA_HEADERS, timeout=self.timeout,
+                              stream=True) as response:
+                response.raise_for_status()
+                self.text = read_text(response.iter_content(RESPONSE_CHUNK_SIZE))
+        except Exception as e:
+            self.error = e
+
+    def feed(self, chunk):
+        # Once the upload has failed nobody reads the queue any more; stop feeding
+        while self._thread.is_alive():
+            try:
+                self._queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self):
+        self.feed(None)
+        self._thread.join(self.timeout)
+        if self.error is not None:
+            logger.warning(f"Streaming extraction via {self.url} failed: {self.error}")
+            return None
+        return self.text
+
+    def abort(self):
+        self.error = self.error or RuntimeError("aborted")
+        self.feed(None)
+
+
+class AsyncTikaStream:
+    """`TikaStream` for the asyncio downloader, uploading through `client`"""
+
+    def __init__(self, client, endpoint=None, timeout=300):
+        self.url = tika_url(endpoint)
+        self.timeout = timeout
+        self.text = None
+        self.error = None
+        self._queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run(client))
+
+    async def _body(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    async def _run(self, client):
+        try:
+            async with client.stream('PUT', self.url, content=self._body(), headers=TIKA_HEADERS,
+                                     timeout=self.timeout) as response:
+                response.raise_for_status()
+                self.text = await aread_text(response.aiter_bytes(RESPONSE_CHUNK_SIZE))
+        except Exception as e:
+            self.error = e
+
+    async def feed(self, chunk):
+        while not self._task.done():
+            try:
+                await asyncio.wait_for(self._queue.put(chunk), 1)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    async def finish(self):
+        await self.feed(None)
+        try:
+            await asyncio.wait_for(self._task, self.timeout)
+        except asyncio.TimeoutError:
+            self.error = self.error or TimeoutError(f"no response within {self.timeout}s")
+        if self.error is not None:
+            logger.warning(f"Streaming extraction via {self.url} failed: {self.error}")
+            return None
+        return self.text
+
+    def abort(self):
+        self.error = self.error or RuntimeError("aborted")
+        self._task.cancel()
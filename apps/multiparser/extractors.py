@@ -0,0 +1,193 @@
+"""
+In-process text extraction for common formats, with Tika as the fallback
+
+Extractors are registered per MIME type and yield the text in pieces (pages,
+paragraphs or slides) that are fed into a `TextBudget` one at a time, so a
+2000-page PDF is never held as one string. They run in a process pool so that
+parsing a large PDF does not hold the GIL of the Celery worker; formats without
+an extractor, and files an extractor fails on, go to Tika (see
+`extraction.TikaPool`).
+"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+import magic
+from django.conf import settings
+
+from apps.multiparser.extraction import MAX_WORD, TextBudget
+
+# Optional parsers; a format whose parser is not installed is extracted by Tika
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+try:
+    import docx
+except ImportError:
+    docx = None
+
+try:
+    import pptx
+except ImportError:
+    pptx = None
+
+logger = logging.getLogger(__name__)
+
+PDF = 'application/pdf'
+DOCX = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+PPTX = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+
+# Document.file_type (the extension as listed on soff.uz) to MIME type
+EXTENSION_TYPES = {
+    '.pdf': PDF,
+    '.docx': DOCX,
+    '.pptx': PPTX,
+    '.txt': 'text/plain',
+    '.csv': 'text/csv',
+    '.md': 'text/markdown',
+}
+# What libmagic reports for containers it cannot tell apart (DOCX and PPTX are zip files)
+GENERIC_TYPES = {'application/octet-stream', 'application/zip', 'application/x-zip-compressed'}
+
+TEXT_CHUNK_SIZE = 1024 * 1024
+
+# MIME type -> function(path) yielding text pieces that end at a word boundary
+NATIVE_EXTRACTORS = {}
+
+
+def register(*mime_types):
+    """Register the decorated function as the native extractor for `mime_types`"""
+    def decorator(func):
+        for mime_type in mime_types:
+            NATIVE_EXTRACTORS[mime_type] = func
+        return func
+    return decorator
+
+
+@register('text/plain', 'text/csv', 'text/markdown')
+def extract_plain_text(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for chunk in iter(lambda: f.read(TEXT_CHUNK_SIZE), ''):
+            # Complete the last line so that no word is split between pieces; a line
+            # longer than MAX_WORD is cut there, as one without whitespace would be
+            yield chunk + f.readline(MAX_WORD)
+
+
+if pypdf:
+    @register(PDF)
+    def extract_pdf(path):
+        for page in pypdf.PdfReader(path).pages:
+            yield page.extract_text() or ''
+
+
+if docx:
+    @register(DOCX)
+    def extract_docx(path):
+        document = docx.Document(path)
+        for paragraph in document.paragraphs:
+            yield paragraph.text
+        for table in document.tables:
+            for row in table.rows:
+                yield ' '.join(cell.text for cell in row.cells)
+
+
+if pptx:
+    @register(PPTX)
+    def extract_pptx(path):
+        for slide in pptx.Presentation(path).slides:
+            for shape in slide.shapes:
+                if shape.has_text_frame:
+                    yield shape.text_frame.text
+
+
+def type_for_extension(file_type):
+    """MIME type for a file extension like '.pdf' (or 'pdf'), None when unknown"""
+    return EXTENSION_TYPES.get('.' + (file_type or '').lower().lstrip('.'))
+
+
+def detect_type(path, file_type=None):
+    """MIME type of the file at `path`, sniffed by libmagic and refined by its extension"""
+    try:
+        mime_type = magic.from_file(str(path), mime=True)
+    except Exception as e:
+        logger.warning(f"Cannot detect the type of {path}: {e}")
+        mime_type = None
+    if not mime_type or mime_type in GENERIC_TYPES:
+        mime_type = type_for_extension(file_type) or mime_type
+    return mime_type
+
+
+def has_native_extractor(mime_type):
+    return mime_type in NATIVE_EXTRACTORS
+
+
+def has_text(mime_type):
+    """Whether files of `mime_type` may hold text: formats with a native extractor, and other documents for Tika"""
+    if has_native_extractor(mime_type):
+        return True
+    if not mime_type or mime_type in GENERIC_TYPES:
+        return False
+    return not mime_type.startswith(('image/', 'audio/', 'video/'))
+
+
+def extracts_natively(extension):
+    """Whether files with `extension` are extracted in-process rather than by Tika"""
+    return settings.NATIVE_EXTRACTION and has_native_extractor(type_for_extension(extension))
+
+
+def _extract(mime_type, path, max_chars):
+    # Runs in a pool process, so only the bounded text crosses the process boundary
+    budget = TextBudget(max_chars)
+    for piece in NATIVE_EXTRACTORS[mime_type](path):
+        budget.add(piece)
+    return budget.result()
+
+
+@lru_cache(maxsize=None)
+def _executor():
+    processes = settings.NATIVE_EXTRACTION_PROCESSES
+    # Daemonic processes (Celery prefork children) cannot start a pool of their own
+    if processes < 1 or multiprocessing.current_process().daemon:
+        return None
+    return ProcessPoolExecutor(max_workers=processes)
+
+
+def extract_native(path, mime_type, timeout=None, max_chars=None):
+    """
+    Extract the text of `path` with the extractor registered for `mime_type`
+
+    Returns a `BoundedText` of at most `max_chars` (EXTRACTED_TEXT_MAX_CHARS).
+    Uses the process pool when this process can have one, and runs inline
+    otherwise. Raises whatever the extractor raises, or TimeoutError.
+    """
+    max_chars = max_chars or settings.EXTRACTED_TEXT_MAX_CHARS
+    executor = _executor()
+    if executor is None:
+        return _extract(mime_type, str(path), max_chars)
+    try:
+        return executor.submit(_extract, mime_type, str(path), max_chars).result(timeout)
+    except TimeoutError:
+        # The extractor keeps running in its process until that is killed
+        _discard(executor)
+        raise
+    except BrokenProcessPool:
+        # A pool process died (e.g. on a malformed file); start a fresh pool next time
+        _executor.cache_clear()
+        raise
+
+
+def _discard(executor):
+    """
+    Kill the processes of `executor` and start a fresh pool next time
+
+    Extractions running in the pool for other tasks fail with
+    BrokenProcessPool and go to Tika.
+    """
+    _executor.cache_clear()
+    for process in list((executor._processes or {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,104 @@
+"""
+On-disk cache of listing responses used for conditional requests and offline replay
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+
+@dataclass
+class CachedResponse:
+    """A stored response body with its validators"""
+    url: str
+    body: bytes
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fetched_at: Optional[str] = None
+
+    def conditional_headers(self):
+        """Headers that turn the next request for this URL into a conditional one"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Response cache keyed by URL.
+
+    Every entry is a small JSON metadata file (URL, ETag, Last-Modified, fetch
+    time) next to the gzip-compressed body, sharded by the first two hex digits
+    of the URL hash. Writes go through a temporary file and ``os.replace`` so a
+    crash never leaves a half-written entry behind.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        shard = self.directory / key[:2]
+        return shard / f"{key}.json", shard / f"{key}.gz"
+
+    def get(self, url):
+        """Return the `CachedResponse` for `url`, or None when it is not cached"""
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with gzip.open(body_path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError, EOFError):
+            return None
+
+        return CachedResponse(
+            url=url,
+            body=body,
+            etag=meta.get('etag'),
+            last_modified=meta.get('last_modified'),
+            fetched_at=meta.get('fetched_at'),
+        )
+
+    def store(self, url, body, etag=None, last_modified=None, fetched_at=None):
+        """Store a response body together with its validators"""
+        meta_path, body_path = self._paths(url)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._write_atomic(body_path, gzip.compress(body, compresslevel=6))
+        meta = {'url': url, 'etag': etag, 'last_modified': last_modified, 'fetched_at': fetched_at}
+        self._write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def delete(self, url):
+        """Drop the entry for `url` so the next request is unconditional"""
+        for path in self._paths(url):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Remove every cached entry"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
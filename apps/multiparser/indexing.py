@@ -0,0 +1,236 @@
+"""
+Bulk loading of documents into Elasticsearch
+"""
+import logging
+import re
+import time
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+
+from django.conf import settings
+from elasticsearch.helpers import parallel_bulk, scan, streaming_bulk
+
+from apps.bot.documents import DocumentDocument
+from apps.multiparser.models import Document
+from apps.multiparser.pipeline import transition
+from apps.multiparser.ratelimit import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Ids of documents waiting to be indexed by `flush_index_buffer`
+INDEX_BUFFER_KEY = 'index:pending'
+
+# The bot searches the `documents` alias; the data lives in versioned indices behind it
+VERSION_PATTERN = r'^{alias}_v(\d+)$'
+
+
+@contextmanager
+def refresh_disabled(client, index):
+    """Turn periodic refresh off while bulk loading `index`, restore it and refresh once afterwards"""
+    response = client.indices.get_settings(index=index, name='index.refresh_interval')
+    previous = next(iter(response.values()), {}).get('settings', {}).get('index', {}).get('refresh_interval')
+    client.indices.put_settings(index=index, settings={'index': {'refresh_interval': '-1'}})
+    try:
+        yield
+    finally:
+        # None resets the setting to the cluster default
+        client.indices.put_settings(index=index, settings={'index': {'refresh_interval': previous}})
+        client.indices.refresh(index=index)
+
+
+def bulk_index(objects, index=None, chunk_size=None, max_chunk_bytes=None, thread_count=None, disable_refresh=False):
+    """
+    Index `objects` (Document instances or a queryset) through the bulk API
+
+    Requests are cut at `chunk_size` documents or `max_chunk_bytes`, whichever
+    comes first; with `thread_count` > 1 they are sent by ``parallel_bulk``
+    (see `parallel_bulk_prepared`).
+    `index` overrides the target index (e.g. a new versioned index), and
+    `disable_refresh` turns refresh off for the duration of a large load.
+    Returns a JSON-serialisable summary.
+    """
+    chunk_size = chunk_size or settings.ES_BULK_CHUNK_SIZE
+    max_chunk_bytes = max_chunk_bytes or settings.ES_BULK_MAX_BYTES
+    thread_count = thread_count or settings.ES_BULK_THREADS
+
+    document = DocumentDocument()
+    client = document._get_connection()
+    index = index or document._index._name
+
+    def actions():
+        for action in document._get_actions(objects, 'index'):
+            action['_index'] = index
+            yield action
+
+    if thread_count > 1:
+        results = parallel_bulk_prepared(client, actions(), thread_count, chunk_size, max_chunk_bytes)
+    else:
+        results = streaming_bulk(client, actions(), chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                 raise_on_error=False, max_retries=3)
+
+    started = time.monotonic()
+    indexed = 0
+    failed_ids = []
+    with refresh_disabled(client, index) if disable_refresh else nullcontext():
+        for ok, item in results:
+            if ok:
+                indexed += 1
+            else:
+                failed_ids.append(next(iter(item.values()), {}).get('_id'))
+                logger.error(f"Failed to index document into {index}: {item}")
+
+    elapsed = time.monotonic() - started
+    return {
+        'index': index,
+        'indexed': indexed,
+        'failed': len(failed_ids),
+        'failed_ids': failed_ids,
+        'elapsed': round(elapsed, 2),
+        'docs_per_second': round(indexed / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+def parallel_bulk_prepared(client, actions, thread_count, chunk_size, max_chunk_bytes):
+    """
+    ``parallel_bulk`` of `actions`, with the actions generated in the calling thread
+
+    ``parallel_bulk`` lets its pool threads pull from the generator, which would
+    run the ORM queries and serialisation there, each thread on a database
+    connection of its own that is never closed. The actions are taken
+    `thread_count` requests at a time instead, and only the prepared lists
+    are handed to the pool.
+    """
+    actions = iter(actions)
+    while window := list(islice(actions, chunk_size * thread_count)):
+        yield from parallel_bulk(client, window, thread_count=thread_count, chunk_size=chunk_size,
+                                 max_chunk_bytes=max_chunk_bytes, raise_on_error=False)
+
+
+def delete_missing(index, batch_size=None):
+    """
+    Delete the entries of `index` whose document no longer exists, returns how many
+
+    Ids are read back from the index a batch at a time and checked against the
+    database, so deletions the rebuild missed are found without a change log.
+    """
+    batch_size = batch_size or settings.ES_BULK_CHUNK_SIZE
+    client = DocumentDocument()._get_connection()
+    hits = scan(client, index=index, query={'query': {'match_all': {}}}, _source=False, size=batch_size)
+
+    deleted = 0
+    while ids := [hit['_id'] for hit in islice(hits, batch_size)]:
+        existing = {str(document_id) for document_id in Document.objects.filter(id__in=ids).values_list('id', flat=True)}
+        actions = [{'_op_type': 'delete', '_index': index, '_id': document_id}
+                   for document_id in ids if document_id not in existing]
+        for ok, item in streaming_bulk(client, actions, raise_on_error=False, max_retries=3):
+            if ok:
+                deleted += 1
+            elif next(iter(item.values()), {}).get('status') != 404:
+                logger.error(f"Failed to delete document from {index}: {item}")
+    return deleted
+
+
+def buffer_for_indexing(document_ids):
+    """Queue documents for the next `flush_index_buffer` run"""
+    if document_ids:
+        get_redis().sadd(INDEX_BUFFER_KEY, *[str(document_id) for document_id in document_ids])
+
+
+def drain_index_buffer(batch_size=None):
+    """Yield batches of buffered document ids until the buffer is empty"""
+    batch_size = batch_size or settings.ES_BULK_CHUNK_SIZE
+    redis = get_redis()
+    while True:
+        ids = redis.spop(INDEX_BUFFER_KEY, batch_size)
+        if not ids:
+            return
+        yield [document_id.decode() for document_id in ids]
+
+
+def index_buffered(batch_size=None, on_indexed=None):
+    """
+    Bulk index every buffered document and move it to the indexed stage, returns the merged summary
+
+    `on_indexed` is called with the ids of each indexed batch before they move on.
+    """
+    totals = {'indexed': 0, 'failed': 0, 'elapsed': 0.0}
+    for ids in drain_index_buffer(batch_size):
+        try:
+            summary = bulk_index(DocumentDocument().get_queryset().filter(id__in=ids))
+        except Exception:
+            # Keep them for the next run
+            buffer_for_indexing(ids)
+            raise
+        indexed = set(ids) - set(summary['failed_ids'])
+        if on_indexed is not None:
+            on_indexed(indexed)
+        transition(Document.objects.filter(id__in=indexed), Document.Stage.INDEXED)
+        for key in totals:
+            totals[key] += summary[key]
+    totals['elapsed'] = round(totals['elapsed'], 2)
+    return totals
+
+
+def index_versions(client, alias):
+    """Existing versioned indices of `alias` as a sorted list of (version, name)"""
+    pattern = re.compile(VERSION_PATTERN.format(alias=re.escape(alias)))
+    names = client.indices.get(index=f"{alias}_v*", expand_wildcards='all', ignore_unavailable=True, allow_no_indices=True)
+    versions = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            versions.append((int(match.group(1)), name))
+    return sorted(versions)
+
+
+def create_versioned_index(client, alias, shards=None, replicas=None, analyzer=None):
+    """
+    Create the next ``<alias>_vN`` index from the DocumentDocument mapping
+
+    `shards`, `replicas` and the `analyzer` of the content field override the
+    document's defaults. The index starts without replicas, `promote_index`
+    adds them once the data is loaded. Returns (name, target replica count).
+    """
+    versions = index_versions(client, alias)
+    name = f"{alias}_v{versions[-1][0] + 1 if versions else 1}"
+
+    body = DocumentDocument._index.to_dict()
+    index_settings = dict(body.get('settings', {}))
+    if shards:
+        index_settings['number_of_shards'] = shards
+    target_replicas = replicas if replicas is not None else index_settings.get('number_of_replicas', 0)
+    index_settings['number_of_replicas'] = 0
+
+    mappings = body.get('mappings', {})
+    if analyzer:
+        mappings.setdefault('properties', {}).setdefault('content', {'type': 'text'})['analyzer'] = analyzer
+
+    client.indices.create(index=name, settings=index_settings, mappings=mappings)
+    return name, target_replicas
+
+
+def promote_index(client, alias, name, replicas=0, keep=1):
+    """
+    Point `alias` at `name` in one atomic update and drop old versions beyond `keep`
+
+    A concrete index still named like the alias (the pre-alias layout) is
+    removed in the same update, so searches never see a missing index.
+    Returns the names of deleted indices.
+    """
+    client.indices.put_settings(index=name, settings={'index': {'number_of_replicas': replicas}})
+    client.cluster.health(index=name, wait_for_status='yellow', timeout='10m')
+
+    actions = [{'add': {'index': name, 'alias': alias, 'is_write_index': True}}]
+    if client.indices.exists_alias(name=alias):
+        for current in client.indices.get_alias(name=alias):
+            if current != name:
+                actions.insert(0, {'remove': {'index': current, 'alias': alias}})
+    elif client.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    client.indices.update_aliases(actions=actions)
+
+    old = [index for _, index in index_versions(client, alias) if index != name]
+    deleted = old[:max(0, len(old) - keep)]
+    for index in deleted:
+        client.indices.delete(index=index)
+    return deleted
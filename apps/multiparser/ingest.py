@@ -0,0 +1,347 @@
+"""
+Batched persistence of parsed listing items
+"""
+import hashlib
+import json
+import logging
+import re
+import uuid
+from dataclasses import astuple, dataclass, field
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+from django.db import DataError, IntegrityError, transaction
+
+from apps.multiparser.models import Seller, Document, Product, CrawlPage
+
+
+FILE_ID_PATTERN = re.compile(r'([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+FILE_EXTENSION_PATTERN = re.compile(r'\.(pdf|docx|doc|pptx|ppt|xlsx|xls|txt|rtf|odt|ods|odp)(?:_page|$)', re.IGNORECASE)
+DOCUMENT_URL_PREFIX = "https://d2co7bxjtnp5o.cloudfront.net/media/documents/"
+# Product.price / discount_price are DecimalField(max_digits=10, decimal_places=2)
+MAX_PRICE = Decimal(10) ** 8
+TEXT_MAX_LENGTH = 500
+
+logger = logging.getLogger(__name__)
+
+
+# Poster URLs are mostly seen once per crawl; a small cache only absorbs products that
+# show up again on a neighbouring page, without growing in long-lived workers
+@lru_cache(maxsize=4096)
+def extract_file_url(poster_url):
+    """
+    Extract the actual file URL from poster_url
+    Example:
+    Input: "https://d2co7bxjtnp5o.cloudfront.net/media/Images/14cddf99-da72-4844-a1ba-2dfdea3000f0.pdf_page-1_generate.webp"
+    Output: "https://d2co7bxjtnp5o.cloudfront.net/media/documents/14cddf99-da72-4844-a1ba-2dfdea3000f0.pdf"
+    """
+    if not poster_url:
+        return None
+
+    # Extract file ID (UUID-like string before "_page") and the document extension
+    match = FILE_ID_PATTERN.search(poster_url)
+    if match:
+        file_ext_match = FILE_EXTENSION_PATTERN.search(poster_url)
+        if file_ext_match:
+            return f"{DOCUMENT_URL_PREFIX}{match.group(1)}.{file_ext_match.group(1).lower()}"
+
+    return None
+
+
+def extract_file_urls(poster_urls):
+    """Batch variant of `extract_file_url`, returns a {poster_url: file_url} mapping"""
+    return {poster_url: extract_file_url(poster_url) for poster_url in set(poster_urls)}
+
+
+def page_content_hash(items):
+    """Stable SHA-256 over the decoded items of a listing page"""
+    payload = json.dumps([astuple(item) for item in items], separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def clean_price(value):
+    """`value` as a Decimal that fits the price columns, None when it is missing or invalid"""
+    if value is None or value == '':
+        return None
+    try:
+        price = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    if not price.is_finite() or abs(price) >= MAX_PRICE:
+        return None
+    return price
+
+
+def clean_item(item):
+    """
+    Normalise a `ProductItem` in place before it is queued; returns False when it cannot be stored
+
+    Invalid prices would abort the whole batch in the database, so a missing or
+    malformed discount price is dropped and an item without a valid price or
+    slug is skipped.
+    """
+    item.price = clean_price(item.price)
+    item.discount_price = clean_price(item.discount_price)
+    item.slug = (item.slug or '').strip()[:TEXT_MAX_LENGTH]
+    item.title = (item.title or '')[:TEXT_MAX_LENGTH]
+    return item.price is not None and bool(item.slug)
+
+
+def product_fingerprint(item):
+    """SHA-256 over the fields of a `ProductItem` that end up in Product/Document rows"""
+    values = [
+        item.title,
+        item.slug,
+        str(clean_price(item.price)),
+        str(clean_price(item.discount_price)),
+        item.discount,
+        item.views_count,
+        item.poster_url,
+        item.content_type,
+        item.demo_link,
+        item.file_url,
+        item.seller_id,
+        item.seller_fullname,
+        item.page_count,
+        item.file_size,
+        item.file_type,
+        item.document_content_type,
+    ]
+    payload = json.dumps(values, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def is_page_unchanged(page, results):
+    """
+    True when the page is stored as it is now, or every product of it is with the same fingerprint
+
+    The content hash of the last stored version of the page is checked first,
+    which settles most unchanged pages with one primary key lookup.
+    """
+    stored_hash = CrawlPage.objects.filter(page=page).values_list('content_hash', flat=True).first()
+    if stored_hash is not None and stored_hash == page_content_hash(results):
+        return True
+
+    fingerprints = {item.id: product_fingerprint(item) for item in results if item.id}
+    if not fingerprints:
+        return False
+    stored = dict(
+        Product.objects.filter(id__in=list(fingerprints)).values_list('id', 'fingerprint')
+    )
+    return stored == fingerprints
+
+
+@dataclass
+class WriteResult:
+    """Counters returned by `BatchWriter.flush`"""
+    products_created: int = 0
+    products_updated: int = 0
+    products_unchanged: int = 0
+    products_failed: int = 0
+    sellers_created: int = 0
+    # Pages with at least one product that could not be stored
+    failed_pages: list = field(default_factory=list)
+
+    @property
+    def products(self):
+        return self.products_created + self.products_updated + self.products_unchanged
+
+    def merge(self, other):
+        """Add the counters of another result to this one"""
+        self.products_created += other.products_created
+        self.products_updated += other.products_updated
+        self.products_unchanged += other.products_unchanged
+        self.products_failed += other.products_failed
+        self.sellers_created += other.sellers_created
+        self.failed_pages.extend(other.failed_pages)
+
+
+class BatchWriter:
+    """
+    Collect parsed items from one or more pages and persist them with bulk upserts.
+
+    Each flush costs a fixed handful of queries (two lookups plus one upsert per
+    table) inside a single transaction, instead of several round-trips per item.
+    Products whose fingerprint matches the stored one are skipped entirely, so
+    re-crawls only touch rows that actually changed. The content hash of every
+    flushed page is stored alongside.
+
+    When the database rejects the batch (a conflicting slug, a value that does
+    not fit its column), it is written again page by page and then item by
+    item, so only the offending products are lost; they are reported in
+    `WriteResult.products_failed` and their pages in `failed_pages`.
+    """
+
+    SELLER_UPDATE_FIELDS = ['fullname', 'updated_at']
+    DOCUMENT_UPDATE_FIELDS = ['page_count', 'file_size', 'file_type', 'content_type', 'file_url', 'updated_at']
+    PRODUCT_UPDATE_FIELDS = [
+        'title', 'slug', 'seller', 'price', 'discount_price', 'discount', 'poster_url',
+        'views_count', 'content_type', 'demo_link', 'file_url', 'fingerprint', 'updated_at',
+    ]
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.items = {}
+        self.item_pages = {}
+        self.pages = []
+        self.page_hashes = {}
+
+    def add(self, page, results):
+        """Queue the valid `ProductItem` records of a page, returns how many were queued"""
+        content_hash = page_content_hash(results)
+        queued = 0
+        for item in results:
+            if not item.id or not item.seller_id or not item.has_document:
+                continue
+            if not clean_item(item):
+                logger.warning(f"Page {page}: skipping product {item.id} without a valid price or slug")
+                continue
+            # The same product can show up on two pages when the listing shifts mid-crawl
+            self.items[item.id] = item
+            self.item_pages[item.id] = page
+            queued += 1
+        self.pages.append(page)
+        self.page_hashes[page] = CrawlPage(
+            page=page,
+            content_hash=content_hash,
+            product_count=queued,
+        )
+        return queued
+
+    def flush(self):
+        """Write all queued items, in one transaction unless the database rejects some of them"""
+        items, self.items = self.items, {}
+        item_pages, self.item_pages = self.item_pages, {}
+        page_hashes, self.page_hashes = self.page_hashes, {}
+        self.pages = []
+        if not items and not page_hashes:
+            return WriteResult()
+
+        try:
+            return self._write(items, page_hashes.values())
+        except (IntegrityError, DataError) as e:
+            logger.warning(f"Batch of {len(page_hashes)} pages rejected ({e}), writing it page by page")
+
+        result = WriteResult()
+        for page, page_hash in page_hashes.items():
+            page_items = {
+                product_id: item for product_id, item in items.items() if item_pages[product_id] == page
+            }
+            try:
+                result.merge(self._write(page_items, [page_hash]))
+                continue
+            except (IntegrityError, DataError) as e:
+                logger.warning(f"Page {page} rejected ({e}), writing it item by item")
+
+            for product_id, item in page_items.items():
+                try:
+                    result.merge(self._write({product_id: item}, []))
+                except (IntegrityError, DataError) as e:
+                    logger.error(f"Page {page}: product {product_id} could not be stored: {e}")
+                    result.products_failed += 1
+                    if page not in result.failed_pages:
+                        result.failed_pages.append(page)
+            # A page with lost products must not look stored
+            if page not in result.failed_pages:
+                self._write({}, [page_hash])
+        return result
+
+    def _write(self, items, page_hashes):
+        """Upsert `items` and the `page_hashes` (CrawlPage rows) in one transaction"""
+        result = WriteResult()
+        with transaction.atomic():
+            existing_products = {
+                product_id: (document_id, fingerprint)
+                for product_id, document_id, fingerprint in Product.objects.filter(
+                    id__in=list(items)
+                ).values_list('id', 'document_id', 'fingerprint')
+            }
+
+            changed = {}
+            for product_id, item in items.items():
+                fingerprint = product_fingerprint(item)
+                existing = existing_products.get(product_id)
+                if existing and existing[1] == fingerprint:
+                    result.products_unchanged += 1
+                    continue
+                changed[product_id] = (item, fingerprint)
+
+            sellers = {}
+            for item, _ in changed.values():
+                sellers[item.seller_id] = Seller(id=item.seller_id, fullname=item.seller_fullname)
+            existing_sellers = dict(
+                Seller.objects.filter(id__in=list(sellers)).values_list('id', 'fullname')
+            )
+            # Only new sellers and renamed ones need a write
+            sellers = {
+                seller_id: seller for seller_id, seller in sellers.items()
+                if existing_sellers.get(seller_id) != seller.fullname
+            }
+
+            documents = []
+            products = []
+            file_urls = extract_file_urls(item.poster_url for item, _ in changed.values())
+            for product_id, (item, fingerprint) in changed.items():
+                existing = existing_products.get(product_id)
+                # Keep the existing document row so download/Telegram state survives a re-crawl
+                document_id = existing[0] if existing else uuid.uuid4()
+                if existing:
+                    result.products_updated += 1
+                else:
+                    result.products_created += 1
+
+                documents.append(Document(
+                    id=document_id,
+                    page_count=item.page_count,
+                    file_size=item.file_size,
+                    file_type=item.file_type,
+                    content_type=item.document_content_type,
+                    file_url=file_urls[item.poster_url],
+                ))
+                products.append(Product(
+                    id=product_id,
+                    title=item.title,
+                    slug=item.slug,
+                    seller_id=item.seller_id,
+                    price=item.price,
+                    discount_price=item.discount_price,
+                    discount=item.discount,
+                    poster_url=item.poster_url,
+                    views_count=item.views_count,
+                    content_type=item.content_type,
+                    demo_link=item.demo_link,
+                    file_url=item.file_url,
+                    document_id=document_id,
+                    fingerprint=fingerprint,
+                ))
+
+            Seller.objects.bulk_create(
+                sellers.values(),
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=['id'],
+                update_fields=self.SELLER_UPDATE_FIELDS,
+            )
+            Document.objects.bulk_create(
+                documents,
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=['id'],
+                update_fields=self.DOCUMENT_UPDATE_FIELDS,
+            )
+            Product.objects.bulk_create(
+                products,
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=['id'],
+                update_fields=self.PRODUCT_UPDATE_FIELDS,
+            )
+            CrawlPage.objects.bulk_create(
+                page_hashes,
+                update_conflicts=True,
+                unique_fields=['page'],
+                update_fields=['content_hash', 'product_count', 'crawled_at'],
+            )
+
+        result.sellers_created = len(sellers.keys() - existing_sellers.keys())
+        return result
@@ -0,0 +1,99 @@
+"""
+Lean decoding of soff.uz listing pages into `ProductItem` records
+"""
+import io
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+# Optional fast decoders; the stdlib json module is used when neither is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+RESULTS_PREFIX = 'pageProps.productsData.results.item'
+
+
+@dataclass(slots=True)
+class ProductItem:
+    """The fields of one listing result that are persisted, nothing else"""
+    id: Optional[int]
+    title: str
+    slug: str
+    price: object
+    discount_price: object
+    discount: int
+    views_count: int
+    poster_url: str
+    content_type: str
+    demo_link: Optional[str]
+    file_url: Optional[str]
+    seller_id: Optional[str]
+    seller_fullname: str
+    has_document: bool
+    page_count: Optional[int]
+    file_size: str
+    file_type: str
+    document_content_type: str
+
+    @classmethod
+    def from_dict(cls, item):
+        seller = item.get("seller") or {}
+        document = item.get("document") or {}
+        seller_id = seller.get("id")
+        return cls(
+            id=item.get("id"),
+            title=item.get("title", ""),
+            slug=item.get("slug", ""),
+            price=item.get("price", 0),
+            discount_price=item.get("discount_price", 0),
+            discount=item.get("discount", 0),
+            views_count=item.get("views_count", 0),
+            poster_url=item.get("poster_url", ""),
+            content_type=item.get("content_type", "file"),
+            demo_link=item.get("demo_link"),
+            file_url=item.get("file_url"),
+            seller_id=str(seller_id) if seller_id else None,
+            seller_fullname=seller.get("fullname", "Unknown Seller"),
+            has_document=bool(document),
+            page_count=document.get("page_count", 1),
+            file_size=document.get("file_size", "0 MB"),
+            file_type=document.get("file_type", ""),
+            document_content_type=document.get("content_type", "file"),
+        )
+
+
+def _results(data):
+    # A page without products may carry null for any of the levels
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+    return ((data.get("pageProps") or {}).get("productsData") or {}).get("results") or []
+
+
+def decode_page(body, decoder=None):
+    """
+    Decode a raw listing page into a list of `ProductItem`
+
+    `decoder` forces one of 'orjson', 'ijson' or 'json'; by default the fastest
+    installed one is used. ijson streams the results array item by item, so the
+    rest of the Next.js payload is never materialised. Raises ValueError on
+    malformed input, whichever decoder is used.
+    """
+    decoder = decoder or ('orjson' if orjson else 'ijson' if ijson else 'json')
+
+    if decoder == 'orjson':
+        return [ProductItem.from_dict(item) for item in _results(orjson.loads(body))]
+
+    if decoder == 'ijson':
+        try:
+            return [ProductItem.from_dict(item) for item in ijson.items(io.BytesIO(body), RESULTS_PREFIX)]
+        except ijson.JSONError as e:
+            raise ValueError(str(e)) from e
+
+    return [ProductItem.from_dict(item) for item in _results(json.loads(body))]
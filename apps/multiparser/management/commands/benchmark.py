@@ -0,0 +1,291 @@
+import json
+import random
+import re
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from apps.multiparser import extractors
+from apps.multiparser import items as page_items
+from apps.multiparser.extraction import extract_file, extraction_timeout
+from apps.multiparser.ingest import extract_file_url, extract_file_urls
+
+
+def legacy_decode(body):
+    """The original parse path: full json decode followed by nested .get() chains per field"""
+    data = json.loads(body)
+    results = data.get("pageProps", {}).get("productsData", {}).get("results", [])
+    extracted = []
+    for item in results:
+        seller_data = item.get("seller", {})
+        document_data = item.get("document", {})
+        extracted.append({
+            'seller_id': seller_data.get("id"),
+            'seller_fullname': seller_data.get("fullname", "Unknown Seller"),
+            'page_count': document_data.get("page_count", 1),
+            'file_size': document_data.get("file_size", "0 MB"),
+            'file_type': document_data.get("file_type", ""),
+            'document_content_type': document_data.get("content_type", "file"),
+            'poster_url': item.get("poster_url", ""),
+            'id': item.get("id"),
+            'title': item.get("title", ""),
+            'slug': item.get("slug", ""),
+            'price': item.get("price", 0),
+            'discount_price': item.get("discount_price", 0),
+            'discount': item.get("discount", 0),
+            'views_count': item.get("views_count", 0),
+            'content_type': item.get("content_type", "file"),
+            'demo_link': item.get("demo_link"),
+            'file_url': item.get("file_url"),
+        })
+    return extracted
+
+
+def legacy_extract_file_url(poster_url):
+    """The original extract_file_url: two uncompiled regex searches per call, no caching"""
+    if not poster_url:
+        return None
+    match = re.search(r'([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})', poster_url)
+    if match:
+        file_id = match.group(1)
+        file_ext_match = re.search(r'\.(pdf|docx|doc|pptx|ppt|xlsx|xls|txt|rtf|odt|ods|odp)(?:_page|$)', poster_url, re.IGNORECASE)
+        if file_ext_match:
+            file_extension = file_ext_match.group(1).lower()
+            return f"https://d2co7bxjtnp5o.cloudfront.net/media/documents/{file_id}.{file_extension}"
+    return None
+
+
+def synthetic_poster_urls(count, repeat_ratio=0.3, seed=42):
+    """Poster URLs across the supported extensions, with a share of repeats as seen on re-crawls"""
+    rng = random.Random(seed)
+    extensions = ['pdf', 'docx', 'doc', 'pptx', 'ppt', 'xlsx', 'txt', 'PDF', 'webp']
+    urls = []
+    for _ in range(count):
+        if urls and rng.random() < repeat_ratio:
+            urls.append(rng.choice(urls))
+            continue
+        file_id = uuid.UUID(int=rng.getrandbits(128))
+        urls.append(
+            f"https://d2co7bxjtnp5o.cloudfront.net/media/Images/{file_id}.{rng.choice(extensions)}_page-1_generate.webp"
+        )
+    return urls
+
+
+def synthetic_page(products=20):
+    """A listing page shaped like the soff.uz Next.js payload, including the fields we never persist"""
+    results = []
+    for i in range(products):
+        file_id = f"14cddf99-da72-4844-a1ba-{i:012d}"
+        results.append({
+            "id": 300000 + i,
+            "title": f"Kurs ishi: Iqtisodiyot nazariyasi asoslari {i}",
+            "slug": f"kurs-ishi-iqtisodiyot-nazariyasi-asoslari-{i}",
+            "description": "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 20 + "</p>",
+            "price": 15000.0,
+            "discount_price": 12000.0,
+            "discount": 20,
+            "views_count": 1234 + i,
+            "poster_url": f"https://d2co7bxjtnp5o.cloudfront.net/media/Images/{file_id}.pdf_page-1_generate.webp",
+            "content_type": "file",
+            "demo_link": None,
+            "file_url": None,
+            "category": {"id": 12, "name": "Iqtisodiyot", "slug": "iqtisodiyot", "parent": {"id": 1, "name": "Fanlar"}},
+            "tags": [{"id": t, "name": f"tag-{t}"} for t in range(8)],
+            "seller": {
+                "id": 201745 + i % 7,
+                "fullname": "Exclusive qog'ozlar",
+                "avatar": "https://d2co7bxjtnp5o.cloudfront.net/media/avatars/seller.webp",
+                "rating": 4.8,
+            },
+            "document": {
+                "page_count": 25,
+                "file_size": "2.5 MB",
+                "file_type": ".pdf",
+                "content_type": "file",
+                "preview_pages": [f"https://d2co7bxjtnp5o.cloudfront.net/media/Images/{file_id}.pdf_page-{p}.webp" for p in range(1, 6)],
+            },
+        })
+    return json.dumps({
+        "pageProps": {
+            "productsData": {"count": 135220, "next": None, "previous": None, "results": results},
+            "categories": [{"id": c, "name": f"Category {c}", "children": []} for c in range(40)],
+            "_sentryTraceData": "0" * 512,
+        },
+        "__N_SSP": True,
+    }).encode('utf-8')
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmarks for the parser hot paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'target',
+            choices=['decode', 'file-urls', 'extract'],
+            help='Code path to benchmark'
+        )
+        parser.add_argument(
+            '--sample',
+            help='Path to a captured raw listing page (JSON body); a synthetic page is used otherwise'
+        )
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=100000,
+            help='Number of synthetic inputs for file-urls (default: 100000)'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            help='Number of iterations per variant (default: 2000 for decode, 5 for file-urls, 3 for extract)'
+        )
+        parser.add_argument(
+            '--sample-dir',
+            help='Directory of documents (PDF, DOCX, PPTX, ...) for extract'
+        )
+        parser.add_argument(
+            '--tika',
+            action='store_true',
+            help='Also time extraction by the Tika server (TIKA_SERVER_ENDPOINT) for extract'
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            help='Process pool size for the extract throughput run (default: NATIVE_EXTRACTION_PROCESSES)'
+        )
+
+    def handle(self, *args, **options):
+        getattr(self, f"bench_{options['target'].replace('-', '_')}")(options)
+
+    def run_variant(self, name, func, iterations):
+        """Time `func` over `iterations` calls and measure its peak allocation on a single call"""
+        func()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.stdout.write(
+            f"{name:<24} {elapsed / iterations * 1e6:>10.1f} us/op "
+            f"{iterations / elapsed:>12.0f} ops/s {peak / 1024:>10.1f} KiB peak"
+        )
+
+    def bench_decode(self, options):
+        if options['sample']:
+            try:
+                with open(options['sample'], 'rb') as f:
+                    body = f.read()
+            except OSError as e:
+                raise CommandError(f"Cannot read sample: {e}")
+            source = options['sample']
+        else:
+            body = synthetic_page()
+            source = 'synthetic page'
+
+        iterations = options['iterations'] or 2000
+        self.stdout.write(f"Decoding {source} ({len(body) / 1024:.1f} KiB), {iterations} iterations")
+
+        self.run_variant('legacy json + .get()', lambda: legacy_decode(body), iterations)
+        self.run_variant('decode_page[json]', lambda: page_items.decode_page(body, 'json'), iterations)
+        if page_items.orjson:
+            self.run_variant('decode_page[orjson]', lambda: page_items.decode_page(body, 'orjson'), iterations)
+        else:
+            self.stdout.write('decode_page[orjson]      skipped (orjson not installed)')
+        if page_items.ijson:
+            self.run_variant('decode_page[ijson]', lambda: page_items.decode_page(body, 'ijson'), iterations)
+        else:
+            self.stdout.write('decode_page[ijson]       skipped (ijson not installed)')
+
+    def bench_file_urls(self, options):
+        urls = synthetic_poster_urls(options['count'])
+        iterations = options['iterations'] or 5
+        self.stdout.write(f"Extracting {len(urls)} poster URLs ({len(set(urls))} unique), {iterations} iterations")
+
+        expected = [legacy_extract_file_url(url) for url in urls]
+        batch = extract_file_urls(urls)
+        if [batch[url] for url in urls] != expected:
+            raise CommandError("extract_file_urls results differ from the legacy implementation")
+
+        def cold_batch():
+            extract_file_url.cache_clear()
+            return extract_file_urls(urls)
+
+        self.run_variant('legacy per-url', lambda: [legacy_extract_file_url(url) for url in urls], iterations)
+        self.run_variant('compiled, no cache', lambda: [extract_file_url.__wrapped__(url) for url in urls], iterations)
+        self.run_variant('batch, cold cache', cold_batch, iterations)
+
+    def time_extraction(self, extract, paths, iterations):
+        """Seconds for `iterations` passes of `extract` over `paths`"""
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for path in paths:
+                extract(path)
+        return time.perf_counter() - started
+
+    def bench_extract(self, options):
+        root = Path(options['sample_dir'] or '')
+        if not options['sample_dir'] or not root.is_dir():
+            raise CommandError("extract needs --sample-dir, a directory of documents")
+        files = sorted(path for path in root.rglob('*') if path.is_file())
+        if not files:
+            raise CommandError(f"No files in {root}")
+        iterations = options['iterations'] or 3
+        max_chars = settings.EXTRACTED_TEXT_MAX_CHARS
+
+        by_type = {}
+        for path in files:
+            by_type.setdefault(extractors.detect_type(path, path.suffix), []).append(path)
+
+        self.stdout.write(f"Extracting {len(files)} files in {len(by_type)} formats, {iterations} iterations")
+        self.stdout.write(
+            f"{'format':<40} {'files':>5} {'MB':>8} {'native ms/file':>15} {'MB/s':>8} {'tika ms/file':>15} {'MB/s':>8}"
+        )
+        for mime_type, paths in sorted(by_type.items(), key=lambda item: str(item[0])):
+            megabytes = sum(path.stat().st_size for path in paths) / (1024 * 1024)
+            columns = []
+            for enabled, extract in (
+                (extractors.has_native_extractor(mime_type), lambda path: extractors._extract(mime_type, str(path), max_chars)),
+                (options['tika'], lambda path: extract_file(path, timeout=extraction_timeout(size=path.stat().st_size))),
+            ):
+                if not enabled:
+                    columns.append(f"{'-':>15} {'-':>8}")
+                    continue
+                try:
+                    elapsed = self.time_extraction(extract, paths, iterations)
+                except Exception as e:
+                    columns.append(f"{'failed':>15} {'-':>8}")
+                    self.stdout.write(self.style.WARNING(f"{mime_type}: {e}"))
+                    continue
+                columns.append(
+                    f"{elapsed / iterations / len(paths) * 1000:>15.1f} {megabytes * iterations / elapsed:>8.2f}"
+                )
+            label = next((ext for ext, known in extractors.EXTENSION_TYPES.items() if known == mime_type), str(mime_type))
+            self.stdout.write(f"{label:<40} {len(paths):>5} {megabytes:>8.2f} {columns[0]} {columns[1]}")
+
+        # Whole-sample throughput of the native extractors, one process versus the pool
+        native = [(mime_type, str(path), max_chars) for mime_type, paths in by_type.items()
+                  if extractors.has_native_extractor(mime_type) for path in paths]
+        if not native:
+            return
+        processes = options['processes'] or settings.NATIVE_EXTRACTION_PROCESSES or 1
+        started = time.perf_counter()
+        for job in native:
+            extractors._extract(*job)
+        sequential = time.perf_counter() - started
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            list(executor.map(extractors._extract, *zip(*native[:processes])))
+            started = time.perf_counter()
+            list(executor.map(extractors._extract, *zip(*native)))
+            pooled = time.perf_counter() - started
+        self.stdout.write(
+            f"Native throughput: {len(native) / sequential:.1f} files/s in one process, "
+            f"{len(native) / pooled:.1f} files/s with {processes} processes"
+        )
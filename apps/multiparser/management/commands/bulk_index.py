@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from apps.bot.documents import DocumentDocument
+from apps.multiparser.indexing import bulk_index
+
+
+class Command(BaseCommand):
+    help = 'Index all documents into Elasticsearch through the bulk API'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            help='Documents per bulk request (default: ES_BULK_CHUNK_SIZE)'
+        )
+        parser.add_argument(
+            '--max-chunk-mb',
+            type=float,
+            help='Maximum bulk request size in MB (default: ES_BULK_MAX_BYTES)'
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            help='Number of parallel_bulk threads, 1 for sequential (default: ES_BULK_THREADS)'
+        )
+        parser.add_argument(
+            '--keep-refresh',
+            action='store_true',
+            help='Do not disable index refresh during the load'
+        )
+
+    def handle(self, *args, **options):
+        max_chunk_bytes = int(options['max_chunk_mb'] * 1024 * 1024) if options['max_chunk_mb'] else None
+
+        self.stdout.write('Bulk indexing documents...')
+        summary = bulk_index(
+            DocumentDocument().get_indexing_queryset(),
+            chunk_size=options['chunk_size'],
+            max_chunk_bytes=max_chunk_bytes,
+            thread_count=options['threads'],
+            disable_refresh=not options['keep_refresh'],
+        )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {summary['indexed']} documents into {summary['index']} in {summary['elapsed']}s "
+                f"({summary['docs_per_second']} docs/s)"
+            )
+        )
+        if summary['failed']:
+            self.stdout.write(self.style.WARNING(f"{summary['failed']} documents failed to index"))
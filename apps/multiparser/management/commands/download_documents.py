@@ -0,0 +1,125 @@
+from django.core.management.base import BaseCommand
+from apps.multiparser.downloader import HTTP2_AVAILABLE, download_batch, pending_document_ids, release_expired_downloads
+from apps.multiparser.tasks import after_download, download_documents_batch
+
+
+class Command(BaseCommand):
+    help = 'Download pending documents in concurrent batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of documents claimed per batch (default: 500)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=100,
+            help='Number of downloads in flight at once (default: 100)'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=0,
+            help='Maximum new requests per second of this downloader on top of the shared per-host DOWNLOAD_RATE_LIMIT, 0 for no extra cap (default: 0)'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=int,
+            default=60,
+            help='Per-request timeout in seconds (default: 60)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Stop after this many documents (default: all pending)'
+        )
+        parser.add_argument(
+            '--no-followup',
+            action='store_true',
+            help='Do not enqueue indexing and Telegram tasks for downloaded files'
+        )
+        parser.add_argument(
+            '--no-extract',
+            action='store_true',
+            help='Do not stream the files to Tika while downloading'
+        )
+        parser.add_argument(
+            '--distributed',
+            action='store_true',
+            help='Enqueue the batches as Celery tasks instead of downloading locally'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        limit = options['limit']
+
+        expired = release_expired_downloads()
+        if expired:
+            self.stdout.write(f"Handed {len(expired)} documents with an expired download lease back to pending")
+
+        if options['distributed']:
+            ids = [str(i) for i in pending_document_ids(limit)]
+            for offset in range(0, len(ids), batch_size):
+                download_documents_batch.delay(
+                    ids[offset:offset + batch_size],
+                    concurrency=options['concurrency'],
+                    rate=options['rate'],
+                )
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Enqueued {len(ids)} documents in {(len(ids) + batch_size - 1) // batch_size} batches'
+                )
+            )
+            return
+
+        self.stdout.write(f"HTTP/2: {'enabled' if HTTP2_AVAILABLE else 'not available (pip install h2)'}")
+
+        totals = {'files': 0, 'downloaded': 0, 'duplicates': 0, 'failed': 0, 'bytes': 0, 'bytes_resumed': 0, 'elapsed': 0.0}
+        batch = 0
+        while limit is None or totals['files'] < limit:
+            size = batch_size if limit is None else min(batch_size, limit - totals['files'])
+            ids = pending_document_ids(size)
+            if not ids:
+                break
+
+            stats = download_batch(
+                ids,
+                concurrency=options['concurrency'],
+                rate=options['rate'],
+                timeout=options['timeout'],
+                on_downloaded=None if options['no_followup'] else after_download,
+                extract=False if options['no_extract'] else None,
+            )
+            if not stats['files']:
+                # Everything was claimed by another downloader in the meantime
+                break
+
+            batch += 1
+            for key in totals:
+                totals[key] += stats[key]
+            self.stdout.write(
+                f"Batch {batch}: {stats['downloaded']}/{stats['files']} downloaded ({stats['duplicates']} duplicates, "
+                f"{stats['extracted']} extracted, {stats['truncated']} truncated), "
+                f"{stats['failed']} failed, "
+                f"{stats['bytes'] / 2 ** 20:.1f} MB ({stats['bytes_resumed'] / 2 ** 20:.1f} MB resumed) "
+                f"in {stats['elapsed']:.1f}s "
+                f"({stats['files_per_second']} files/s, {stats['mbytes_per_second']} MB/s), "
+                f"first byte p50/p95 {stats['first_byte_p50']:.2f}/{stats['first_byte_p95']:.2f}s, "
+                f"duration p50/p95 {stats['duration_p50']:.2f}/{stats['duration_p95']:.2f}s"
+            )
+
+        elapsed = totals['elapsed']
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Downloaded {totals['downloaded']} of {totals['files']} documents "
+                f"({totals['bytes'] / 2 ** 20:.1f} MB) in {elapsed:.1f}s"
+                + (f", {totals['downloaded'] / elapsed:.2f} files/s" if elapsed else '')
+            )
+        )
+        if totals['duplicates']:
+            self.stdout.write(f"{totals['duplicates']} files duplicated already stored content and were not kept")
+        if totals['failed']:
+            self.stdout.write(self.style.WARNING(f"{totals['failed']} downloads failed"))
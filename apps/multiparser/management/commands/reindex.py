@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from apps.bot.documents import DocumentDocument
+from apps.multiparser.indexing import bulk_index, create_versioned_index, delete_missing, promote_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the documents index as a new version and swap the alias without downtime'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--shards',
+            type=int,
+            help='Number of primary shards of the new index (default: as in DocumentDocument)'
+        )
+        parser.add_argument(
+            '--replicas',
+            type=int,
+            help='Number of replicas once the load is done (default: as in DocumentDocument)'
+        )
+        parser.add_argument(
+            '--analyzer',
+            help='Analyzer for the content field of the new index, e.g. "russian"'
+        )
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=1,
+            help='Number of previous versions kept for rollback (default: 1)'
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            help='Number of parallel_bulk threads (default: ES_BULK_THREADS)'
+        )
+        parser.add_argument(
+            '--no-swap',
+            action='store_true',
+            help='Build and load the new index but leave the alias untouched'
+        )
+
+    def handle(self, *args, **options):
+        document = DocumentDocument()
+        client = document._get_connection()
+        alias = document._index._name
+
+        name, replicas = create_versioned_index(
+            client, alias, shards=options['shards'], replicas=options['replicas'], analyzer=options['analyzer']
+        )
+        self.stdout.write(f'Created {name}')
+
+        started = timezone.now()
+        try:
+            summary = bulk_index(
+                document.get_indexing_queryset(), index=name, thread_count=options['threads'], disable_refresh=True
+            )
+        except Exception as e:
+            client.indices.delete(index=name)
+            raise CommandError(f'Loading {name} failed, index removed: {e}')
+        self.stdout.write(
+            f"Loaded {summary['indexed']} documents in {summary['elapsed']}s ({summary['docs_per_second']} docs/s)"
+        )
+        if summary['failed']:
+            self.stdout.write(self.style.WARNING(f"{summary['failed']} documents failed to index"))
+
+        # Documents changed or deleted during the load were written to the live index only
+        caught_up = timezone.now()
+        self.catch_up(name, started)
+
+        if options['no_swap']:
+            self.stdout.write(self.style.SUCCESS(f'{name} is ready, alias "{alias}" unchanged'))
+            return
+
+        deleted = promote_index(client, alias, name, replicas=replicas, keep=max(0, options['keep']))
+        self.catch_up(name, caught_up)
+
+        self.stdout.write(self.style.SUCCESS(f'Alias "{alias}" now points to {name}'))
+        for index in deleted:
+            self.stdout.write(f'Deleted {index}')
+
+    def catch_up(self, name, since):
+        changed = DocumentDocument().get_queryset().filter(
+            Q(updated_at__gte=since) | Q(download_completed_at__gte=since)
+        )
+        summary = bulk_index(changed, index=name, thread_count=1)
+        if summary['indexed']:
+            self.stdout.write(f"Re-indexed {summary['indexed']} documents changed during the rebuild")
+        deleted = delete_missing(name)
+        if deleted:
+            self.stdout.write(f"Removed {deleted} documents deleted during the rebuild")
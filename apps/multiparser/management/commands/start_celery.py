@@ -1,17 +1,23 @@
 import subprocess
 import sys
 import os
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
+# Queues served by workers of their own, started next to the main one (as in docker-compose.yml):
+# extraction threads wait on Tika while native parsing runs in a process pool that prefork
+# children cannot start, and Telegram uploads need a single consumer
+DEDICATED_QUEUES = {'extract', 'telegram'}
+
+
 class Command(BaseCommand):
-    help = 'Start Celery worker and beat scheduler'
+    help = 'Start Celery workers and beat scheduler'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--worker-only',
             action='store_true',
-            help='Start only Celery worker (not beat)'
+            help='Start only Celery workers (not beat)'
         )
         parser.add_argument(
             '--beat-only',
@@ -22,90 +28,76 @@ class Command(BaseCommand):
             '--workers',
             type=int,
             default=10,
-            help='Number of worker processes (default: 10)'
+            help='Number of main worker processes (default: 10)'
+        )
+        parser.add_argument(
+            '--queues',
+            default='celery,crawl',
+            help='Comma-separated queues the main worker consumes (default: celery,crawl). The extract '
+                 'and telegram queues always get workers of their own'
+        )
+        parser.add_argument(
+            '--extract-threads',
+            type=int,
+            default=8,
+            help='Number of threads of the extract worker (default: 8)'
         )
 
     def handle(self, *args, **options):
         worker_only = options['worker_only']
         beat_only = options['beat_only']
         workers = options['workers']
+        queues = options['queues']
 
-        if not worker_only and not beat_only:
-            # Start both worker and beat
-            self.stdout.write(
-                self.style.SUCCESS('Starting Celery worker and beat scheduler...')
-            )
-            
-            # Start beat in background
-            beat_cmd = [
-                sys.executable, '-m', 'celery', '-A', 'core_project', 'beat',
-                '--loglevel=info', '--scheduler=django_celery_beat.schedulers:DatabaseScheduler'
-            ]
-            
-            beat_process = subprocess.Popen(
-                beat_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            
-            self.stdout.write(
-                self.style.SUCCESS(f'Beat scheduler started with PID: {beat_process.pid}')
+        dedicated = DEDICATED_QUEUES & set(queues.split(','))
+        if dedicated and not beat_only:
+            raise CommandError(
+                f"{', '.join(sorted(dedicated))} cannot be consumed by the main worker; "
+                "start_celery runs a dedicated worker for it"
             )
-            
-            # Start worker
-            worker_cmd = [
-                sys.executable, '-m', 'celery', '-A', 'core_project', 'worker',
-                '--loglevel=info', f'--concurrency={workers}'
-            ]
-            
-            self.stdout.write(
-                self.style.SUCCESS(f'Starting worker with {workers} processes...')
-            )
-            
-            try:
-                subprocess.run(worker_cmd, check=True)
-            except KeyboardInterrupt:
-                self.stdout.write(
-                    self.style.WARNING('\nStopping Celery processes...')
-                )
-                beat_process.terminate()
-                beat_process.wait()
-                self.stdout.write(
-                    self.style.SUCCESS('Celery processes stopped.')
-                )
-        
-        elif worker_only:
-            # Start only worker
-            self.stdout.write(
-                self.style.SUCCESS(f'Starting Celery worker with {workers} processes...')
-            )
-            
-            worker_cmd = [
-                sys.executable, '-m', 'celery', '-A', 'core_project', 'worker',
-                '--loglevel=info', f'--concurrency={workers}'
-            ]
-            
-            try:
-                subprocess.run(worker_cmd, check=True)
-            except KeyboardInterrupt:
-                self.stdout.write(
-                    self.style.SUCCESS('\nWorker stopped.')
-                )
-        
-        elif beat_only:
-            # Start only beat
-            self.stdout.write(
-                self.style.SUCCESS('Starting Celery beat scheduler...')
-            )
-            
-            beat_cmd = [
-                sys.executable, '-m', 'celery', '-A', 'core_project', 'beat',
-                '--loglevel=info', '--scheduler=django_celery_beat.schedulers:DatabaseScheduler'
-            ]
-            
-            try:
-                subprocess.run(beat_cmd, check=True)
-            except KeyboardInterrupt:
-                self.stdout.write(
-                    self.style.SUCCESS('\nBeat scheduler stopped.')
-                )
+
+        background = []
+        try:
+            if not worker_only:
+                # Start beat in background, or in the foreground when it runs alone
+                beat_cmd = [
+                    sys.executable, '-m', 'celery', '-A', 'core_project', 'beat',
+                    '--loglevel=info', '--scheduler=django_celery_beat.schedulers:DatabaseScheduler'
+                ]
+                if beat_only:
+                    self.stdout.write(self.style.SUCCESS('Starting Celery beat scheduler...'))
+                    subprocess.run(beat_cmd, check=True)
+                    return
+
+                beat_process = subprocess.Popen(beat_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                background.append(beat_process)
+                self.stdout.write(self.style.SUCCESS(f'Beat scheduler started with PID: {beat_process.pid}'))
+
+            # Dedicated workers in background
+            for name, worker_options in [
+                ('extract', ['--pool=threads', f"--concurrency={options['extract_threads']}", '--prefetch-multiplier=1']),
+                ('telegram', ['--concurrency=1', '--prefetch-multiplier=1']),
+            ]:
+                process = subprocess.Popen(self.worker_cmd(name, name, worker_options))
+                background.append(process)
+                self.stdout.write(self.style.SUCCESS(f'{name.capitalize()} worker started with PID: {process.pid}'))
+
+            # Main worker in foreground
+            self.stdout.write(self.style.SUCCESS(f'Starting worker with {workers} processes...'))
+            subprocess.run(self.worker_cmd('main', queues, [f'--concurrency={workers}']), check=True)
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\nStopping Celery processes...'))
+        finally:
+            for process in background:
+                process.terminate()
+            for process in background:
+                process.wait()
+            if background:
+                self.stdout.write(self.style.SUCCESS('Celery processes stopped.'))
+
+    @staticmethod
+    def worker_cmd(name, queues, worker_options):
+        return [
+            sys.executable, '-m', 'celery', '-A', 'core_project', 'worker', '--loglevel=info',
+            f'--hostname={name}@%h', *worker_options, f'--queues={queues}',
+        ]
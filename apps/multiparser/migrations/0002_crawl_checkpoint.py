@@ -0,0 +1,45 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiparser', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='Name')),
+                ('start_page', models.PositiveIntegerField(verbose_name='Start Page')),
+                ('end_page', models.PositiveIntegerField(verbose_name='End Page')),
+                ('last_completed_page', models.PositiveIntegerField(blank=True, null=True, verbose_name='Last Completed Page')),
+                ('completed', models.BooleanField(default=False, verbose_name='Completed')),
+                ('started_at', models.DateTimeField(verbose_name='Started At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+            ],
+            options={
+                'verbose_name': 'Crawl Checkpoint',
+                'verbose_name_plural': 'Crawl Checkpoints',
+                'ordering': ['-updated_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CrawlPage',
+            fields=[
+                ('page', models.PositiveIntegerField(primary_key=True, serialize=False, verbose_name='Page')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='Content Hash')),
+                ('product_count', models.PositiveIntegerField(default=0, verbose_name='Product Count')),
+                ('crawled_at', models.DateTimeField(auto_now=True, verbose_name='Crawled At')),
+            ],
+            options={
+                'verbose_name': 'Crawl Page',
+                'verbose_name_plural': 'Crawl Pages',
+                'ordering': ['page'],
+            },
+        ),
+    ]
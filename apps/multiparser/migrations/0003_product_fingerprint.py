@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiparser', '0002_crawl_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='fingerprint',
+            field=models.CharField(blank=True, help_text='Hash of the crawled fields, used to skip unchanged products on re-crawl', max_length=64, null=True, verbose_name='Content Fingerprint'),
+        ),
+    ]
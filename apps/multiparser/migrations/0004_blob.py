@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiparser', '0003_product_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='SHA-256')),
+                ('size', models.BigIntegerField(verbose_name='Size')),
+                ('file_path', models.CharField(blank=True, help_text='Path of the stored content, relative to MEDIA_ROOT', max_length=500, null=True, verbose_name='Local File Path')),
+                ('file_id', models.CharField(blank=True, help_text='File ID after sending to Telegram channel', max_length=255, null=True, verbose_name='Telegram File ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+            ],
+            options={
+                'verbose_name': 'Blob',
+                'verbose_name_plural': 'Blobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='blob',
+            field=models.ForeignKey(blank=True, help_text='Stored content, shared by documents with identical files', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='documents', to='multiparser.blob', verbose_name='Blob'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:38
+
+import zlib
+from pathlib import Path
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def import_text_files(apps, schema_editor):
+    """Move text kept next to the blobs (``<sha256>.txt``) into the table"""
+    Blob = apps.get_model('multiparser', 'Blob')
+    ExtractedText = apps.get_model('multiparser', 'ExtractedText')
+    for sha256 in Blob.objects.values_list('sha256', flat=True).iterator():
+        path = Path(settings.MEDIA_ROOT) / 'blobs' / sha256[:2] / sha256[2:4] / f"{sha256}.txt"
+        try:
+            text = path.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        ExtractedText.objects.update_or_create(
+            blob_id=sha256, defaults={'data': zlib.compress(text.encode('utf-8'), 6), 'length': len(text)}
+        )
+        path.unlink()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiparser', '0004_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractedText',
+            fields=[
+                ('blob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='extracted_text', serialize=False, to='multiparser.blob', verbose_name='Blob')),
+                ('data', models.BinaryField(verbose_name='Compressed Text')),
+                ('length', models.PositiveIntegerField(default=0, help_text='Number of characters before compression', verbose_name='Length')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+            ],
+            options={
+                'verbose_name': 'Extracted Text',
+                'verbose_name_plural': 'Extracted Texts',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.RunPython(import_text_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+def set_original_length(apps, schema_editor):
+    """Texts stored so far were kept in full"""
+    ExtractedText = apps.get_model('multiparser', 'ExtractedText')
+    ExtractedText.objects.update(original_length=models.F('length'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiparser', '0005_extracted_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractedtext',
+            name='original_length',
+            field=models.PositiveIntegerField(default=0, help_text='Number of characters extracted before the text was cut to EXTRACTED_TEXT_MAX_CHARS', verbose_name='Original Length'),
+        ),
+        migrations.AddField(
+            model_name='extractedtext',
+            name='truncated',
+            field=models.BooleanField(default=False, help_text='Only the beginning and a sample of later pages were kept', verbose_name='Truncated'),
+        ),
+        migrations.RunPython(set_original_length, migrations.RunPython.noop),
+    ]
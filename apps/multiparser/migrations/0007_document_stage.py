@@ -0,0 +1,50 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:59
+
+from django.db import migrations, models
+
+# download_status -> stage
+STATUS_STAGES = {
+    'pending': 0,
+    'downloading': 1,
+    'downloaded': 2,
+    'failed': 7,
+    'skipped': 8,
+}
+
+
+def set_stages(apps, schema_editor):
+    """Derive the stage of every document from its download status, stored text and channel upload"""
+    Document = apps.get_model('multiparser', 'Document')
+    for status, stage in STATUS_STAGES.items():
+        Document.objects.filter(download_status=status).update(stage=stage)
+    downloaded = Document.objects.filter(download_status='downloaded')
+    downloaded.filter(blob__extracted_text__isnull=False).update(stage=3)
+    downloaded.filter(sent_to_channel=True).update(stage=5)
+    downloaded.filter(sent_to_channel=True, file_path__isnull=True).update(stage=6)
+
+
+def set_download_statuses(apps, schema_editor):
+    Document = apps.get_model('multiparser', 'Document')
+    for status, stage in STATUS_STAGES.items():
+        Document.objects.filter(stage=stage).update(download_status=status)
+    Document.objects.filter(stage__in=[3, 4, 5, 6]).update(download_status='downloaded')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiparser', '0006_extracted_text_truncation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='stage',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Downloading'), (2, 'Downloaded'), (3, 'Extracted'), (4, 'Indexed'), (5, 'Uploaded'), (6, 'Evicted'), (7, 'Failed'), (8, 'Skipped')], db_index=True, default=0, verbose_name='Pipeline Stage'),
+        ),
+        migrations.RunPython(set_stages, set_download_statuses),
+        migrations.RemoveField(
+            model_name='document',
+            name='download_status',
+        ),
+    ]
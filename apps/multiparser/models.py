@@ -28,6 +28,41 @@ class Seller(models.Model):
         return reverse('admin:multiparser_seller_change', args=[str(self.id)])
 
 
+class Blob(models.Model):
+    """Content-addressed file: one stored copy and one Telegram upload per distinct content"""
+    sha256 = models.CharField(max_length=64, primary_key=True, verbose_name="SHA-256")
+    size = models.BigIntegerField(verbose_name="Size")
+    file_path = models.CharField(max_length=500, blank=True, null=True, verbose_name="Local File Path", help_text="Path of the stored content, relative to MEDIA_ROOT")
+    file_id = models.CharField(max_length=255, blank=True, null=True, verbose_name="Telegram File ID", help_text="File ID after sending to Telegram channel")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Created At")
+
+    class Meta:
+        verbose_name = "Blob"
+        verbose_name_plural = "Blobs"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
+class ExtractedText(models.Model):
+    """Text extracted from a blob, zlib-compressed; indexing reads it instead of re-parsing the file"""
+    blob = models.OneToOneField(Blob, on_delete=models.CASCADE, primary_key=True, related_name='extracted_text', verbose_name="Blob")
+    data = models.BinaryField(verbose_name="Compressed Text")
+    length = models.PositiveIntegerField(default=0, verbose_name="Length", help_text="Number of characters before compression")
+    original_length = models.PositiveIntegerField(default=0, verbose_name="Original Length", help_text="Number of characters extracted before the text was cut to EXTRACTED_TEXT_MAX_CHARS")
+    truncated = models.BooleanField(default=False, verbose_name="Truncated", help_text="Only the beginning and a sample of later pages were kept")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Created At")
+
+    class Meta:
+        verbose_name = "Extracted Text"
+        verbose_name_plural = "Extracted Texts"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.blob_id[:12]} ({self.length} chars)"
+
+
 class Document(models.Model):
     """Document model for file information"""
     CONTENT_TYPE_CHOICES = [
@@ -37,13 +72,17 @@ class Document(models.Model):
         ('presentation', 'Presentation'),
     ]
     
-    DOWNLOAD_STATUS_CHOICES = [
-        ('pending', 'Pending'),
-        ('downloading', 'Downloading'),
-        ('downloaded', 'Downloaded'),
-        ('failed', 'Failed'),
-        ('skipped', 'Skipped'),
-    ]
+    class Stage(models.IntegerChoices):
+        """Pipeline stages in the order a document goes through them (see `pipeline.TRANSITIONS`)"""
+        PENDING = 0, 'Pending'
+        DOWNLOADING = 1, 'Downloading'
+        DOWNLOADED = 2, 'Downloaded'
+        EXTRACTED = 3, 'Extracted'
+        INDEXED = 4, 'Indexed'
+        UPLOADED = 5, 'Uploaded'
+        EVICTED = 6, 'Evicted'
+        FAILED = 7, 'Failed'
+        SKIPPED = 8, 'Skipped'
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     page_count = models.PositiveIntegerField(blank=True, null=True, verbose_name="Page Count")
@@ -60,15 +99,16 @@ class Document(models.Model):
     file_url = models.URLField(blank=True, null=True, verbose_name="File URL", help_text="Direct link to the document file")
     file_path = models.CharField(max_length=500, blank=True, null=True, verbose_name="Local File Path", help_text="Path where file is saved locally")
     file_upload = models.FileField(upload_to=upload_to, blank=True, null=True, verbose_name="File Upload", help_text="Uploaded file for processing")
-    download_status = models.CharField(
-        max_length=20,
-        choices=DOWNLOAD_STATUS_CHOICES,
-        default='pending',
-        verbose_name="Download Status"
+    stage = models.PositiveSmallIntegerField(
+        choices=Stage.choices,
+        default=Stage.PENDING,
+        db_index=True,
+        verbose_name="Pipeline Stage"
     )
     download_started_at = models.DateTimeField(blank=True, null=True, verbose_name="Download Started At")
     download_completed_at = models.DateTimeField(blank=True, null=True, verbose_name="Download Completed At")
     download_error = models.TextField(blank=True, null=True, verbose_name="Download Error")
+    blob = models.ForeignKey(Blob, on_delete=models.SET_NULL, blank=True, null=True, related_name='documents', verbose_name="Blob", help_text="Stored content, shared by documents with identical files")
     
     # Telegram integration
     file_id = models.CharField(max_length=255, blank=True, null=True, verbose_name="Telegram File ID", help_text="File ID after sending to Telegram channel")
@@ -119,6 +159,7 @@ class Product(models.Model):
     demo_link = models.URLField(blank=True, null=True, verbose_name="Demo Link")
     file_url = models.URLField(blank=True, null=True, verbose_name="File URL")
     document = models.OneToOneField(Document, on_delete=models.CASCADE, related_name='product', verbose_name="Document")
+    fingerprint = models.CharField(max_length=64, blank=True, null=True, verbose_name="Content Fingerprint", help_text="Hash of the crawled fields, used to skip unchanged products on re-crawl")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Created At")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Updated At")
 
@@ -172,3 +213,38 @@ class ProductView(models.Model):
 
     def __str__(self):
         return f"{self.product.title} - {self.viewed_at}"
+
+
+class CrawlCheckpoint(models.Model):
+    """Progress of a full listing crawl, used by ``parse --resume``"""
+    name = models.CharField(max_length=50, unique=True, verbose_name="Name")
+    start_page = models.PositiveIntegerField(verbose_name="Start Page")
+    end_page = models.PositiveIntegerField(verbose_name="End Page")
+    last_completed_page = models.PositiveIntegerField(blank=True, null=True, verbose_name="Last Completed Page")
+    completed = models.BooleanField(default=False, verbose_name="Completed")
+    started_at = models.DateTimeField(verbose_name="Started At")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Updated At")
+
+    class Meta:
+        verbose_name = "Crawl Checkpoint"
+        verbose_name_plural = "Crawl Checkpoints"
+        ordering = ['-updated_at']
+
+    def __str__(self):
+        return f"{self.name}: {self.last_completed_page or '-'} / {self.end_page}"
+
+
+class CrawlPage(models.Model):
+    """Content hash of the last successfully stored version of a listing page"""
+    page = models.PositiveIntegerField(primary_key=True, verbose_name="Page")
+    content_hash = models.CharField(max_length=64, verbose_name="Content Hash")
+    product_count = models.PositiveIntegerField(default=0, verbose_name="Product Count")
+    crawled_at = models.DateTimeField(auto_now=True, verbose_name="Crawled At")
+
+    class Meta:
+        verbose_name = "Crawl Page"
+        verbose_name_plural = "Crawl Pages"
+        ordering = ['page']
+
+    def __str__(self):
+        return f"Page {self.page} ({self.product_count} products)"
@@ -0,0 +1,83 @@
+"""
+State machine of the document pipeline
+
+A document moves pending → downloading → downloaded → extracted → indexed →
+uploaded → evicted, or ends up failed or skipped. `Document.stage` is the
+furthest stage reached. Indexing and the channel upload run side by side, so
+a document uploaded before the next index flush goes straight from extracted
+to uploaded.
+
+Every transition is a single conditional UPDATE (``... WHERE stage IN
+(<allowed predecessors>)``), so a worker only moves documents that are where
+it expects them, a late or repeated step never moves a document backwards,
+and a whole batch costs one statement. Being UPDATEs they bypass ``auto_now``,
+so each one sets ``updated_at`` itself; the reindex catch-up relies on it.
+"""
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from apps.multiparser.models import Document
+
+Stage = Document.Stage
+
+# Stage -> stages a document may enter it from
+TRANSITIONS = {
+    # Handed back when the host asks to come back later
+    Stage.PENDING: {Stage.DOWNLOADING},
+    Stage.DOWNLOADING: {Stage.PENDING, Stage.FAILED},
+    Stage.DOWNLOADED: {Stage.DOWNLOADING},
+    Stage.EXTRACTED: {Stage.DOWNLOADING, Stage.DOWNLOADED},
+    Stage.INDEXED: {Stage.DOWNLOADED, Stage.EXTRACTED},
+    # A duplicate of content that is already in the channel is uploaded as soon as it is stored
+    Stage.UPLOADED: {Stage.DOWNLOADING, Stage.DOWNLOADED, Stage.EXTRACTED, Stage.INDEXED},
+    Stage.EVICTED: {Stage.UPLOADED},
+    Stage.FAILED: {Stage.DOWNLOADING},
+    Stage.SKIPPED: {Stage.PENDING, Stage.FAILED},
+}
+
+
+def transition(documents, stage, **fields):
+    """
+    Move the `documents` (a queryset) that may enter `stage` into it
+
+    `fields` are set in the same UPDATE, on the moved documents only. Returns
+    the number of documents moved; 0 means another worker got there first.
+    """
+    return documents.filter(stage__in=TRANSITIONS[stage]).update(stage=stage, updated_at=timezone.now(), **fields)
+
+
+def advance(documents, stage, **fields):
+    """
+    Set `fields` on all `documents` and move the ones that may enter `stage` into it
+
+    For updates that hold whatever stage the documents are in (e.g. clearing
+    the path of every document sharing a deleted file), in one UPDATE.
+    """
+    return documents.update(
+        stage=Case(
+            When(stage__in=TRANSITIONS[stage], then=Value(stage)),
+            default=F('stage'),
+            output_field=Document._meta.get_field('stage'),
+        ),
+        updated_at=timezone.now(),
+        **fields
+    )
+
+
+def claim(document_ids, stage, sources=None, **fields):
+    """
+    Claim the documents among `document_ids` that may enter `stage`, and move them there
+
+    Rows locked by a concurrent claim are skipped rather than waited for.
+    `sources` narrows the stages claimed from. Returns the claimed ids.
+    """
+    with transaction.atomic():
+        claimed = list(
+            Document.objects.select_for_update(skip_locked=True)
+            .filter(id__in=document_ids, stage__in=sources or TRANSITIONS[stage])
+            .values_list('id', flat=True)
+        )
+        if claimed:
+            Document.objects.filter(id__in=claimed).update(stage=stage, updated_at=timezone.now(), **fields)
+    return claimed
@@ -0,0 +1,62 @@
+"""
+Distributed per-host rate limiting for download tasks, backed by Redis
+"""
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import redis
+from django.conf import settings
+
+# GCRA ("virtual scheduling") token bucket. KEYS[1] holds the theoretical
+# arrival time of the next request; every call reserves one slot and returns
+# how long the caller has to wait for it. Redis TIME is used so that the
+# clocks of individual workers do not matter.
+RESERVE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < now then
+    tat = now
+end
+local delay = tat - now - burst
+if delay < 0 then
+    delay = 0
+end
+local ttl = math.ceil((tat + interval - now + burst) * 1000) + 1000
+redis.call('SET', KEYS[1], tostring(tat + interval), 'PX', ttl)
+return tostring(delay)
+"""
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+
+class HostRateLimiter:
+    """
+    Token bucket of `rate` requests per second with room for `burst` requests, shared
+    by every worker through Redis.
+
+    `reserve()` never blocks: it books the next free slot for the host and returns
+    the number of seconds until that slot, so a task can be rescheduled with that
+    countdown instead of sleeping while it holds a worker slot.
+    """
+
+    def __init__(self, host, rate=None, burst=None):
+        self.host = host
+        self.rate = rate or settings.DOWNLOAD_RATE_LIMIT
+        self.burst = max(1, burst or settings.DOWNLOAD_RATE_BURST)
+        self.key = f"ratelimit:{host}"
+        self._reserve = get_redis().register_script(RESERVE_SCRIPT)
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        return cls(urlparse(url).hostname or 'unknown', **kwargs)
+
+    def reserve(self):
+        """Reserve a request slot; returns seconds to wait before using it (0 to go now)"""
+        interval = 1.0 / self.rate
+        return float(self._reserve(keys=[self.key], args=[interval, interval * (self.burst - 1)]))
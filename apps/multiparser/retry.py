@@ -0,0 +1,131 @@
+"""
+Retry/backoff policy and per-host circuit breaker shared by the crawler and the downloader
+"""
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from django.core.cache import cache
+from django.utils import timezone
+
+# Statuses that mean "slow down" rather than "broken"
+THROTTLE_STATUS_CODES = {429, 503}
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(headers):
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds, None if absent/invalid"""
+    value = (headers or {}).get('Retry-After') or (headers or {}).get('retry-after')
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, (retry_at - timezone.now()).total_seconds())
+
+
+def is_throttled(status_code):
+    return status_code in THROTTLE_STATUS_CODES
+
+
+def is_retryable(status_code):
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter, honouring Retry-After when the server sends one.
+
+    Without Retry-After the delay for attempt n is drawn from
+    [(1 - jitter) * d, d] with d = min(max_delay, base_delay * 2 ** n), which
+    spreads retries of many workers instead of having them hit the host in lockstep.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=300.0, jitter=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (0-based)"""
+        if retry_after is not None:
+            # Never retry earlier than the server asked, only spread out slightly later
+            return min(self.max_delay, retry_after) + random.uniform(0, self.jitter * self.base_delay)
+
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform((1 - self.jitter) * ceiling, ceiling)
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker whose state lives in Django's cache.
+
+    Using the shared cache (Redis in production) means every worker process
+    sees the same state: after `failure_threshold` consecutive failures, or as
+    soon as the host sends Retry-After, the circuit opens and callers are told
+    how long to stay away instead of sending more requests. When the open period
+    ends a single trial request goes through; its outcome closes the circuit or
+    re-opens it.
+    """
+
+    # How long other callers wait while the single trial request is in flight
+    PROBE_WAIT = 5.0
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=60.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures_key = f"circuit:{host}:failures"
+        self.open_until_key = f"circuit:{host}:open_until"
+        self.probe_key = f"circuit:{host}:probe"
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        return cls(urlparse(url).hostname or 'unknown', **kwargs)
+
+    def open_for(self):
+        """Seconds to stay away from the host, 0 when a request may be sent now"""
+        open_until = cache.get(self.open_until_key)
+        if open_until is None:
+            return 0.0
+
+        remaining = open_until - time.time()
+        if remaining > 0:
+            return remaining
+        # Half-open: exactly one caller gets to probe the host
+        if cache.add(self.probe_key, 1, timeout=int(self.reset_timeout)):
+            return 0.0
+        return self.PROBE_WAIT
+
+    def record_success(self):
+        cache.delete_many([self.failures_key, self.open_until_key, self.probe_key])
+
+    def record_failure(self, retry_after=None):
+        """
+        Count a failure; open the circuit when the threshold is reached or the host
+        asked us to back off. Returns how long the circuit is open (0 if still closed).
+        """
+        cache.add(self.failures_key, 0, timeout=int(self.reset_timeout * 10))
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            failures = 1
+            cache.set(self.failures_key, failures, timeout=int(self.reset_timeout * 10))
+
+        if retry_after is None and failures < self.failure_threshold:
+            return 0.0
+
+        open_for = retry_after if retry_after is not None else self.reset_timeout
+        # Keep the marker past the open period so the circuit stays half-open until a probe succeeds
+        cache.set(self.open_until_key, time.time() + open_for, timeout=int(open_for + self.reset_timeout * 10))
+        cache.delete(self.probe_key)
+        return open_for
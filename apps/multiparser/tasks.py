@@ -1,303 +1,559 @@
 import os
-import random
 import time
+from contextlib import nullcontext
+from itertools import islice
 from pathlib import Path
 from urllib.parse import urlparse
 
 import requests
-from celery import shared_task
+from celery import group, shared_task
+from celery.exceptions import Retry
 from django.conf import settings
+from django.core.management import call_command
 from django.utils import timezone
-from apps.multiparser.models import Document, Product, Seller
+from apps.bot.documents import DocumentDocument
+from apps.multiparser.crawler import crawl_range
+from apps.multiparser.blobs import document_text, store_download, store_file_text
+from apps.multiparser.cleanup import free_media_space, remove_sent_files
+from apps.multiparser.dedup import TaskLock, claim, enqueue_once, task_finished
+from apps.multiparser.downloader import (
+    CHUNK_SIZE, DownloadLease, PartialDownload, download_batch, guess_extension, pending_documents,
+    release_expired_downloads,
+)
+from apps.multiparser.extraction import TikaPool, TikaStream, extract_file, extraction_timeout
+from apps.multiparser.extractors import detect_type, extract_native, extracts_natively, has_native_extractor, has_text
+from apps.multiparser.indexing import buffer_for_indexing, bulk_index, index_buffered
+from apps.multiparser.http_cache import ResponseCache
+from apps.multiparser.models import Blob, Document, Product, Seller
+from apps.multiparser.pipeline import advance, transition
+from apps.multiparser.ratelimit import HostRateLimiter, get_redis
+from apps.multiparser.retry import CircuitBreaker, RetryPolicy, is_retryable, is_throttled, retry_after_seconds
+from apps.multiparser.telegram_upload import queue_upload, upload_pending
 import logging
 import re
 from django.db import transaction
 from django.utils import timezone
 import asyncio
-from telegram import Bot
-from telegram.error import TelegramError
 import magic
-from elasticsearch import Elasticsearch
-from tika import parser as tika_parser
 
 logger = logging.getLogger(__name__)
 
-# Initialize Elasticsearch client
-es_client = Elasticsearch([settings.ES_URL]) if hasattr(settings, 'ES_URL') else None
+# Backoff between download retries: ~1, 2, 4 minutes with jitter, or whatever Retry-After asks for
+DOWNLOAD_RETRY_POLICY = RetryPolicy(max_attempts=4, base_delay=60.0, max_delay=3600.0)
+# Countdown for extraction tasks that found every Tika server busy: 5s doubling up to a minute
+EXTRACTION_BUSY_POLICY = RetryPolicy(max_attempts=1, base_delay=5.0, max_delay=60.0)
+TELEGRAM_FLUSH_LOCK_KEY = 'telegram:flush-lock'
+
+
+def send_claim(task):
+    """Claim name of the runs of `task` that send the document to the channel afterwards"""
+    return f"{task.name}:send"
+
+
+def after_download(document_id, extracted):
+    """
+    Follow-up of a newly stored file: index it and send it to the channel
+
+    Without extracted text the file goes to the extraction queue first, and is
+    sent (which deletes the local copy) only once Tika is done with it.
+    """
+    if extracted:
+        buffer_for_indexing([document_id])
+        enqueue_once(send_to_telegram_channel, document_id)
+    else:
+        # Claimed apart from an extraction queued by indexing, as that one does not send
+        enqueue_once(extract_document_text, document_id, claim_name=send_claim(extract_document_text), send=True)
+
 
 @shared_task(bind=True, max_retries=3, default_retry_delay=60)
-def download_and_save_file(self, document_id):
+def download_and_save_file(self, document_id, slot_reserved=False):
     """
     Download file from URL and save it locally
+
+    Downloads are rate limited per host: when no slot is free right now the task
+    books the next one and is re-queued with a countdown instead of sleeping.
+    Only one worker downloads a document at a time, and the document stays
+    claimed (see `dedup.enqueue_once`) until the task is done with it, and
+    its download lease is renewed while the file is fetched.
     """
+    lock = TaskLock(self.name, document_id)
+    if not lock.acquire():
+        return f"Document {document_id}: Already being downloaded"
+    finished = True
+    lease = None
     try:
         document = Document.objects.get(id=document_id)
-        
-        # Update status to downloading
-        document.download_status = 'downloading'
-        document.download_started_at = timezone.now()
-        document.save(update_fields=['download_status', 'download_started_at'])
-        
-        # Random delay to avoid blocking
-        time.sleep(random.uniform(1, 5))
-        
+        documents = Document.objects.filter(id=document_id)
+
         if not document.file_url:
-            document.download_status = 'skipped'
-            document.download_error = 'No file URL available'
-            document.save(update_fields=['download_status', 'download_error'])
+            transition(documents, Document.Stage.SKIPPED, download_error='No file URL available')
             return f"Document {document_id}: No file URL available"
-        
-        # Download file
-        response = requests.get(document.file_url, stream=True, timeout=30)
-        response.raise_for_status()
-        
-        # Create upload directory
-        upload_dir = Path(settings.MEDIA_ROOT) / 'documents' / str(document.id)
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Determine file extension from URL or content
-        file_extension = Path(document.file_url).suffix
-        if not file_extension:
-            # Try to get from content-type
-            content_type = response.headers.get('content-type', '')
-            if 'pdf' in content_type:
-                file_extension = '.pdf'
-            elif 'doc' in content_type:
-                file_extension = '.doc'
-            elif 'docx' in content_type:
-                file_extension = '.docx'
-            else:
-                file_extension = '.pdf'  # Default
-        
-        filename = f"document_{document.id}{file_extension}"
-        file_path = upload_dir / filename
-        
-        # Save file
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+
+        breaker = CircuitBreaker.for_url(document.file_url)
+        wait = breaker.open_for()
+        if wait:
+            # Host is backing off: reschedule without consuming one of the retries
+            self.apply_async(args=[document_id], countdown=wait)
+            finished = False
+            return f"Document {document_id}: {breaker.host} unavailable, rescheduled in {wait:.0f}s"
+
+        if not slot_reserved:
+            wait = HostRateLimiter.for_url(document.file_url).reserve()
+            if wait > 0:
+                self.apply_async(args=[document_id], kwargs={'slot_reserved': True}, countdown=wait)
+                finished = False
+                return f"Document {document_id}: rate limited, rescheduled in {wait:.1f}s"
+        
+        # Claim the document; a batch download (or a duplicate task) may have taken it meanwhile
+        started_at = timezone.now()
+        if not transition(documents, Document.Stage.DOWNLOADING, download_started_at=started_at):
+            return f"Document {document_id}: Not waiting for download"
+        lease = DownloadLease([document_id], started_at).start()
+        
+        # Download file, continuing a partial file left behind by an earlier attempt
+        part = PartialDownload(document.id)
+        try:
+            response = requests.get(document.file_url, stream=True, timeout=30, headers=part.request_headers())
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.record_failure()
+            raise
+        if is_retryable(response.status_code):
+            retry_after = retry_after_seconds(response.headers) if is_throttled(response.status_code) else None
+            breaker.record_failure(retry_after)
+            if retry_after is not None:
+                response.close()
+                lease.transition(Document.Stage.PENDING)
+                raise self.retry(countdown=DOWNLOAD_RETRY_POLICY.delay(self.request.retries, retry_after), kwargs={})
+        if response.status_code not in (200, 206, 416):
+            response.raise_for_status()
+        breaker.record_success()
+        
+        # Save file into the content-addressed store, extracting its text in the same pass
+        # when a Tika server has room for it (otherwise the extraction queue does it later).
+        # Formats extracted in-process skip Tika altogether.
+        extension = guess_extension(document.file_url, response.headers.get('content-type', ''))
+        stream = settings.EXTRACT_WHILE_DOWNLOADING and not extracts_natively(extension)
+        timeout = extraction_timeout(document.page_count, int(response.headers.get('content-length') or 0))
+        with TikaPool().slot(timeout) if stream else nullcontext() as endpoint:
+            extractor = TikaStream(endpoint, timeout) if endpoint else None
+            try:
+                extracted = part.receive(
+                    response.status_code, response.headers, response.iter_content(chunk_size=CHUNK_SIZE), extractor
+                )
+            except BaseException:
+                if extractor is not None:
+                    extractor.abort()
+                raise
+            text = extractor.finish() if extracted else None
+        if part.resumed:
+            logger.info(f"Document {document_id}: resumed download at byte {part.resumed}")
+        blob, duplicate = store_download(part, extension, text=text)
         
         # Update document with file path
-        document.file_path = str(file_path.relative_to(settings.MEDIA_ROOT))
-        document.download_status = 'downloaded'
-        document.download_completed_at = timezone.now()
-        document.save(update_fields=['file_path', 'download_status', 'download_completed_at'])
+        fields = {'blob': blob, 'file_path': blob.file_path, 'download_completed_at': timezone.now(), 'download_error': None}
+        stage = Document.Stage.EXTRACTED if text is not None else Document.Stage.DOWNLOADED
+        if blob.file_id:
+            fields.update(file_id=blob.file_id, sent_to_channel=True, sent_at=timezone.now())
+            stage = Document.Stage.UPLOADED
+        if not lease.transition(stage, **fields):
+            # The lease ran out meanwhile and the document was handed to another worker
+            return f"Document {document_id}: Download lease lost"
         
-        # Trigger indexing task
-        index_document.delay(document_id)
+        if duplicate:
+            # Same content as an already stored document: it is indexed and sent once
+            return f"Document {document_id}: Duplicate of blob {blob.sha256}"
         
-        # Trigger send to channel task
-        send_to_telegram_channel.delay(document_id)
+        # Index and send to channel, extracting the text first if that did not happen above
+        after_download(document_id, text is not None)
         
-        return f"Document {document_id}: Downloaded successfully to {file_path}"
+        return f"Document {document_id}: Downloaded successfully to {blob.file_path}"
         
     except Document.DoesNotExist:
         return f"Document {document_id}: Not found"
+    except Retry:
+        finished = False
+        raise
     except Exception as exc:
         logger.error(f"Error downloading document {document_id}: {exc}")
         
         # Update document with error
         try:
-            document = Document.objects.get(id=document_id)
-            document.download_status = 'failed'
-            document.download_error = str(exc)
-            document.save(update_fields=['download_status', 'download_error'])
+            if lease is not None:
+                lease.transition(Document.Stage.FAILED, download_error=str(exc))
+            else:
+                transition(Document.objects.filter(id=document_id), Document.Stage.FAILED, download_error=str(exc))
         except:
             pass
         
         # Retry with exponential backoff
-        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+        finished = self.request.retries >= self.max_retries
+        raise self.retry(exc=exc, countdown=DOWNLOAD_RETRY_POLICY.delay(self.request.retries), kwargs={})
+    finally:
+        if lease is not None:
+            lease.stop()
+        lock.release()
+        if finished:
+            task_finished(self.name, document_id)
 
 
 @shared_task(bind=True, max_retries=3, default_retry_delay=60)
 def index_document(self, document_id):
     """
-    Index document using Elasticsearch and Tika for content extraction
+    Queue a document for the next bulk indexing run (see flush_index_buffer)
     """
     try:
-        document = Document.objects.get(id=document_id)
-        
-        if not document.file_path:
-            return f"Document {document_id}: No file path available"
-        
-        file_path = Path(settings.MEDIA_ROOT) / document.file_path
-        
-        if not file_path.exists():
-            return f"Document {document_id}: File not found at {file_path}"
-        
-        # Extract text content using Tika
-        try:
-            parsed = tika_parser.from_file(str(file_path))
-            content = parsed.get('content', '')
-            metadata = parsed.get('metadata', {})
-        except Exception as e:
-            logger.warning(f"Tika parsing failed for {document_id}: {e}")
-            content = ""
-            metadata = {}
-        
-        # Prepare document for indexing
-        doc_data = {
-            'id': document.id,
-            'title': document.title or '',
-            'description': document.description or '',
-            'content': content,
-            'file_path': document.file_path,
-            'file_url': document.file_url,
-            'mime_type': metadata.get('Content-Type', ''),
-            'file_size': metadata.get('Content-Length', 0),
-            'created_at': document.created_at.isoformat() if document.created_at else None,
-            'product_id': document.product.id if document.product else None,
-            'seller_id': document.product.seller.id if document.product and document.product.seller else None,
-        }
-        
-        # Index in Elasticsearch
-        if es_client:
-            try:
-                index_name = getattr(settings, 'ES_INDEX', 'documents')
-                es_client.index(
-                    index=index_name,
-                    id=document.id,
-                    body=doc_data
-                )
-                logger.info(f"Document {document_id} indexed successfully")
-            except Exception as e:
-                logger.error(f"Elasticsearch indexing failed for {document_id}: {e}")
-                raise self.retry(exc=e, countdown=60 * (2 ** self.request.retries))
-        
-        return f"Document {document_id}: Indexed successfully"
+        buffer_for_indexing([document_id])
+        task_finished(self.name, document_id)
+        return f"Document {document_id}: Queued for indexing"
         
+    except Exception as exc:
+        logger.error(f"Error queueing document {document_id} for indexing: {exc}")
+        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def extract_document_text(self, document_id, send=False, busy=0):
+    """
+    Extract the text of a downloaded document and queue it for indexing
+
+    Runs on the ``extract`` queue with its own workers. Formats with a native
+    extractor are parsed in-process, everything else (and whatever a native
+    extractor fails on) by Tika. The timeout grows with the page count and file
+    size; when every Tika server is at its limit the task is re-queued with a
+    growing countdown instead of waiting. With `send`, the document is sent to
+    the channel afterwards, even if extraction failed.
+    """
+    lock = TaskLock(self.name, document_id)
+    if not lock.acquire():
+        if send:
+            # The running extraction may not send the document; come back once it is done
+            countdown = EXTRACTION_BUSY_POLICY.delay(busy)
+            self.apply_async(args=[document_id], kwargs={'send': send, 'busy': busy + 1}, countdown=countdown)
+            return f"Document {document_id}: Already being extracted, rescheduled in {countdown:.0f}s"
+        return f"Document {document_id}: Already being extracted"
+    finished = True
+    try:
+        document = Document.objects.select_related('blob__extracted_text').get(id=document_id)
+        if document_text(document) is None:
+            path = Path(settings.MEDIA_ROOT) / document.file_path if document.file_path else None
+            if path is None or not path.exists():
+                # Indexed without text
+                buffer_for_indexing([document_id])
+                return f"Document {document_id}: No local file to extract"
+
+            timeout = extraction_timeout(document.page_count, path.stat().st_size)
+            mime_type = detect_type(path, document.file_type) if settings.NATIVE_EXTRACTION else None
+            text = None
+            if has_native_extractor(mime_type):
+                try:
+                    text = extract_native(path, mime_type, timeout)
+                except Exception as e:
+                    logger.warning(f"Native extraction of document {document_id} ({mime_type}) failed, using Tika: {e}")
+            if text is None:
+                with TikaPool().slot(timeout) as endpoint:
+                    if endpoint is None:
+                        countdown = EXTRACTION_BUSY_POLICY.delay(busy)
+                        self.apply_async(args=[document_id], kwargs={'send': send, 'busy': busy + 1}, countdown=countdown)
+                        finished = False
+                        return f"Document {document_id}: Tika busy, rescheduled in {countdown:.0f}s"
+                    text = extract_file(path, endpoint, timeout)
+            store_file_text(document, path, text)
+
+        transition(Document.objects.filter(id=document_id), Document.Stage.EXTRACTED)
+        buffer_for_indexing([document_id])
+        if send:
+            enqueue_once(send_to_telegram_channel, document_id)
+        return f"Document {document_id}: Text extracted"
+
     except Document.DoesNotExist:
         return f"Document {document_id}: Not found"
     except Exception as exc:
-        logger.error(f"Error indexing document {document_id}: {exc}")
+        logger.error(f"Error extracting text of document {document_id}: {exc}")
+        if self.request.retries >= self.max_retries:
+            # Give up on the text and index the document without it. Moving it on
+            # from the downloaded stage keeps flush_index_buffer from queueing it again
+            transition(Document.objects.filter(id=document_id), Document.Stage.EXTRACTED)
+            buffer_for_indexing([document_id])
+            if send:
+                enqueue_once(send_to_telegram_channel, document_id)
+            return f"Document {document_id}: Extraction failed: {exc}"
+        finished = False
         raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+    finally:
+        lock.release()
+        if finished:
+            task_finished(send_claim(self) if send else self.name, document_id)
 
 
-@shared_task(bind=True, max_retries=3, default_retry_delay=60)
-def send_to_telegram_channel(self, document_id):
+def extract_missing_text(document_ids):
+    """
+    Queue the extraction of documents among `document_ids` that have a local file of a text-bearing type but no text
+
+    Only documents still at the downloaded stage qualify: an extraction that
+    ran, even one that gave up, moved the document on.
+    """
+    documents = Document.objects.filter(
+        id__in=document_ids, stage=Document.Stage.DOWNLOADED, file_path__isnull=False,
+        blob__extracted_text__isnull=True,
+    ).values_list('id', 'file_type', 'file_path')
+    for document_id, file_type, file_path in documents:
+        path = Path(settings.MEDIA_ROOT) / file_path
+        # file_type is the extension from the listing ('.pdf', 'docx'); the file itself tells the rest
+        if path.exists() and path.stat().st_size > 0 and has_text(detect_type(path, file_type)):
+            enqueue_once(extract_document_text, document_id)
+
+
+@shared_task
+def flush_index_buffer():
     """
-    Send document to Telegram channel and save file_id
+    Bulk index the documents queued by index_document
+
+    Documents indexed without their text get it extracted in the background,
+    never while indexing.
     """
     try:
-        document = Document.objects.get(id=document_id)
-        
-        if not document.file_path:
-            return f"Document {document_id}: No file path available"
-        
-        # Get bot token and channel ID from settings
-        bot_token = getattr(settings, 'BOT_TOKEN', None)
-        channel_id = getattr(settings, 'FORCE_CHANNEL_ID', None)
-        
-        if not bot_token or not channel_id:
-            logger.error("BOT_TOKEN or FORCE_CHANNEL_ID not configured")
-            return f"Document {document_id}: Bot configuration missing"
-        
-        file_path = Path(settings.MEDIA_ROOT) / document.file_path
-        
-        if not file_path.exists():
-            return f"Document {document_id}: File not found at {file_path}"
+        totals = index_buffered(on_indexed=extract_missing_text)
+        if totals['indexed'] or totals['failed']:
+            logger.info(
+                f"Bulk indexed {totals['indexed']} documents in {totals['elapsed']}s, {totals['failed']} failed"
+            )
+        return totals
         
-        # Send file to channel
-        try:
-            bot = Bot(token=bot_token)
-            
-            # Send as document
-            with open(file_path, 'rb') as f:
-                result = bot.send_document(
-                    chat_id=channel_id,
-                    document=f,
-                    filename=file_path.name,
-                    caption=f"📄 {document.title or 'Document'}\n\n"
-                           f"📝 Description: {document.description or 'No description'}\n"
-                           f"🏷️ Product: {document.product.title if document.product else 'N/A'}\n"
-                           f"👤 Seller: {document.product.seller.fullname if document.product and document.product.seller else 'N/A'}"
-                )
-            
-            # Save file_id and mark as sent
-            document.file_id = result.document.file_id
-            document.sent_to_channel = True
-            document.sent_at = timezone.now()
-            document.save(update_fields=['file_id', 'sent_to_channel', 'sent_at'])
-            
-            logger.info(f"Document {document_id} sent to channel successfully")
-            
-            # Delete local file after sending
-            try:
-                os.remove(file_path)
-                document.file_path = None
-                document.save(update_fields=['file_path'])
-                logger.info(f"Local file deleted for document {document_id}")
-            except Exception as e:
-                logger.warning(f"Failed to delete local file for {document_id}: {e}")
-            
-            return f"Document {document_id}: Sent to channel successfully"
-            
-        except TelegramError as e:
-            logger.error(f"Telegram error sending document {document_id}: {e}")
-            raise self.retry(exc=e, countdown=60 * (2 ** self.request.retries))
+    except Exception as e:
+        logger.error(f"Error in flush_index_buffer: {e}")
+        return f"Index flush failed: {e}"
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def bulk_index_documents(self, document_ids=None):
+    """
+    Bulk index the given documents, or all of them with refresh disabled during the load
+    """
+    try:
+        if document_ids is None:
+            summary = bulk_index(DocumentDocument().get_indexing_queryset(), disable_refresh=True)
+        else:
+            summary = bulk_index(DocumentDocument().get_queryset().filter(id__in=document_ids))
+        logger.info(
+            f"Bulk indexed {summary['indexed']} documents into {summary['index']} in {summary['elapsed']}s "
+            f"({summary['docs_per_second']} docs/s), {summary['failed']} failed"
+        )
+        return summary
         
-    except Document.DoesNotExist:
-        return f"Document {document_id}: Not found"
     except Exception as exc:
-        logger.error(f"Error sending document {document_id} to channel: {exc}")
+        logger.error(f"Error bulk indexing documents: {exc}")
+        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def send_to_telegram_channel(self, document_id):
+    """
+    Queue a document for the next Telegram upload run (see flush_telegram_uploads)
+    """
+    try:
+        queue_upload([document_id])
+        task_finished(self.name, document_id)
+        return f"Document {document_id}: Queued for the channel"
+
+    except Exception as exc:
+        logger.error(f"Error queueing document {document_id} for the channel: {exc}")
         raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
 
 
+@shared_task
+def flush_telegram_uploads():
+    """
+    Upload the documents queued by send_to_telegram_channel in media groups
+
+    Runs on the ``telegram`` queue, which has a single worker process, so that
+    the bot and its connection pool are initialised once and the channel's rate
+    limit is governed in one place. A Redis lock keeps a slow run from
+    overlapping the next one.
+    """
+    budget = settings.TELEGRAM_FLUSH_SECONDS
+    redis = get_redis()
+    if not redis.set(TELEGRAM_FLUSH_LOCK_KEY, 1, nx=True, ex=int(budget) + 60):
+        return "Telegram upload already running"
+    try:
+        summary = upload_pending(budget)
+        if summary['uploaded'] or summary['failed']:
+            logger.info(
+                f"Sent {summary['uploaded']} documents to the channel in {summary['groups']} messages "
+                f"({summary['reused']} reused, {summary['failed']} failed, waited {summary['waited']}s)"
+            )
+        return summary
+
+    except Exception as e:
+        logger.error(f"Error in flush_telegram_uploads: {e}")
+        return f"Telegram upload failed: {e}"
+    finally:
+        redis.delete(TELEGRAM_FLUSH_LOCK_KEY)
+
+
 @shared_task
 def cleanup_old_files():
     """
     Clean up old downloaded files that are no longer needed
     """
     try:
-        # Find documents that were sent to channel more than 1 day ago
+        # Files whose content was sent to the channel more than 1 day ago
         cutoff_date = timezone.now() - timezone.timedelta(days=1)
-        old_documents = Document.objects.filter(
-            sent_to_channel=True,
-            sent_at__lt=cutoff_date,
-            file_path__isnull=False
+        summary = remove_sent_files(cutoff_date)
+        logger.info(
+            f"Cleaned up {summary['files']} old files ({summary['bytes'] / 2 ** 20:.1f} MB) in {summary['elapsed']}s"
         )
-        
-        cleaned_count = 0
-        for document in old_documents:
-            try:
-                file_path = Path(settings.MEDIA_ROOT) / document.file_path
-                if file_path.exists():
-                    os.remove(file_path)
-                    document.file_path = None
-                    document.save(update_fields=['file_path'])
-                    cleaned_count += 1
-            except Exception as e:
-                logger.error(f"Failed to clean up file for document {document.id}: {e}")
-        
-        logger.info(f"Cleaned up {cleaned_count} old files")
-        return f"Cleaned up {cleaned_count} old files"
+
+        summary['evicted'] = free_media_space()['files']
+        return summary
         
     except Exception as e:
         logger.error(f"Error in cleanup_old_files: {e}")
         return f"Cleanup failed: {e}"
 
 
+@shared_task
+def check_media_space():
+    """
+    Evict files already in the channel, least recently used first, while MEDIA_ROOT is low on space
+    """
+    try:
+        summary = free_media_space()
+        if summary['files']:
+            logger.info(
+                f"Disk pressure: evicted {summary['files']} files ({summary['bytes'] / 2 ** 20:.1f} MB), "
+                f"{summary['free_after'] / 2 ** 30:.1f} GB free"
+            )
+        return summary
+
+    except Exception as e:
+        logger.error(f"Error in check_media_space: {e}")
+        return f"Disk pressure check failed: {e}"
+
+
 @shared_task
 def update_parsed_data_periodic():
     """
     Periodic task to update parsed data every 3 days
     """
     try:
-        # This would be your existing parsing logic
-        # For now, just trigger download tasks for documents that need processing
-        pending_documents = Document.objects.filter(
-            download_status='pending',
-            file_url__isnull=False
-        ).exclude(
-            product__id=327540  # Skip this specific product ID as requested
+        # Refresh the catalogue, stopping as soon as already known and unchanged pages are reached
+        call_command('parse', incremental=True)
+    except Exception as e:
+        # Documents found by earlier runs still have to be downloaded
+        logger.error(f"Error refreshing the catalogue in update_parsed_data_periodic: {e}")
+
+    try:
+        # Downloads lost with their worker are dispatched again; their tasks are gone
+        for document_id in release_expired_downloads():
+            task_finished(download_and_save_file.name, document_id)
+
+        # Trigger download tasks for documents that need processing, a chunk of
+        # messages at a time, skipping documents still queued from an earlier run
+        started = time.monotonic()
+        chunk_size = settings.DOWNLOAD_DISPATCH_CHUNK
+        summary = {'pending': 0, 'enqueued': 0, 'skipped': 0, 'capped': False}
+        ids = pending_documents().values_list('id', flat=True).iterator(chunk_size=chunk_size)
+        while chunk := list(islice(ids, chunk_size)):
+            fresh, room = claim(download_and_save_file.name, chunk, limit=settings.DOWNLOAD_MAX_IN_FLIGHT)
+            if fresh:
+                group(download_and_save_file.s(document_id) for document_id in fresh).apply_async()
+            summary['pending'] += len(chunk)
+            summary['enqueued'] += len(fresh)
+            if room <= 0:
+                # DOWNLOAD_MAX_IN_FLIGHT reached; the rest waits for the next run
+                summary['capped'] = True
+                break
+        summary['skipped'] = summary['pending'] - summary['enqueued']
+        summary['elapsed'] = round(time.monotonic() - started, 2)
+        summary['enqueued_per_second'] = round(summary['enqueued'] / summary['elapsed'], 1) if summary['elapsed'] else 0.0
+
+        logger.info(
+            f"Triggered download for {summary['enqueued']} pending documents in {summary['elapsed']}s "
+            f"({summary['enqueued_per_second']} tasks/s), {summary['skipped']} skipped as still queued"
+            + (", in-flight limit reached" if summary['capped'] else "")
         )
-        
-        for document in pending_documents:
-            download_and_save_file.delay(document.id)
-        
-        logger.info(f"Triggered download for {pending_documents.count()} pending documents")
-        return f"Triggered download for {pending_documents.count()} pending documents"
+        return summary
         
     except Exception as e:
         logger.error(f"Error in update_parsed_data_periodic: {e}")
         return f"Periodic update failed: {e}"
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def crawl_page_range(self, start_page, end_page, concurrency=1, rate=2.0, batch_pages=10):
+    """
+    Crawl one chunk of listing pages (routed to the ``crawl`` queue)
+    """
+    try:
+        summary = crawl_range(
+            start_page,
+            end_page,
+            concurrency=concurrency,
+            rate=rate,
+            batch_pages=batch_pages,
+            cache=ResponseCache(settings.CRAWL_CACHE_DIR),
+        )
+        logger.info(
+            f"Crawled pages {start_page}-{end_page}: {summary['pages']} pages in {summary['elapsed']}s "
+            f"({summary['pages_per_second']} pages/s), {summary['not_modified']} not modified, "
+            f"{len(summary['failed_pages'])} failed"
+        )
+        return summary
+
+    except Exception as exc:
+        logger.error(f"Error crawling pages {start_page}-{end_page}: {exc}")
+        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+
+
+@shared_task
+def crawl_finished(summaries, started_at=None):
+    """
+    Chord callback: aggregate the chunk summaries of a distributed crawl
+    """
+    totals = {
+        'chunks': len(summaries),
+        'pages': sum(s['pages'] for s in summaries),
+        'failed_pages': sorted(p for s in summaries for p in s['failed_pages']),
+        'inserted': sum(s['inserted'] for s in summaries),
+        'updated': sum(s['updated'] for s in summaries),
+        'unchanged': sum(s['unchanged'] for s in summaries),
+        'sellers_created': sum(s['sellers_created'] for s in summaries),
+    }
+
+    for s in sorted(summaries, key=lambda s: s['start_page']):
+        logger.info(
+            f"Chunk {s['start_page']}-{s['end_page']}: {s['pages']} pages in {s['elapsed']}s "
+            f"({s['pages_per_second']} pages/s), {s['inserted']} inserted, {s['updated']} updated, "
+            f"{s['unchanged']} unchanged, {len(s['failed_pages'])} failed"
+        )
+
+    if started_at:
+        elapsed = (timezone.now() - timezone.datetime.fromisoformat(started_at)).total_seconds()
+        totals['elapsed'] = round(elapsed, 2)
+        totals['pages_per_second'] = round(totals['pages'] / elapsed, 2) if elapsed else 0.0
+
+    logger.info(
+        f"Distributed crawl finished: {totals['pages']} pages in {totals['chunks']} chunks, "
+        f"{totals['inserted']} inserted, {totals['updated']} updated, {totals['unchanged']} unchanged, "
+        f"{len(totals['failed_pages'])} failed pages"
+    )
+    return totals
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def download_documents_batch(self, document_ids, concurrency=100, rate=0):
+    """
+    Download a batch of pending documents concurrently from one asyncio event loop
+    """
+    try:
+        stats = download_batch(document_ids, concurrency=concurrency, rate=rate, on_downloaded=after_download)
+        logger.info(
+            f"Downloaded {stats['downloaded']}/{stats['files']} documents in {stats['elapsed']}s "
+            f"({stats['files_per_second']} files/s, {stats['mbytes_per_second']} MB/s, "
+            f"p95 {stats['duration_p95']}s), {stats['failed']} failed"
+        )
+        return stats
+
+    except Exception as exc:
+        logger.error(f"Error downloading batch of {len(document_ids)} documents: {exc}")
+        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
@@ -0,0 +1,291 @@
+"""
+Uploads of downloaded documents to the Telegram channel
+
+`send_to_telegram_channel` only queues a document; `flush_telegram_uploads`,
+the single consumer of the ``telegram`` queue, uploads the queue in media
+groups of up to ten files through one bot (and HTTP connection pool) per
+worker process. Uploads are paced by a Redis token bucket below Telegram's
+per-channel limit, and a flood-control RetryAfter is waited out exactly.
+
+Queued ids are moved to an in-progress set when a run takes them and removed
+from it once their outcome is recorded; whatever a run leaves there (it ran out
+of time, raised or was killed) goes back to the queue.
+"""
+import asyncio
+import logging
+import os
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+from telegram import Bot, InputMediaDocument
+from telegram.error import RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+from apps.multiparser.blobs import release_blob_file
+from apps.multiparser.models import Blob, Document
+from apps.multiparser.pipeline import advance
+from apps.multiparser.ratelimit import HostRateLimiter, get_redis
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_QUEUE_KEY = 'telegram:pending'
+# Ids taken from the queue by the running upload whose outcome is not recorded yet
+UPLOAD_SENDING_KEY = 'telegram:sending'
+# Failed upload attempts per document; a document is dropped from the queue after MAX_ATTEMPTS
+ATTEMPTS_KEY = 'telegram:attempts'
+MAX_ATTEMPTS = 3
+# Telegram accepts at most ten files per sendMediaGroup
+MEDIA_GROUP_SIZE = 10
+CAPTION_LIMIT = 1024
+
+# Move up to ARGV[1] ids from the queue (KEYS[1]) to the in-progress set (KEYS[2])
+TAKE_SCRIPT = """
+local ids = redis.call('SPOP', KEYS[1], ARGV[1])
+if #ids > 0 then
+    redis.call('SADD', KEYS[2], unpack(ids))
+end
+return ids
+"""
+
+
+def queue_upload(document_ids):
+    """Queue documents for the next `flush_telegram_uploads` run"""
+    if document_ids:
+        get_redis().sadd(UPLOAD_QUEUE_KEY, *[str(document_id) for document_id in document_ids])
+
+
+def take_queued(count):
+    """Move up to `count` queued ids to the in-progress set and return them"""
+    ids = get_redis().eval(TAKE_SCRIPT, 2, UPLOAD_QUEUE_KEY, UPLOAD_SENDING_KEY, count)
+    return [document_id.decode() for document_id in ids]
+
+
+def acknowledge(document_ids):
+    """Remove documents whose outcome is recorded from the in-progress set"""
+    if document_ids:
+        get_redis().srem(UPLOAD_SENDING_KEY, *[str(document_id) for document_id in document_ids])
+
+
+def requeue_unacknowledged():
+    """Put the ids a run took but did not acknowledge back in the queue"""
+    pipe = get_redis().pipeline()
+    pipe.sunionstore(UPLOAD_QUEUE_KEY, [UPLOAD_QUEUE_KEY, UPLOAD_SENDING_KEY])
+    pipe.delete(UPLOAD_SENDING_KEY)
+    pipe.execute()
+
+
+class ChannelUploader:
+    """
+    A bot initialised once and driven from a private event loop
+
+    python-telegram-bot is asyncio based and its connection pool is bound to the
+    loop it was first used on, so the loop lives as long as the uploader.
+    """
+
+    def __init__(self, token, channel_id):
+        self.channel_id = channel_id
+        self.loop = asyncio.new_event_loop()
+        self.bot = Bot(token=token, request=HTTPXRequest(
+            connection_pool_size=2, read_timeout=60, write_timeout=60, media_write_timeout=300
+        ))
+        self.loop.run_until_complete(self.bot.initialize())
+        self.limiter = HostRateLimiter(
+            f"telegram:{channel_id}", rate=settings.TELEGRAM_UPLOAD_RATE, burst=settings.TELEGRAM_UPLOAD_BURST
+        )
+
+    def send(self, uploads):
+        """Send `uploads` as one message or media group, returns their file_ids in order"""
+        if len(uploads) == 1:
+            upload = uploads[0]
+            message = self.loop.run_until_complete(self.bot.send_document(
+                chat_id=self.channel_id, document=upload.path, filename=upload.path.name, caption=upload.caption
+            ))
+            return [message.document.file_id]
+
+        media = [
+            InputMediaDocument(upload.path, filename=upload.path.name, caption=upload.caption) for upload in uploads
+        ]
+        messages = self.loop.run_until_complete(self.bot.send_media_group(chat_id=self.channel_id, media=media))
+        return [message.document.file_id for message in messages]
+
+
+@lru_cache(maxsize=None)
+def get_uploader():
+    """The worker's `ChannelUploader`, None when BOT_TOKEN or FORCE_CHANNEL_ID is not configured"""
+    token = getattr(settings, 'BOT_TOKEN', None)
+    channel_id = getattr(settings, 'FORCE_CHANNEL_ID', None)
+    if not token or not channel_id:
+        return None
+    return ChannelUploader(token, channel_id)
+
+
+class Upload:
+    """One file to send: the documents sharing it, their blob and the caption"""
+
+    def __init__(self, document, path):
+        self.documents = [document]
+        self.blob = document.blob
+        self.path = path
+        self.caption = caption_for(document)
+
+
+def caption_for(document):
+    try:
+        product = document.product
+    except Document.product.RelatedObjectDoesNotExist:
+        product = None
+    caption = (
+        f"📄 {product.title if product else 'Document'}\n\n"
+        f"👤 Seller: {product.seller.fullname if product else 'N/A'}"
+    )
+    return caption[:CAPTION_LIMIT]
+
+
+def prepare_uploads(document_ids, summary):
+    """
+    Turn queued ids into `Upload`s, one per distinct file
+
+    Documents whose content was already uploaded reuse its file_id right away,
+    and documents without a local file are skipped.
+    """
+    uploads = {}
+    documents = Document.objects.select_related('blob', 'product__seller').filter(
+        id__in=document_ids, sent_to_channel=False
+    )
+    for document in documents:
+        if document.blob and document.blob.file_id:
+            advance(
+                Document.objects.filter(id=document.id), Document.Stage.UPLOADED,
+                file_id=document.blob.file_id, sent_to_channel=True, sent_at=timezone.now()
+            )
+            summary['reused'] += 1
+            continue
+
+        path = Path(settings.MEDIA_ROOT) / document.file_path if document.file_path else None
+        if path is None or not path.exists():
+            logger.warning(f"Document {document.id}: no local file to send to the channel")
+            summary['skipped'] += 1
+            continue
+
+        key = document.blob_id or document.id
+        if key in uploads:
+            uploads[key].documents.append(document)
+        else:
+            uploads[key] = Upload(document, path)
+    return list(uploads.values())
+
+
+def record_upload(upload, file_id):
+    """Store the file_id on the documents (and every document sharing the blob), then delete the local file"""
+    sent_at = timezone.now()
+    advance(
+        Document.objects.filter(id__in=[document.id for document in upload.documents]), Document.Stage.UPLOADED,
+        file_id=file_id, sent_to_channel=True, sent_at=sent_at
+    )
+    try:
+        if upload.blob:
+            Blob.objects.filter(sha256=upload.blob.sha256).update(file_id=file_id)
+            advance(
+                Document.objects.filter(blob=upload.blob, file_id__isnull=True), Document.Stage.UPLOADED,
+                file_id=file_id, sent_to_channel=True, sent_at=sent_at
+            )
+            release_blob_file(upload.blob)
+        else:
+            os.remove(upload.path)
+            advance(
+                Document.objects.filter(id__in=[document.id for document in upload.documents]), Document.Stage.EVICTED,
+                file_path=None
+            )
+    except Exception as e:
+        logger.warning(f"Failed to delete local file {upload.path}: {e}")
+
+
+def record_failure(upload, error):
+    """Put the documents back in the queue, or drop them after MAX_ATTEMPTS"""
+    redis = get_redis()
+    for document in upload.documents:
+        attempts = redis.hincrby(ATTEMPTS_KEY, str(document.id), 1)
+        if attempts < MAX_ATTEMPTS:
+            queue_upload([document.id])
+        else:
+            redis.hdel(ATTEMPTS_KEY, str(document.id))
+            logger.error(f"Document {document.id}: giving up sending to the channel after {attempts} attempts: {error}")
+    acknowledge([document.id for document in upload.documents])
+
+
+def upload_pending(budget):
+    """
+    Upload queued documents for up to `budget` seconds, returns a summary
+
+    Every message of a group takes one slot of the channel's token bucket and
+    the call sleeps until the slots are due. A RetryAfter is slept exactly
+    before the group is tried again; a group Telegram rejects otherwise is
+    retried one file at a time, so one bad file does not hold back the others.
+    """
+    summary = {'uploaded': 0, 'groups': 0, 'reused': 0, 'skipped': 0, 'failed': 0, 'waited': 0.0}
+    uploader = get_uploader()
+    if uploader is None:
+        logger.error("BOT_TOKEN or FORCE_CHANNEL_ID not configured")
+        return summary
+
+    redis = get_redis()
+    # Left behind by a run that was killed
+    requeue_unacknowledged()
+    deadline = time.monotonic() + budget
+    pending = []
+    try:
+        while True:
+            if not pending:
+                ids = take_queued(MEDIA_GROUP_SIZE)
+                if not ids:
+                    break
+                group = prepare_uploads(ids, summary)
+                # Already sent, reused or without a file: nothing more to do for them
+                acknowledge(set(ids) - {str(document.id) for upload in group for document in upload.documents})
+                pending = [group]
+            group = pending.pop(0)
+            if not group:
+                continue
+
+            wait = max(uploader.limiter.reserve() for _ in group)
+            if time.monotonic() + wait > deadline:
+                break
+            time.sleep(wait)
+            summary['waited'] += wait
+
+            try:
+                file_ids = uploader.send(group)
+            except RetryAfter as e:
+                retry_after = getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)()
+                logger.warning(f"Telegram flood control, retrying in {retry_after}s")
+                if time.monotonic() + retry_after > deadline:
+                    break
+                time.sleep(retry_after)
+                summary['waited'] += retry_after
+                pending.insert(0, group)
+                continue
+            except TelegramError as e:
+                if len(group) > 1:
+                    logger.warning(f"Media group of {len(group)} files rejected ({e}), sending them one by one")
+                    pending[:0] = [[upload] for upload in group]
+                    continue
+                logger.error(f"Telegram error sending {group[0].path.name}: {e}")
+                record_failure(group[0], e)
+                summary['failed'] += len(group[0].documents)
+                continue
+
+            for upload, file_id in zip(group, file_ids):
+                record_upload(upload, file_id)
+                redis.hdel(ATTEMPTS_KEY, *[str(document.id) for document in upload.documents])
+                acknowledge([document.id for document in upload.documents])
+                summary['uploaded'] += len(upload.documents)
+            summary['groups'] += 1
+    finally:
+        # Groups not reached before the deadline, or interrupted by an error
+        requeue_unacknowledged()
+
+    summary['waited'] = round(summary['waited'], 2)
+    return summary
@@ -1,3 +1,598 @@
-from django.test import TestCase
+import hashlib
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from email.utils import format_datetime
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from apps.multiparser import telegram_upload
+from apps.multiparser.crawler import PageFetcher
+from apps.multiparser.dedup import TaskLock, enqueue_once, task_finished
+from apps.multiparser.downloader import (
+    DownloadLease, IncompleteDownload, PartialDownload, parse_content_range, release_expired_downloads,
+)
+from apps.multiparser.extraction import MAX_WORD, TextBudget, read_text
+from apps.multiparser.extractors import TEXT_CHUNK_SIZE, extract_plain_text
+from apps.multiparser.ingest import BatchWriter, is_page_unchanged
+from apps.multiparser.items import ProductItem, decode_page, ijson, orjson
+from apps.multiparser.models import CrawlPage, Document, Product, Seller
+from apps.multiparser.pipeline import advance, claim, transition
+from apps.multiparser.ratelimit import HostRateLimiter
+from apps.multiparser.retry import CircuitBreaker, retry_after_seconds
+from apps.multiparser.tasks import extract_document_text, extract_missing_text
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def product_item(product_id, **fields):
+    """A `ProductItem` as decoded from a listing page, with `fields` overriding the defaults"""
+    item = {
+        'id': product_id,
+        'title': f"Product {product_id}",
+        'slug': f"product-{product_id}",
+        'price': 15000,
+        'discount_price': 12000,
+        'poster_url': f"https://example.com/media/Images/{product_id:08d}-0000-0000-0000-000000000000.pdf_page-1.webp",
+        'seller': {'id': 7, 'fullname': 'Seller'},
+        'document': {'page_count': 3, 'file_size': '1 MB', 'file_type': 'pdf'},
+    }
+    item.update(fields)
+    return ProductItem.from_dict(item)
+
+
+class DecodePageTests(SimpleTestCase):
+
+    def decoders(self):
+        return ['json'] + [name for name, module in [('orjson', orjson), ('ijson', ijson)] if module]
+
+    def test_null_products_data_is_an_empty_page(self):
+        for body in [b'{"pageProps": {"productsData": null}}', b'{"pageProps": {"productsData": {"results": null}}}',
+                     b'{"pageProps": null}', b'{}']:
+            for decoder in self.decoders():
+                with self.subTest(body=body, decoder=decoder):
+                    self.assertEqual(decode_page(body, decoder=decoder), [])
+
+    def test_malformed_page_raises_value_error(self):
+        for body in [b'{"pageProps": ', b'[1, 2]']:
+            for decoder in self.decoders():
+                if decoder == 'ijson' and body == b'[1, 2]':
+                    # Streamed by path: a document without it has no results
+                    continue
+                with self.subTest(body=body, decoder=decoder), self.assertRaises(ValueError):
+                    decode_page(body, decoder=decoder)
+
+
+class RetryAfterSecondsTests(SimpleTestCase):
+
+    def test_delta_seconds(self):
+        self.assertEqual(retry_after_seconds({'Retry-After': '120'}), 120.0)
+        self.assertEqual(retry_after_seconds({'retry-after': ' 5 '}), 5.0)
+
+    def test_http_date(self):
+        retry_at = timezone.now() + timezone.timedelta(seconds=30)
+        seconds = retry_after_seconds({'Retry-After': format_datetime(retry_at, usegmt=True)})
+        self.assertAlmostEqual(seconds, 30, delta=2)
+
+    def test_http_date_in_the_past(self):
+        retry_at = timezone.now() - timezone.timedelta(hours=1)
+        self.assertEqual(retry_after_seconds({'Retry-After': format_datetime(retry_at, usegmt=True)}), 0.0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(retry_after_seconds({}))
+        self.assertIsNone(retry_after_seconds(None))
+        self.assertIsNone(retry_after_seconds({'Retry-After': 'soon'}))
+        self.assertIsNone(retry_after_seconds({'Retry-After': '-1'}))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker('files.example.com', failure_threshold=3, reset_timeout=60.0)
+
+    def test_opens_after_threshold(self):
+        self.assertEqual(self.breaker.record_failure(), 0.0)
+        self.assertEqual(self.breaker.record_failure(), 0.0)
+        self.assertEqual(self.breaker.open_for(), 0.0)
+
+        self.assertEqual(self.breaker.record_failure(), 60.0)
+        self.assertAlmostEqual(self.breaker.open_for(), 60.0, delta=1)
+
+    def test_retry_after_opens_at_once(self):
+        self.assertEqual(self.breaker.record_failure(retry_after=15.0), 15.0)
+        self.assertAlmostEqual(self.breaker.open_for(), 15.0, delta=1)
+
+    def test_success_closes(self):
+        self.breaker.record_failure(retry_after=15.0)
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.open_for(), 0.0)
+        # The failure count starts over as well
+        self.assertEqual(self.breaker.record_failure(), 0.0)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.breaker.record_failure(retry_after=10.0)
+        with mock.patch('apps.multiparser.retry.time') as clock:
+            clock.time.return_value = time.time() + 11
+            self.assertEqual(self.breaker.open_for(), 0.0)
+            self.assertEqual(self.breaker.open_for(), CircuitBreaker.PROBE_WAIT)
+
+    def test_hosts_are_independent(self):
+        self.breaker.record_failure(retry_after=10.0)
+        self.assertEqual(CircuitBreaker.for_url('https://other.example.com/file.pdf').open_for(), 0.0)
+
+
+class HostRateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('apps.multiparser.ratelimit.get_redis', return_value=fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_spaced_slots(self):
+        limiter = HostRateLimiter('files.example.com', rate=2.0, burst=3)
+        waits = [limiter.reserve() for _ in range(5)]
+        self.assertEqual(waits[:3], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(waits[3], 0.5, delta=0.1)
+        self.assertAlmostEqual(waits[4], 1.0, delta=0.1)
+
+    def test_limiters_of_a_host_share_the_bucket(self):
+        first = HostRateLimiter('files.example.com', rate=1.0, burst=1)
+        second = HostRateLimiter.for_url('https://files.example.com/a.pdf', rate=1.0, burst=1)
+        self.assertEqual(first.reserve(), 0.0)
+        self.assertAlmostEqual(second.reserve(), 1.0, delta=0.1)
+        self.assertEqual(HostRateLimiter('other.example.com', rate=1.0, burst=1).reserve(), 0.0)
+
+
+class TextBudgetTests(SimpleTestCase):
+
+    def test_keeps_text_that_fits(self):
+        budget = TextBudget(100)
+        budget.add('Hello,\n  world ')
+        budget.add('\tagain')
+        result = budget.result()
+        self.assertEqual(result.text, 'Hello, world again')
+        self.assertFalse(result.truncated)
+
+    def test_cuts_to_the_budget(self):
+        for max_chars in (10, 100, 1000):
+            budget = TextBudget(max_chars)
+            pages = [f"page {page}" + ' word' * 20 for page in range(500)]
+            for page in pages:
+                budget.add(page)
+            result = budget.result()
+            self.assertLessEqual(len(result.text), max_chars)
+            self.assertTrue(result.text.startswith('page 0'))
+            self.assertTrue(result.truncated)
+            self.assertEqual(result.seen, len(' '.join(pages)))
+
+    def test_sample_is_repeatable(self):
+        def extract():
+            budget = TextBudget(200)
+            for page in range(1000):
+                budget.add(f"page {page}")
+            return budget.result().text
+        self.assertEqual(extract(), extract())
+
+
+class ReadTextTests(SimpleTestCase):
+
+    def test_words_split_between_chunks(self):
+        self.assertEqual(read_text([b'hel', b'lo  wor', b'ld\n', b'again']).text, 'hello world again')
+
+    def test_characters_split_between_chunks(self):
+        data = 'привет мир'.encode()
+        self.assertEqual(read_text([data[:3], data[3:]]).text, 'привет мир')
+
+    def test_invalid_bytes_are_replaced(self):
+        self.assertEqual(read_text([b'ab\xff cd']).text, 'ab\ufffd cd')
+
+    def test_endless_word_is_split(self):
+        # The carried word is let go once it grows past MAX_WORD
+        result = read_text([b'x' * 1024] * (3 * MAX_WORD // 1024), max_chars=10 * MAX_WORD)
+        words = result.text.split(' ')
+        self.assertGreater(len(words), 1)
+        self.assertLessEqual(max(map(len, words)), MAX_WORD + 1024)
+        self.assertEqual(sum(map(len, words)), 3 * MAX_WORD)
+
+
+class PlainTextExtractorTests(SimpleTestCase):
+
+    def test_pieces_end_at_line_ends(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write(('word ' * 100 + '\n') * (3 * TEXT_CHUNK_SIZE // 500))
+            f.flush()
+            pieces = list(extract_plain_text(f.name))
+        self.assertGreater(len(pieces), 1)
+        self.assertTrue(all(piece.endswith('\n') for piece in pieces))
+
+    def test_line_without_end_is_read_in_bounded_pieces(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            text = 'word ' * (3 * TEXT_CHUNK_SIZE // 5)
+            f.write(text)
+            f.flush()
+            pieces = list(extract_plain_text(f.name))
+        self.assertLessEqual(max(map(len, pieces)), TEXT_CHUNK_SIZE + MAX_WORD)
+        self.assertEqual(''.join(pieces), text)
+
+
+class UploadQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.sent = []
+        uploader = mock.Mock(limiter=mock.Mock(reserve=mock.Mock(return_value=0.0)), send=self.send)
+        for name, value in [
+            ('get_redis', mock.Mock(return_value=self.redis)),
+            ('get_uploader', mock.Mock(return_value=uploader)),
+            ('prepare_uploads', self.prepare_uploads),
+            ('record_upload', mock.Mock()),
+        ]:
+            patcher = mock.patch.object(telegram_upload, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def prepare_uploads(self, document_ids, summary):
+        return [mock.Mock(documents=[mock.Mock(id=document_id)]) for document_id in document_ids]
+
+    def send(self, group):
+        if self.sent:
+            raise RuntimeError('connection reset')
+        self.sent.extend(upload.documents[0].id for upload in group)
+        return ['file-id'] * len(group)
+
+    def queued(self):
+        return {document_id.decode() for document_id in self.redis.smembers(telegram_upload.UPLOAD_QUEUE_KEY)}
+
+    def test_interrupted_run_requeues_what_it_took(self):
+        ids = {f"doc-{n}" for n in range(25)}
+        telegram_upload.queue_upload(ids)
+        with self.assertRaises(RuntimeError):
+            telegram_upload.upload_pending(60)
+        self.assertEqual(len(self.sent), telegram_upload.MEDIA_GROUP_SIZE)
+        self.assertEqual(self.queued(), ids - set(self.sent))
+        self.assertFalse(self.redis.exists(telegram_upload.UPLOAD_SENDING_KEY))
+
+    def test_run_out_of_time_requeues_what_it_took(self):
+        telegram_upload.queue_upload(['doc-1', 'doc-2'])
+        summary = telegram_upload.upload_pending(-1)
+        self.assertEqual(summary['uploaded'], 0)
+        self.assertEqual(self.queued(), {'doc-1', 'doc-2'})
+
+
+class DedupTests(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch('apps.multiparser.dedup.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_enqueue_once(self):
+        task = mock.Mock()
+        task.name = 'extract'
+        self.assertTrue(enqueue_once(task, 'doc'))
+        self.assertFalse(enqueue_once(task, 'doc'))
+        # A variant claimed apart is published while the plain task is queued
+        self.assertTrue(enqueue_once(task, 'doc', claim_name='extract:send', send=True))
+        task.apply_async.assert_called_with(args=['doc'], kwargs={'send': True})
+
+        task_finished('extract', 'doc')
+        self.assertTrue(enqueue_once(task, 'doc'))
+        self.assertFalse(enqueue_once(task, 'doc', claim_name='extract:send', send=True))
+
+    def test_lock_is_renewed_while_held(self):
+        lock = TaskLock('extract', 'doc', ttl=1)
+        self.assertTrue(lock.acquire())
+        time.sleep(1.5)
+        self.assertFalse(TaskLock('extract', 'doc', ttl=1).acquire())
+        lock.release()
+        lock = TaskLock('extract', 'doc', ttl=1)
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PageFetcherTests(SimpleTestCase):
+
+    def test_crashed_fetch_loop_is_raised(self):
+        fetcher = PageFetcher('https://example.com/?page={}')
+        with mock.patch.object(PageFetcher, '_produce', side_effect=RuntimeError('loop died')):
+            with self.assertLogs('apps.multiparser.crawler', 'ERROR'), self.assertRaisesMessage(RuntimeError, 'loop died'):
+                list(fetcher.iter_pages(range(1, 4)))
+
+
+class PartialDownloadTests(SimpleTestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.part = PartialDownload('doc')
+
+    def write_partial(self, data, validator='"v1"'):
+        self.part.path.parent.mkdir(parents=True, exist_ok=True)
+        self.part.path.write_bytes(data)
+        if validator:
+            self.part.validator_path.write_text(validator)
+
+    def test_parse_content_range(self):
+        self.assertEqual(parse_content_range('bytes 100-199/1000'), (100, 1000))
+        self.assertEqual(parse_content_range('bytes */1000'), (None, 1000))
+        self.assertEqual(parse_content_range('bytes 0-9/*'), (0, None))
+        self.assertEqual(parse_content_range('pages 1-2/3'), (None, None))
+        self.assertEqual(parse_content_range(None), (None, None))
+
+    def test_full_download(self):
+        self.assertNotIn('Range', self.part.request_headers())
+        self.part.receive(200, {'content-length': '6', 'etag': '"v1"'}, [b'abc', b'def'])
+        self.assertEqual(self.part.validator_path.read_text(), '"v1"')
+        self.assertEqual(self.part.verify(), 6)
+        self.assertEqual(self.part.sha256(), hashlib.sha256(b'abcdef').hexdigest())
+
+    def test_resume_from_offset(self):
+        self.write_partial(b'abc')
+        headers = self.part.request_headers()
+        self.assertEqual(headers['Range'], 'bytes=3-')
+        self.assertEqual(headers['If-Range'], '"v1"')
+
+        self.part.receive(206, {'content-range': 'bytes 3-5/6'}, [b'def'])
+        self.assertEqual(self.part.resumed, 3)
+        self.assertEqual(self.part.path.read_bytes(), b'abcdef')
+        self.assertEqual(self.part.verify(), 6)
+        self.assertEqual(self.part.sha256(), hashlib.sha256(b'abcdef').hexdigest())
+
+    def test_no_validator_starts_over(self):
+        self.write_partial(b'abc', validator=None)
+        self.assertNotIn('Range', self.part.request_headers())
+        self.assertFalse(self.part.path.exists())
+
+    def test_resume_at_wrong_offset_discards(self):
+        self.write_partial(b'abc')
+        with self.assertRaises(IncompleteDownload):
+            self.part.receive(206, {'content-range': 'bytes 0-5/6'}, [b'abcdef'])
+        self.assertFalse(self.part.path.exists())
+
+    def test_changed_file_restarts(self):
+        # If-Range did not match: the server sends the whole new file
+        self.write_partial(b'old')
+        self.part.receive(200, {'content-length': '3', 'etag': '"v2"'}, [b'new'])
+        self.assertEqual(self.part.resumed, 0)
+        self.assertEqual(self.part.path.read_bytes(), b'new')
+        self.assertEqual(self.part.validator_path.read_text(), '"v2"')
+
+    def test_range_not_satisfiable_on_complete_file(self):
+        self.write_partial(b'abcdef')
+        self.assertFalse(self.part.receive(416, {'content-range': 'bytes */6'}, []))
+        self.assertEqual(self.part.verify(), 6)
+        self.assertEqual(self.part.sha256(), hashlib.sha256(b'abcdef').hexdigest())
+
+    def test_range_not_satisfiable_on_other_size_discards(self):
+        self.write_partial(b'abcdef')
+        with self.assertRaises(IncompleteDownload):
+            self.part.receive(416, {'content-range': 'bytes */4'}, [])
+        self.assertFalse(self.part.path.exists())
+
+    def test_short_transfer_keeps_part(self):
+        self.part.receive(200, {'content-length': '6', 'etag': '"v1"'}, [b'abc'])
+        with self.assertRaises(IncompleteDownload):
+            self.part.verify()
+        self.assertEqual(self.part.path.read_bytes(), b'abc')
+
+
+class BatchWriterTests(TestCase):
+
+    def flush(self, *pages):
+        writer = BatchWriter()
+        for page, items in pages:
+            writer.add(page, items)
+        return writer.flush()
+
+    def test_creates_then_skips_unchanged(self):
+        result = self.flush((1, [product_item(1), product_item(2)]))
+        self.assertEqual((result.products_created, result.sellers_created), (2, 1))
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(CrawlPage.objects.get(page=1).product_count, 2)
+
+        result = self.flush((1, [product_item(1), product_item(2)]))
+        self.assertEqual((result.products_created, result.products_unchanged), (0, 2))
+
+    def test_update_keeps_document(self):
+        self.flush((1, [product_item(1)]))
+        document_id = Product.objects.get(id=1).document_id
+
+        result = self.flush((1, [product_item(1, title='Renamed', seller={'id': 7, 'fullname': 'New name'})]))
+        self.assertEqual(result.products_updated, 1)
+        product = Product.objects.get(id=1)
+        self.assertEqual((product.title, product.document_id), ('Renamed', document_id))
+        self.assertEqual(Seller.objects.get(id='7').fullname, 'New name')
+
+    def test_cleans_invalid_values(self):
+        result = self.flush((1, [product_item(1, price=None), product_item(2, discount_price='n/a'), product_item(3, slug='')]))
+        self.assertEqual(result.products_created, 1)
+        self.assertIsNone(Product.objects.get(id=2).discount_price)
+
+    def test_rejected_product_does_not_drop_the_batch(self):
+        self.flush((1, [product_item(1)]))
+
+        result = self.flush(
+            (2, [product_item(2), product_item(3, slug='product-1')]),
+            (3, [product_item(4)]),
+        )
+        self.assertEqual(result.products_created, 2)
+        self.assertEqual(result.products_failed, 1)
+        self.assertEqual(result.failed_pages, [2])
+        self.assertEqual(set(Product.objects.values_list('id', flat=True)), {1, 2, 4})
+        # The page with the lost product is not recorded as stored
+        self.assertFalse(CrawlPage.objects.filter(page=2).exists())
+        self.assertTrue(CrawlPage.objects.filter(page=3).exists())
+
+    def test_page_unchanged(self):
+        self.flush((1, [product_item(1), product_item(2)]))
+        self.assertTrue(is_page_unchanged(1, [product_item(1), product_item(2)]))
+        self.assertFalse(is_page_unchanged(1, [product_item(1), product_item(2, price=9000)]))
+        # Same products, page not stored under this number: the fingerprints decide
+        self.assertTrue(is_page_unchanged(5, [product_item(1), product_item(2)]))
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class PipelineTests(TestCase):
+
+    def document(self, stage):
+        return Document.objects.create(file_size='1 MB', file_type='.pdf', stage=stage)
+
+    def stage(self, document):
+        return Document.objects.values_list('stage', flat=True).get(id=document.id)
+
+    def test_transition_moves_documents_from_allowed_stages(self):
+        document = self.document(Document.Stage.DOWNLOADING)
+
+        moved = transition(Document.objects.filter(id=document.id), Document.Stage.DOWNLOADED, download_error=None)
+        self.assertEqual(moved, 1)
+        self.assertEqual(self.stage(document), Document.Stage.DOWNLOADED)
+
+    def test_transition_refuses_other_stages(self):
+        pending = self.document(Document.Stage.PENDING)
+        # A late step of a document another worker already moved on
+        stale = self.document(Document.Stage.UPLOADED)
+
+        self.assertEqual(transition(Document.objects.filter(id=pending.id), Document.Stage.EVICTED), 0)
+        self.assertEqual(
+            transition(Document.objects.filter(id=stale.id), Document.Stage.FAILED, download_error='late'), 0
+        )
+        self.assertEqual(self.stage(pending), Document.Stage.PENDING)
+        self.assertEqual(self.stage(stale), Document.Stage.UPLOADED)
+        self.assertIsNone(Document.objects.get(id=stale.id).download_error)
+
+    def test_advance_sets_fields_and_moves_allowed_stages_only(self):
+        documents = {stage: self.document(stage) for stage in [
+            Document.Stage.PENDING, Document.Stage.DOWNLOADED, Document.Stage.EXTRACTED, Document.Stage.UPLOADED,
+        ]}
+
+        advance(Document.objects.all(), Document.Stage.INDEXED, download_error='cleared')
+        self.assertEqual(
+            {stage: self.stage(document) for stage, document in documents.items()},
+            {
+                Document.Stage.PENDING: Document.Stage.PENDING,
+                Document.Stage.DOWNLOADED: Document.Stage.INDEXED,
+                Document.Stage.EXTRACTED: Document.Stage.INDEXED,
+                Document.Stage.UPLOADED: Document.Stage.UPLOADED,
+            },
+        )
+        self.assertEqual(set(Document.objects.values_list('download_error', flat=True)), {'cleared'})
+
+    def test_claim_takes_claimable_documents_only(self):
+        pending = self.document(Document.Stage.PENDING)
+        failed = self.document(Document.Stage.FAILED)
+        downloaded = self.document(Document.Stage.DOWNLOADED)
+        started_at = timezone.now()
+
+        claimed = claim(
+            [pending.id, failed.id, downloaded.id], Document.Stage.DOWNLOADING,
+            sources=[Document.Stage.PENDING], download_started_at=started_at,
+        )
+        self.assertEqual(claimed, [pending.id])
+        self.assertEqual(self.stage(pending), Document.Stage.DOWNLOADING)
+        self.assertEqual(Document.objects.get(id=pending.id).download_started_at, started_at)
+        self.assertEqual(self.stage(failed), Document.Stage.FAILED)
+        self.assertEqual(self.stage(downloaded), Document.Stage.DOWNLOADED)
+
+        # Without `sources`, every stage the target may be entered from
+        self.assertEqual(claim([failed.id, downloaded.id], Document.Stage.DOWNLOADING), [failed.id])
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class DownloadLeaseTests(TestCase):
+
+    def document(self, stage, started_minutes_ago=None):
+        started_at = timezone.now() - timezone.timedelta(minutes=started_minutes_ago) if started_minutes_ago else None
+        return Document.objects.create(
+            file_size='1 MB', file_type='.pdf', file_url='https://example.com/a.pdf',
+            stage=stage, download_started_at=started_at,
+        )
+
+    def test_lease_records_outcome_while_held(self):
+        document = self.document(Document.Stage.DOWNLOADING, started_minutes_ago=1)
+        lease = DownloadLease([document.id], document.download_started_at)
+
+        self.assertEqual(lease.transition(Document.Stage.DOWNLOADED, download_error=None), 1)
+        self.assertEqual(Document.objects.get(id=document.id).stage, Document.Stage.DOWNLOADED)
+
+    def test_lost_lease_does_not_record_outcome(self):
+        document = self.document(Document.Stage.DOWNLOADING, started_minutes_ago=120)
+        lease = DownloadLease([document.id], document.download_started_at)
+        release_expired_downloads(lease=3600)
+        # Claimed again by another worker
+        claim([document.id], Document.Stage.DOWNLOADING, download_started_at=timezone.now())
+
+        self.assertEqual(lease.transition(Document.Stage.FAILED, download_error='late'), 0)
+        document.refresh_from_db()
+        self.assertEqual(document.stage, Document.Stage.DOWNLOADING)
+        self.assertIsNone(document.download_error)
+
+    def test_renewal_keeps_lease_from_expiring(self):
+        document = self.document(Document.Stage.DOWNLOADING, started_minutes_ago=120)
+        lease = DownloadLease([document.id], document.download_started_at)
+
+        # One renewal, run in this thread so that it shares the test transaction
+        with override_settings(DOWNLOAD_LEASE_SECONDS=3600), \
+                mock.patch.object(lease._stopped, 'wait', side_effect=[False, True]), \
+                mock.patch('apps.multiparser.downloader.connection'):
+            lease._keep_alive()
+
+        self.assertEqual(release_expired_downloads(lease=3600), [])
+        self.assertEqual(lease.transition(Document.Stage.DOWNLOADED), 1)
+
+    def test_expired_downloads_go_back_to_pending(self):
+        expired = self.document(Document.Stage.DOWNLOADING, started_minutes_ago=120)
+        unknown = self.document(Document.Stage.DOWNLOADING)
+        running = self.document(Document.Stage.DOWNLOADING, started_minutes_ago=5)
+        downloaded = self.document(Document.Stage.DOWNLOADED, started_minutes_ago=120)
+
+        self.assertEqual(set(release_expired_downloads(lease=3600)), {expired.id, unknown.id})
+        stages = dict(Document.objects.values_list('id', 'stage'))
+        self.assertEqual(stages[expired.id], Document.Stage.PENDING)
+        self.assertEqual(stages[unknown.id], Document.Stage.PENDING)
+        self.assertEqual(stages[running.id], Document.Stage.DOWNLOADING)
+        self.assertEqual(stages[downloaded.id], Document.Stage.DOWNLOADED)
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class ExtractMissingTextTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.media_root = Path(media_root)
+
+    def document(self, file_type, content, stage=Document.Stage.DOWNLOADED):
+        document = Document.objects.create(file_size='1 KB', file_type=file_type, stage=stage)
+        document.file_path = f"documents/{document.id}{file_type if file_type.startswith('.') else ''}"
+        (self.media_root / 'documents').mkdir(exist_ok=True)
+        (self.media_root / document.file_path).write_bytes(content)
+        Document.objects.filter(id=document.id).update(file_path=document.file_path)
+        return document
+
+    def test_queues_documents_without_text(self):
+        pdf = self.document('.pdf', b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<<>>\nendobj\n')
+        text = self.document('txt', b'plain words\n')
+        image = self.document('.png', b'\x89PNG\r\n\x1a\n' + b'\0' * 32)
+        extracted = self.document('.pdf', b'%PDF-1.4\n', stage=Document.Stage.EXTRACTED)
+
+        with mock.patch('apps.multiparser.tasks.enqueue_once') as enqueue_once:
+            extract_missing_text([pdf.id, text.id, image.id, extracted.id])
+        self.assertEqual(
+            {call.args[1] for call in enqueue_once.call_args_list if call.args[0] is extract_document_text},
+            {pdf.id, text.id},
+        )
@@ -17,11 +17,31 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 app.conf.enable_utc = False
 
+# Listing crawl chunks and text extraction run on their own queues so they never compete
+# with downloads; Telegram uploads have a single-process queue that owns the channel's rate limit
+app.conf.task_routes = {
+    'apps.multiparser.tasks.crawl_page_range': {'queue': 'crawl'},
+    'apps.multiparser.tasks.extract_document_text': {'queue': 'extract'},
+    'apps.multiparser.tasks.flush_telegram_uploads': {'queue': 'telegram'},
+}
+
 app.conf.beat_schedule = {
     'update-parsed-data-every-3-days': {
         'task': 'apps.multiparser.tasks.update_parsed_data_periodic',
         'schedule': crontab(hour=2, minute=0, day_of_week='*/3'),
     },
+    'flush-index-buffer-every-minute': {
+        'task': 'apps.multiparser.tasks.flush_index_buffer',
+        'schedule': 60.0,
+    },
+    'flush-telegram-uploads-every-minute': {
+        'task': 'apps.multiparser.tasks.flush_telegram_uploads',
+        'schedule': 60.0,
+    },
+    'check-media-space-every-5-minutes': {
+        'task': 'apps.multiparser.tasks.check_media_space',
+        'schedule': 300.0,
+    },
     'cleanup-old-files-weekly': {
         'task': 'apps.multiparser.tasks.cleanup_old_files',
         'schedule': crontab(hour=3, minute=0, day_of_week=0),
@@ -141,10 +141,11 @@ MEDIA_ROOT = BASE_DIR / "media"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Cache configuration
+REDIS_URL = env.str("REDIS_URL", "redis://localhost:6379/0")
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.redis.RedisCache",
-        "LOCATION": env.str("REDIS_URL", "redis://localhost:6379/0"),
+        "LOCATION": REDIS_URL,
     }
 }
 
@@ -200,8 +201,54 @@ ELASTICSEARCH_DSL = {
     }
 }
 
+# Bulk indexing: documents per request, maximum request size, and parallel_bulk threads
+ES_BULK_CHUNK_SIZE = env.int("ES_BULK_CHUNK_SIZE", 500)
+ES_BULK_MAX_BYTES = env.int("ES_BULK_MAX_BYTES", 10 * 1024 * 1024)
+ES_BULK_THREADS = env.int("ES_BULK_THREADS", 4)
+
 # Tika server configuration
 TIKA_SERVER_ENDPOINT = env.str("TIKA_SERVER_ENDPOINT", "http://localhost:9998")
+# Stream downloads to Tika as they arrive instead of re-reading the file for indexing
+EXTRACT_WHILE_DOWNLOADING = env.bool("EXTRACT_WHILE_DOWNLOADING", True)
+# Tika servers used round-robin, and concurrent extractions allowed per server
+TIKA_SERVER_ENDPOINTS = env.list("TIKA_SERVER_ENDPOINTS", default=[TIKA_SERVER_ENDPOINT])
+TIKA_MAX_IN_FLIGHT = env.int("TIKA_MAX_IN_FLIGHT", 2)
+# Per-file extraction timeout: base seconds plus allowances per page and per MB, capped
+TIKA_TIMEOUT = env.float("TIKA_TIMEOUT", 30.0)
+TIKA_TIMEOUT_PER_PAGE = env.float("TIKA_TIMEOUT_PER_PAGE", 0.5)
+TIKA_TIMEOUT_PER_MB = env.float("TIKA_TIMEOUT_PER_MB", 5.0)
+TIKA_TIMEOUT_MAX = env.float("TIKA_TIMEOUT_MAX", 900.0)
+# Extract PDF, DOCX, PPTX and plain text in-process (pool of N processes, 0 runs inline), Tika for the rest
+NATIVE_EXTRACTION = env.bool("NATIVE_EXTRACTION", True)
+NATIVE_EXTRACTION_PROCESSES = env.int("NATIVE_EXTRACTION_PROCESSES", 2)
+# Characters of extracted text kept per document: the beginning plus a sample of later pages
+EXTRACTED_TEXT_MAX_CHARS = env.int("EXTRACTED_TEXT_MAX_CHARS", 1000000)
+
+# Listing crawler response cache (ETag/Last-Modified revalidation and offline replay)
+CRAWL_CACHE_DIR = env.str("CRAWL_CACHE_DIR", str(BASE_DIR / "cache" / "crawl"))
+
+# Per-host download rate limit (requests per second, shared by all workers) and burst size
+DOWNLOAD_RATE_LIMIT = env.float("DOWNLOAD_RATE_LIMIT", 2.0)
+DOWNLOAD_RATE_BURST = env.int("DOWNLOAD_RATE_BURST", 5)
+# Periodic download fan-out: tasks published per group, and most documents queued at once
+DOWNLOAD_DISPATCH_CHUNK = env.int("DOWNLOAD_DISPATCH_CHUNK", 500)
+DOWNLOAD_MAX_IN_FLIGHT = env.int("DOWNLOAD_MAX_IN_FLIGHT", 5000)
+# Seconds a download lease lasts; workers renew it every third of that while downloading, and a
+# document whose lease ran out is taken for a lost download and handed back to pending
+DOWNLOAD_LEASE_SECONDS = env.int("DOWNLOAD_LEASE_SECONDS", 3600)
+# Pipeline task de-duplication: seconds a (task, document) pair stays claimed when its task
+# never finishes, and seconds a running task's lock outlives its worker (it is renewed while
+# the task runs, so it may be shorter than the longest download or extraction)
+TASK_QUEUED_TTL = env.int("TASK_QUEUED_TTL", 6 * 3600)
+TASK_LOCK_TTL = env.int("TASK_LOCK_TTL", 15 * 60)
+
+# Local file cleanup: rows per chunk and parallel deletes. Below MEDIA_MIN_FREE_BYTES free in
+# MEDIA_ROOT, files already in the channel are evicted least recently used first until
+# MEDIA_TARGET_FREE_BYTES are free
+CLEANUP_CHUNK_SIZE = env.int("CLEANUP_CHUNK_SIZE", 1000)
+CLEANUP_THREADS = env.int("CLEANUP_THREADS", 8)
+MEDIA_MIN_FREE_BYTES = env.int("MEDIA_MIN_FREE_BYTES", 5 * 1024 ** 3)
+MEDIA_TARGET_FREE_BYTES = env.int("MEDIA_TARGET_FREE_BYTES", 10 * 1024 ** 3)
 
 # File upload settings
 MAX_UPLOAD_SIZE = env.int("MAX_UPLOAD_SIZE", 10485760)  # 10MB
@@ -266,4 +313,10 @@ LOGGING = {
 # Create logs directory if it doesn't exist
 os.makedirs(BASE_DIR / "logs", exist_ok=True)
 BOT_TOKEN=env.str("BOT_TOKEN", None)
-WEBHOOK_URL=env.str("WEBHOOK_URL", None)
\ No newline at end of file
+WEBHOOK_URL=env.str("WEBHOOK_URL", None)
+FORCE_CHANNEL_ID=env.str("FORCE_CHANNEL_ID", None)
+# Channel uploads: messages per second (Telegram allows about 20 per minute in one channel),
+# burst size, and seconds each flush_telegram_uploads run may spend uploading
+TELEGRAM_UPLOAD_RATE = env.float("TELEGRAM_UPLOAD_RATE", 0.3)
+TELEGRAM_UPLOAD_BURST = env.int("TELEGRAM_UPLOAD_BURST", 10)
+TELEGRAM_FLUSH_SECONDS = env.int("TELEGRAM_FLUSH_SECONDS", 50)
\ No newline at end of file
@@ -1,2 +1 @@
-python manage.py search_index --create
-python manage.py search_index --populate
\ No newline at end of file
+python manage.py reindex